@@ -0,0 +1,113 @@
+# app/common/events.py
+# -------------------------------------------------------------
+# Pub/sub in-process per push verso il frontend via Server-Sent Events.
+# I route che scrivono (save/conferma/chiusura parziali) pubblicano su un topic,
+# i client aperti su /stream/... ricevono l'evento invece di fare polling.
+#
+# NB: il broker vive nel processo. Con più worker (gunicorn -w N) ogni worker
+# vede solo i propri publish: per lo streaming usare un solo processo con
+# thread (es. gunicorn -w 1 -k gthread --threads 32).
+# -------------------------------------------------------------
+
+import json
+import logging
+import queue
+import threading
+from typing import Iterable, Optional
+
+from flask import Response
+
+SSE_HEARTBEAT_SECONDS = 15
+SSE_QUEUE_SIZE = 100
+
+
+class EventBroker:
+    """Topic -> code dei subscriber. publish() non blocca mai il chiamante."""
+
+    def __init__(self, queue_size: int = SSE_QUEUE_SIZE):
+        self._lock = threading.Lock()
+        self._subs: dict[str, set] = {}
+        self._queue_size = queue_size
+
+    def subscribe(self, topics: Iterable[str]) -> queue.Queue:
+        q = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            for t in topics:
+                self._subs.setdefault(t, set()).add(q)
+        return q
+
+    def unsubscribe(self, topics: Iterable[str], q: queue.Queue) -> None:
+        with self._lock:
+            for t in topics:
+                subs = self._subs.get(t)
+                if subs is None:
+                    continue
+                subs.discard(q)
+                if not subs:
+                    self._subs.pop(t, None)
+
+    def publish(self, topic: str, event: str, data) -> int:
+        with self._lock:
+            subs = list(self._subs.get(topic, ()))
+        msg = (topic, event, data)
+        for q in subs:
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # client lento: scarta il più vecchio, tieni l'ultimo stato
+                try:
+                    q.get_nowait()
+                    q.put_nowait(msg)
+                except (queue.Empty, queue.Full):
+                    pass
+        return len(subs)
+
+    def subscribers(self, topic: str) -> int:
+        with self._lock:
+            return len(self._subs.get(topic, ()))
+
+
+broker = EventBroker()
+
+
+def publish(topic: str, event: str, data) -> None:
+    """Best-effort: un errore di push non deve mai far fallire la scrittura."""
+    try:
+        broker.publish(topic, event, data)
+    except Exception as ex:
+        logging.warning(f"[events] publish fallita su {topic}/{event}: {ex}")
+
+
+def _sse_format(event: str, data, topic: Optional[str] = None) -> str:
+    payload = data if topic is None else {"topic": topic, "data": data}
+    return f"event: {event}\ndata: {json.dumps(payload, default=str, ensure_ascii=False)}\n\n"
+
+
+def sse_response(topics: list[str], initial: Optional[tuple[str, object]] = None,
+                 heartbeat: int = SSE_HEARTBEAT_SECONDS) -> Response:
+    """
+    Response text/event-stream sui topic indicati.
+    La sottoscrizione avviene subito (non al primo read) così nessun evento
+    pubblicato tra la risposta e la prima lettura va perso.
+    """
+    q = broker.subscribe(topics)
+
+    def _gen():
+        try:
+            yield "retry: 3000\n\n"
+            if initial is not None:
+                yield _sse_format(initial[0], initial[1])
+            while True:
+                try:
+                    topic, event, data = q.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield _sse_format(event, data, topic)
+        finally:
+            broker.unsubscribe(topics, q)
+
+    return Response(_gen(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",   # niente buffering dietro nginx
+    })
@@ -0,0 +1,207 @@
+# app/common/log_sink.py
+# -------------------------------------------------------------
+# Scrittura bufferizzata dei log (movimenti_produzione_vendor).
+# I route accodano i record in memoria e un thread di background li inserisce
+# a blocchi (per dimensione o per tempo): la richiesta non aspetta l'insert.
+#
+# Modalità (env MOVIMENTI_LOG_MODE):
+#   async   -> thread di background (default)
+#   request -> flush a fine richiesta (teardown del blueprint), utile nei test
+#   sync    -> insert immediato, come prima
+#
+# Se un blocco fallisce si riprova riga per riga (con il paracadute FK del
+# chiamante), ma solo per errori legati ai dati: su errori di rete/timeout il
+# blocco va direttamente nello spool JSONL su disco, che viene reinserito al primo
+# flush andato a buon fine. Lo spool è condiviso tra i worker (gunicorn) ed è
+# protetto da flock. Oltre MOVIMENTI_LOG_MAX_PENDING record in coda i più vecchi
+# vengono spostati nello spool, così la memoria resta limitata se il DB non risponde.
+# -------------------------------------------------------------
+
+import atexit
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+import httpx
+
+try:
+    import fcntl
+except ImportError:  # Windows: niente lock tra processi
+    fcntl = None
+
+LOG_SINK_MODE = os.getenv("MOVIMENTI_LOG_MODE", "async")
+LOG_SINK_BATCH = int(os.getenv("MOVIMENTI_LOG_BATCH", "200"))
+LOG_SINK_FLUSH_SECONDS = float(os.getenv("MOVIMENTI_LOG_FLUSH_SECONDS", "1.0"))
+LOG_SINK_SPOOL_DIR = os.getenv("MOVIMENTI_LOG_SPOOL_DIR", tempfile.gettempdir())
+LOG_SINK_MAX_PENDING = int(os.getenv("MOVIMENTI_LOG_MAX_PENDING", "10000"))
+LOG_SINK_EXIT_TIMEOUT = 10.0
+
+# errori non legati alla singola riga: inutile riprovare riga per riga
+_TRANSPORT_EXC = (httpx.TransportError, ConnectionError, TimeoutError)
+
+
+def _lock_file(fh) -> None:
+    if fcntl is not None:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+
+
+def _same_file(fh, path: str) -> bool:
+    """True se path punta ancora al file aperto (non rimosso da un replay concorrente)."""
+    try:
+        return os.stat(path).st_ino == os.fstat(fh.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+class BufferedLogSink:
+    """
+    Coda in-process di record da inserire in blocco.
+    insert_many(rows) e insert_one(row) devono sollevare in caso di errore.
+    """
+
+    def __init__(self, name: str, insert_many: Callable[[list], None],
+                 insert_one: Optional[Callable[[dict], None]] = None,
+                 mode: str = LOG_SINK_MODE, batch_size: int = LOG_SINK_BATCH,
+                 flush_interval: float = LOG_SINK_FLUSH_SECONDS,
+                 spool_path: Optional[str] = None,
+                 max_pending: int = LOG_SINK_MAX_PENDING):
+        self.name = name
+        self.mode = mode
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = flush_interval
+        self.max_pending = max(self.batch_size, int(max_pending))
+        self.spool_path = spool_path or os.path.join(LOG_SINK_SPOOL_DIR, f"{name}_spool.jsonl")
+        self._insert_many = insert_many
+        self._insert_one = insert_one or (lambda row: insert_many([row]))
+        self._buf: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        atexit.register(self.close)
+
+    # -- scrittura ---------------------------------------------------------
+    def write(self, record: dict) -> None:
+        if self.mode == "sync":
+            self._write_rows([record])
+            return
+        overflow = []
+        with self._lock:
+            self._buf.append(record)
+            if len(self._buf) > self.max_pending:
+                overflow = [self._buf.popleft() for _ in range(self.batch_size)]
+            pending = len(self._buf)
+        if overflow:
+            self._spool(overflow)
+        if self.mode == "async":
+            self._ensure_thread()
+            if pending >= self.batch_size:
+                self._wake.set()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buf)
+
+    def flush(self) -> int:
+        """Svuota la coda (sincrono). Ritorna il numero di record processati."""
+        with self._flush_lock:
+            done, spooled = 0, False
+            while True:
+                with self._lock:
+                    batch = [self._buf.popleft() for _ in range(min(self.batch_size, len(self._buf)))]
+                if not batch:
+                    break
+                spooled = not self._write_rows(batch) or spooled
+                done += len(batch)
+            if not spooled:
+                self._replay_spool()
+            return done
+
+    def close(self, timeout: float = LOG_SINK_EXIT_TIMEOUT) -> None:
+        """Flush finale (a processo in chiusura) con timeout: non blocca lo shutdown."""
+        if not self.pending():
+            return
+        t = threading.Thread(target=self.flush, name=f"{self.name}-exit-flush", daemon=True)
+        t.start()
+        t.join(timeout)
+        if t.is_alive():
+            logging.warning(f"[log_sink] {self.name}: flush finale non completato ({self.pending()} in coda)")
+
+    # -- interni -------------------------------------------------------------
+    def _ensure_thread(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.warning(f"[log_sink] {self.name}: flush fallito: {ex}")
+
+    def _write_rows(self, rows: list) -> bool:
+        """Inserisce il blocco; su errore riga per riga, poi spool. True se tutto inserito."""
+        try:
+            self._insert_many(rows)
+            return True
+        except _TRANSPORT_EXC as ex:
+            logging.warning(f"[log_sink] {self.name}: insert di {len(rows)} righe fallito (rete): {ex}")
+            self._spool(rows)
+            return False
+        except Exception as ex:
+            logging.warning(f"[log_sink] {self.name}: insert di {len(rows)} righe fallito, riprovo singolarmente: {ex}")
+        failed = []
+        for row in rows:
+            try:
+                self._insert_one(row)
+            except Exception:
+                failed.append(row)
+        if failed:
+            self._spool(failed)
+        return not failed
+
+    def _spool(self, rows: list) -> None:
+        try:
+            while True:
+                fh = open(self.spool_path, "a", encoding="utf-8")
+                _lock_file(fh)
+                if _same_file(fh, self.spool_path):
+                    break
+                fh.close()  # rimosso da un replay mentre aspettavamo il lock: riapro
+            with fh:
+                for row in rows:
+                    fh.write(json.dumps(row, default=str, ensure_ascii=False) + "\n")
+            logging.warning(f"[log_sink] {self.name}: {len(rows)} righe salvate in {self.spool_path}")
+        except Exception as ex:
+            logging.error(f"[log_sink] {self.name}: spool fallito, righe perse: {rows} ({ex})")
+
+    def _replay_spool(self) -> None:
+        try:
+            fh = open(self.spool_path, encoding="utf-8")
+        except FileNotFoundError:
+            return
+        try:
+            with fh:
+                _lock_file(fh)
+                if not _same_file(fh, self.spool_path):
+                    return  # già preso da un altro worker
+                rows = [json.loads(line) for line in fh if line.strip()]
+                os.remove(self.spool_path)
+        except Exception as ex:
+            logging.warning(f"[log_sink] {self.name}: lettura spool fallita: {ex}")
+            return
+        for i in range(0, len(rows), self.batch_size):
+            self._write_rows(rows[i:i + self.batch_size])
+        if rows:
+            logging.info(f"[log_sink] {self.name}: reinserite {len(rows)} righe dallo spool")
@@ -0,0 +1,124 @@
+# app/common/spapi.py
+# -------------------------------------------------------------
+# Accesso condiviso a SP-API (Amazon Selling Partner API).
+#   - spapi_session: requests.Session con pool di connessioni (keep-alive verso
+#     api.amazon.com / sellingpartnerapi-eu), riusata da tutte le chiamate
+#   - token LWA in cache con la sua scadenza (expires_in): rinnovato in background
+#     SPAPI_TOKEN_REFRESH_AHEAD secondi prima della scadenza, in modo sincrono
+#     solo se assente o già scaduto. Un solo rinnovo alla volta tra i thread.
+#
+# NB: la cache vive nel processo, ogni worker ha il proprio token (sono validi in parallelo).
+# -------------------------------------------------------------
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SPAPI_TOKEN_URL = "https://api.amazon.com/auth/o2/token"
+SPAPI_TOKEN_REFRESH_AHEAD = float(os.getenv("SPAPI_TOKEN_REFRESH_AHEAD", "300"))
+SPAPI_POOL_SIZE = int(os.getenv("SPAPI_POOL_SIZE", "10"))
+SPAPI_TIMEOUT = 20
+
+
+def _make_session() -> requests.Session:
+    s = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=SPAPI_POOL_SIZE)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+spapi_session = _make_session()
+
+
+def _exchange_refresh_token() -> tuple:
+    """Scambio LWA refresh_token -> (access_token, expires_in secondi)."""
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": os.getenv("SPAPI_REFRESH_TOKEN"),
+        "client_id": os.getenv("SPAPI_CLIENT_ID"),
+        "client_secret": os.getenv("SPAPI_CLIENT_SECRET"),
+    }
+    resp = spapi_session.post(SPAPI_TOKEN_URL, data=data, timeout=SPAPI_TIMEOUT)
+    try:
+        resp.raise_for_status()
+    except Exception:
+        logging.error(f"[SPAPI] Token error: {resp.status_code} {resp.text}")
+        raise
+    j = resp.json()
+    if "access_token" not in j:
+        raise RuntimeError(f"[SPAPI] access_token mancante nella risposta: {j}")
+    return j["access_token"], float(j.get("expires_in") or 3600)
+
+
+class SpapiTokenCache:
+    """Access token LWA con scadenza, thread-safe, rinnovo anticipato in background."""
+
+    def __init__(self, fetch: Callable[[], tuple] = _exchange_refresh_token,
+                 refresh_ahead: float = SPAPI_TOKEN_REFRESH_AHEAD,
+                 clock: Callable[[], float] = time.monotonic):
+        self._fetch = fetch
+        self._refresh_ahead = refresh_ahead
+        self._clock = clock
+        self._lock = threading.Lock()          # protegge token/scadenza
+        self._refresh_lock = threading.Lock()  # un solo scambio LWA alla volta
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._bg: Optional[threading.Thread] = None
+
+    def get(self) -> str:
+        now = self._clock()
+        with self._lock:
+            token, expires_at = self._token, self._expires_at
+        if token and now < expires_at - self._refresh_ahead:
+            return token
+        if token and now < expires_at:
+            # ancora valido ma in scadenza: rinnovo in background, intanto uso questo
+            self._refresh_async()
+            return token
+        return self._refresh(force=False)
+
+    def invalidate(self) -> None:
+        """Da chiamare su 401/403 da SP-API: il prossimo get() rinnova."""
+        with self._lock:
+            self._token, self._expires_at = None, 0.0
+
+    # -- interni -------------------------------------------------------------
+    def _refresh(self, force: bool = True) -> str:
+        with self._refresh_lock:
+            # un altro thread potrebbe averlo appena rinnovato
+            with self._lock:
+                if not force and self._token and self._clock() < self._expires_at:
+                    return self._token
+            started = self._clock()
+            token, expires_in = self._fetch()
+            with self._lock:
+                self._token = token
+                self._expires_at = started + expires_in
+            return token
+
+    def _refresh_async(self) -> None:
+        with self._lock:
+            if self._bg is not None and self._bg.is_alive():
+                return
+
+            def _run():
+                try:
+                    self._refresh(force=True)
+                except Exception as ex:
+                    logging.warning(f"[SPAPI] rinnovo token in background fallito: {ex}")
+
+            self._bg = threading.Thread(target=_run, name="spapi-token-refresh", daemon=True)
+            self._bg.start()
+
+
+spapi_tokens = SpapiTokenCache()
+
+
+def get_spapi_access_token() -> str:
+    return spapi_tokens.get()
@@ -10,6 +10,9 @@ _RETRYABLE_EXC = (
     httpx.TransportError, httpx.RequestError,
 )
 
+# funzione / tabella non deployata
+_MISSING_CODES = ("PGRST202", "42883", "PGRST205", "42P01")
+
 def supa_with_retry(builder_fn, retries: int = 6, delay: float = 0.5, backoff: float = 2.0):
     last_ex = None
     cur_delay = delay
@@ -25,13 +28,19 @@ def supa_with_retry(builder_fn, retries: int = 6, delay: float = 0.5, backoff: f
 
         except APIError as ex:
             msg = getattr(ex, "args", [None])[0]
-            code = (msg.get("code") if isinstance(msg, dict) else None)
-            details = ((msg.get("details") or "") if isinstance(msg, dict) else "")
-            message = ((msg.get("message") or "") if isinstance(msg, dict) else "")
+            code = getattr(ex, "code", None) or (msg.get("code") if isinstance(msg, dict) else None)
+            details = getattr(ex, "details", None) or ((msg.get("details") or "") if isinstance(msg, dict) else "")
+            message = getattr(ex, "message", None) or ((msg.get("message") or "") if isinstance(msg, dict) else "")
 
             # NO retry su errori business (PL/pgSQL)
             if code == "P0001":  # 'Quantità oltre il disponibile' / 'Riga origine non trovata' ecc.
                 raise ex
+            # NO retry se la RPC/tabella non esiste (migrazione non applicata): il chiamante ripiega subito
+            if code in _MISSING_CODES:
+                raise ex
+            # NO retry su violazioni di vincoli (23xxx: FK, unique, not null...): fallirebbe uguale
+            if str(code or "").startswith("23"):
+                raise ex
 
             # SI retry su transient CF/edge o 409 JSON/5xx
             transient = (
@@ -64,3 +73,43 @@ def supa_with_retry(builder_fn, retries: int = 6, delay: float = 0.5, backoff: f
             cur_delay *= backoff
 
     raise last_ex
+
+
+def is_missing_rpc(ex: Exception) -> bool:
+    """
+    True se PostgREST segnala che la funzione RPC non esiste (PGRST202),
+    cioè la migrazione non è ancora stata applicata: il chiamante può
+    ripiegare sul percorso legacy lato Python.
+    """
+    msg = getattr(ex, "args", [None])[0]
+    if isinstance(msg, dict):
+        if msg.get("code") in ("PGRST202", "42883"):
+            return True
+        msg = msg.get("message") or ""
+    s = str(msg or ex)
+    return "PGRST202" in s or "Could not find the function" in s
+
+
+def is_missing_relation(ex: Exception) -> bool:
+    """
+    True se la tabella/vista interrogata non esiste ancora (PGRST205 / 42P01).
+    """
+    msg = getattr(ex, "args", [None])[0]
+    if isinstance(msg, dict):
+        if msg.get("code") in ("PGRST205", "42P01"):
+            return True
+        msg = msg.get("message") or ""
+    s = str(msg or ex)
+    return "PGRST205" in s or "42P01" in s or "Could not find the table" in s
+
+
+def is_lock_conflict(ex: Exception) -> bool:
+    """
+    True per deadlock / serializzazione / lock non ottenibile (40P01, 40001, 55P03):
+    la transazione è stata annullata per intero e si può rieseguire.
+    """
+    code = getattr(ex, "code", None)
+    if code is None:
+        msg = getattr(ex, "args", [None])[0]
+        code = msg.get("code") if isinstance(msg, dict) else None
+    return code in ("40P01", "40001", "55P03")
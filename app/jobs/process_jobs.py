@@ -4,6 +4,7 @@ Worker Supabase:
 - import_vendor_orders
 - genera_fattura_amazon_vendor
 - genera_notecredito_amazon_reso
+- sync_vendor_pos (ordini Vendor da SP-API, anche a intervalli: SPAPI_PO_SYNC_MINUTES)
 
 Compatibile con lo schema che mi hai incollato:
 - ordini_vendor_items.start_delivery è TEXT (salvo "YYYY-MM-DD" come stringa)
@@ -16,13 +17,16 @@ Compatibile con lo schema che mi hai incollato:
 
 import io
 import os
+import tempfile
 import time
 import traceback
 from collections import defaultdict
 from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, Optional
+from typing import Any, Dict, Iterable, Iterator, Optional
 
 import pandas as pd
+import requests
+from openpyxl import load_workbook
 from dotenv import load_dotenv
 from supabase import create_client
 import html
@@ -149,157 +153,236 @@ def genera_numero_nota_credito(supabase_client) -> str:
 # IMPORT VENDOR ORDERS
 # -----------------------
 
-def process_import_vendor_orders_job(job: Dict[str, Any]) -> None:
+VENDOR_ORDERS_SHEET = "Articoli"
+VENDOR_ORDERS_HEADER_ROW = 3      # il file Amazon ha intestazioni a partire dalla terza riga
+VENDOR_IMPORT_CHUNK = int(os.getenv("VENDOR_IMPORT_CHUNK", "300"))
+DOWNLOAD_CHUNK_BYTES = 1 << 20
+
+VENDOR_ORDERS_REQUIRED_COLUMNS = [
+    'Numero ordine/ordine d’acquisto',
+    'Codice identificativo esterno',
+    'Numero di modello',
+    'ASIN',
+    'Titolo',
+    'Costo',
+    'Quantità ordinata',
+    'Quantità confermata',
+    'Inizio consegna',
+    'Termine consegna',
+    'Data di consegna prevista',
+    'Stato disponibilità',
+    'Codice fornitore',
+    'Fulfillment Center'
+]
+
+
+def _norm_header(c: Any) -> str:
+    return str(c).strip().replace('\n', ' ').replace('\r', '').replace('  ', ' ')
+
+
+def download_to_tempfile(bucket: str, filename: str):
+    """
+    Scarica il file dallo storage su un file temporaneo, a blocchi (URL firmato):
+    il file non passa mai interamente in memoria. Fallback: download() classico.
+    """
+    fh = tempfile.TemporaryFile()
     try:
-        supabase.table("jobs").update({
-            "status": "in_progress",
-            "started_at": datetime.now(timezone.utc).isoformat()
-        }).eq("id", job["id"]).execute()
-
-        storage_path = job["payload"]["storage_path"]
-        bucket, filename = storage_path.split("/", 1)
-        print(f"[worker] Scarico file {storage_path} da storage...", flush=True)
+        signed = supabase.storage.from_(bucket).create_signed_url(filename, 600)
+        url = signed.get("signedURL") or signed.get("signedUrl")
+        if not url:
+            raise Exception(f"URL firmato mancante: {signed}")
+        with requests.get(url, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+                fh.write(chunk)
+    except Exception as ex:
+        print(f"[worker] download a blocchi non riuscito ({ex}), uso download()", flush=True)
+        fh.seek(0)
+        fh.truncate()
         file_resp = supabase.storage.from_(bucket).download(filename)
         if hasattr(file_resp, 'error') and file_resp.error:
             raise Exception(f"Errore download da storage: {file_resp.error}")
-        excel_bytes = file_resp
-
-        # Il file Amazon ha intestazioni a partire dalla terza riga
-        df = pd.read_excel(io.BytesIO(excel_bytes), header=2, sheet_name="Articoli")
-        df.columns = [str(c).strip().replace('\n', ' ').replace('\r', '').replace('  ', ' ') for c in df.columns]
-
-        required_columns = [
-            'Numero ordine/ordine d’acquisto',
-            'Codice identificativo esterno',
-            'Numero di modello',
-            'ASIN',
-            'Titolo',
-            'Costo',
-            'Quantità ordinata',
-            'Quantità confermata',
-            'Inizio consegna',
-            'Termine consegna',
-            'Data di consegna prevista',
-            'Stato disponibilità',
-            'Codice fornitore',
-            'Fulfillment Center'
-        ]
-        for col in required_columns:
-            if col not in df.columns:
-                raise Exception(f"Colonna mancante: {col}")
-
-        # Pre-carico chiavi esistenti per deduplicazione veloce
-        res = supabase.table("ordini_vendor_items").select(
-            "po_number,model_number,qty_ordered,start_delivery,fulfillment_center"
-        ).execute()
-        ordini_esistenti = res.data if hasattr(res, 'data') else res
-
-        def key_tuple(po: str, model: str, qty: int, start: Optional[str], fc: str):
-            return (
-                (po or "").strip(),
-                (model or "").strip(),
-                int(qty or 0),
-                fix_date(start) or "",
-                (fc or "").strip()
-            )
+        fh.write(file_resp)
+    fh.seek(0)
+    return fh
 
-        existing_keys = {
-            key_tuple(
-                o.get("po_number"),
-                o.get("model_number"),
-                o.get("qty_ordered"),
-                o.get("start_delivery"),
-                o.get("fulfillment_center"),
-            )
-            for o in (ordini_esistenti or [])
-        }
 
-        importati = 0
-        po_numbers = set()
-        errors: list[str] = []
-        doppioni: list[str] = []
+def iter_vendor_order_rows(fh, sheet: str = VENDOR_ORDERS_SHEET,
+                           header_row: int = VENDOR_ORDERS_HEADER_ROW) -> Iterator[Dict[str, Any]]:
+    """
+    Righe del foglio come dict {intestazione: valore}, una alla volta.
+    .xlsx: openpyxl read_only (memoria costante); .xls (non zip): pandas/xlrd come prima.
+    Solleva se manca una colonna obbligatoria (prima di produrre righe).
+    """
+    magic = fh.read(4)
+    fh.seek(0)
+    if magic != b"PK\x03\x04":
+        df = pd.read_excel(fh, header=header_row - 1, sheet_name=sheet)
+        df.columns = [_norm_header(c) for c in df.columns]
+        _check_columns(df.columns)
+        for rec in df.to_dict("records"):
+            yield rec
+        return
+
+    wb = load_workbook(fh, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet].iter_rows(min_row=header_row, values_only=True)
+        header = [_norm_header(c) if c is not None else "" for c in next(rows, ())]
+        _check_columns(header)
+        for values in rows:
+            if all(v is None or (isinstance(v, str) and not v.strip()) for v in values):
+                continue
+            yield dict(zip(header, values))
+    finally:
+        wb.close()
+
+
+def _check_columns(columns: Iterable[str]) -> None:
+    cols = set(columns)
+    for col in VENDOR_ORDERS_REQUIRED_COLUMNS:
+        if col not in cols:
+            raise Exception(f"Colonna mancante: {col}")
+
+
+def _chunked(it: Iterable[Any], n: int) -> Iterator[list]:
+    buf = []
+    for x in it:
+        buf.append(x)
+        if len(buf) >= n:
+            yield buf
+            buf = []
+    if buf:
+        yield buf
+
+
+def _vendor_key(po: Any, model: Any, qty: Any, start: Any, fc: Any) -> tuple:
+    return (
+        (po or "").strip(),
+        (model or "").strip(),
+        int(qty or 0),
+        fix_date(start) or "",
+        (fc or "").strip()
+    )
+
 
-        for _, row in df.iterrows():
+def _vendor_order_from_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "po_number": safe_str(row["Numero ordine/ordine d’acquisto"]),
+        "vendor_product_id": safe_str(row["Codice identificativo esterno"]),
+        "model_number": safe_str(row["Numero di modello"]),
+        "asin": safe_str(row["ASIN"]),
+        "title": safe_str(row["Titolo"]),
+        "cost": to_float(row["Costo"], None),  # numeric
+        "qty_ordered": safe_int(row["Quantità ordinata"], 0),
+        "qty_confirmed": safe_int(row["Quantità confermata"], 0),
+        # N.B. in ordini_vendor_items è TEXT
+        "start_delivery": fix_date(row["Inizio consegna"]),
+        "end_delivery": fix_date(row["Termine consegna"]),
+        "delivery_date": fix_date(row["Data di consegna prevista"]),
+        # metto sia status che availability, così non perdi nulla
+        "status": safe_str(row["Stato disponibilità"]),
+        "availability": safe_str(row["Stato disponibilità"]),
+        "vendor_code": safe_str(row["Codice fornitore"]),
+        "fulfillment_center": safe_str(row["Fulfillment Center"]),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _existing_vendor_keys(po_numbers: Iterable[str]) -> set:
+    """Chiavi già in tabella, solo per i PO del blocco (niente scansione dell'intera tabella)."""
+    pos = sorted({p for p in po_numbers if p})
+    if not pos:
+        return set()
+    res = supabase.table("ordini_vendor_items").select(
+        "po_number,model_number,qty_ordered,start_delivery,fulfillment_center"
+    ).in_("po_number", pos).execute()
+    return {
+        _vendor_key(o.get("po_number"), o.get("model_number"), o.get("qty_ordered"),
+                    o.get("start_delivery"), o.get("fulfillment_center"))
+        for o in (res.data or [])
+    }
+
+
+def _insert_vendor_orders(ordini: list, errors: list) -> list:
+    """Insert a blocco; se il blocco fallisce riprova riga per riga. Ritorna le righe inserite."""
+    if not ordini:
+        return []
+    try:
+        supabase.table("ordini_vendor_items").insert(ordini).execute()
+        return ordini
+    except Exception as ex:
+        print(f"[worker] insert di {len(ordini)} righe fallito, riprovo singolarmente: {ex}", flush=True)
+    ok = []
+    for o in ordini:
+        try:
+            supabase.table("ordini_vendor_items").insert(o).execute()
+            ok.append(o)
+        except Exception as ex:
+            errors.append(f"{ex}")
+    return ok
+
+
+def import_vendor_orders_stream(rows: Iterable[Dict[str, Any]],
+                                chunk_size: int = VENDOR_IMPORT_CHUNK) -> Dict[str, Any]:
+    """Dedup + insert a blocchi di chunk_size righe; in memoria resta un blocco alla volta."""
+    importati = 0
+    po_numbers = set()
+    gruppi = set()
+    errors: list[str] = []
+    doppioni: list[str] = []
+
+    for chunk in _chunked(rows, chunk_size):
+        seen = _existing_vendor_keys(safe_str(r.get('Numero ordine/ordine d’acquisto')) for r in chunk)
+        ordini = []
+        for row in chunk:
             try:
-                k = key_tuple(
+                k = _vendor_key(
                     safe_str(row['Numero ordine/ordine d’acquisto']),
                     safe_str(row['Numero di modello']),
                     safe_int(row['Quantità ordinata']),
                     fix_date(row['Inizio consegna']),
                     safe_str(row['Fulfillment Center']),
                 )
-                if k in existing_keys:
+                if k in seen:
                     doppioni.append(
                         f"Doppione: Ordine={row['Numero ordine/ordine d’acquisto']} | Modello={row['Numero di modello']} | Quantità={row['Quantità ordinata']}"
                     )
                     continue
-
-                ordine = {
-                    "po_number": safe_str(row["Numero ordine/ordine d’acquisto"]),
-                    "vendor_product_id": safe_str(row["Codice identificativo esterno"]),
-                    "model_number": safe_str(row["Numero di modello"]),
-                    "asin": safe_str(row["ASIN"]),
-                    "title": safe_str(row["Titolo"]),
-                    "cost": to_float(row["Costo"], None),  # numeric
-                    "qty_ordered": safe_int(row["Quantità ordinata"], 0),
-                    "qty_confirmed": safe_int(row["Quantità confermata"], 0),
-                    # N.B. in ordini_vendor_items è TEXT
-                    "start_delivery": fix_date(row["Inizio consegna"]),
-                    "end_delivery": fix_date(row["Termine consegna"]),
-                    "delivery_date": fix_date(row["Data di consegna prevista"]),
-                    # metto sia status che availability, così non perdi nulla
-                    "status": safe_str(row["Stato disponibilità"]),
-                    "availability": safe_str(row["Stato disponibilità"]),
-                    "vendor_code": safe_str(row["Codice fornitore"]),
-                    "fulfillment_center": safe_str(row["Fulfillment Center"]),
-                    "created_at": datetime.now(timezone.utc).isoformat(),
-                }
-
-                supabase.table("ordini_vendor_items").insert(ordine).execute()
-                existing_keys.add(k)
-                if ordine["po_number"]:
-                    po_numbers.add(ordine["po_number"])
-                importati += 1
-
+                ordini.append(_vendor_order_from_row(row))
+                seen.add(k)
             except Exception as ex:
                 errors.append(f"{ex}")
 
-        # --- RIEPILOGO: aggiorna sempre dopo import ---
-        ordini = supabase.table("ordini_vendor_items").select(
-            "po_number, qty_ordered, fulfillment_center, start_delivery"
-        ).execute().data
-
-        gruppi: Dict[tuple, Dict[str, Any]] = defaultdict(lambda: {"po_list": set(), "totale_articoli": 0})
-        for o in ordini:
-            key = (o["fulfillment_center"], fix_date(o["start_delivery"]))
-            gruppi[key]["po_list"].add(o["po_number"])
-            gruppi[key]["totale_articoli"] += safe_int(o["qty_ordered"])
-
-        for (fc, data), dati in gruppi.items():
-            riepilogo = {
-                "fulfillment_center": fc,
-                "start_delivery": data,  # la tabella è DATE: Postgres casterà la stringa ISO
-                "po_list": list(sorted(dati["po_list"])),
-                "totale_articoli": dati["totale_articoli"],
-                "stato_ordine": "nuovo",
-            }
-            res = supabase.table("ordini_vendor_riepilogo") \
-                .select("id") \
-                .eq("fulfillment_center", fc) \
-                .eq("start_delivery", data) \
-                .execute()
-            if res.data and len(res.data) > 0:
-                id_riep = res.data[0]['id']
-                supabase.table("ordini_vendor_riepilogo") \
-                    .update({
-                        "po_list": riepilogo["po_list"],
-                        "totale_articoli": riepilogo["totale_articoli"],
-                    }) \
-                    .eq("id", id_riep) \
-                    .execute()
-            else:
-                supabase.table("ordini_vendor_riepilogo").insert(riepilogo).execute()
+        for o in _insert_vendor_orders(ordini, errors):
+            if o["po_number"]:
+                po_numbers.add(o["po_number"])
+            gruppi.add((o["fulfillment_center"], o["start_delivery"]))
+            importati += 1
+
+    return {"importati": importati, "doppioni": doppioni, "po_numbers": po_numbers,
+            "gruppi": gruppi, "errors": errors}
+
+
+def process_import_vendor_orders_job(job: Dict[str, Any]) -> None:
+    try:
+        supabase.table("jobs").update({
+            "status": "in_progress",
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }).eq("id", job["id"]).execute()
+
+        storage_path = job["payload"]["storage_path"]
+        bucket, filename = storage_path.split("/", 1)
+        print(f"[worker] Scarico file {storage_path} da storage...", flush=True)
+
+        with download_to_tempfile(bucket, filename) as fh:
+            esito = import_vendor_orders_stream(iter_vendor_order_rows(fh))
 
+        # --- RIEPILOGO: aggiorna i gruppi (FC, data) toccati dall'import ---
+        # import locale: come per il sync SP-API
+        from app.jobs.vendor_po_sync import aggiorna_riepiloghi
+        aggiorna_riepiloghi(supabase, esito["gruppi"])
+
+        importati, doppioni, po_numbers = esito["importati"], esito["doppioni"], esito["po_numbers"]
         supabase.table("jobs").update({
             "status": "done",
             "result": {
@@ -307,7 +390,7 @@ def process_import_vendor_orders_job(job: Dict[str, Any]) -> None:
                 "doppioni": doppioni,
                 "po_unici": len(po_numbers),
                 "po_list": list(sorted(po_numbers)),
-                "errors": errors,
+                "errors": esito["errors"],
             },
             "finished_at": datetime.now(timezone.utc).isoformat()
         }).eq("id", job["id"]).execute()
@@ -323,6 +406,49 @@ def process_import_vendor_orders_job(job: Dict[str, Any]) -> None:
             "finished_at": datetime.now(timezone.utc).isoformat()
         }).eq("id", job["id"]).execute()
 
+# -----------------------
+# SYNC ORDINI VENDOR DA SP-API
+# -----------------------
+
+SPAPI_PO_SYNC_MINUTES = float(os.getenv("SPAPI_PO_SYNC_MINUTES", "0") or 0)   # 0 = solo su job
+
+
+def _run_vendor_po_sync() -> Dict[str, Any]:
+    # import locale: il worker resta avviabile anche senza le dipendenze SP-API
+    from requests_aws4auth import AWS4Auth
+    from app.common.spapi import get_spapi_access_token, spapi_session
+    from app.jobs.vendor_po_sync import sync_vendor_purchase_orders
+
+    auth = None
+    if os.getenv("AWS_ACCESS_KEY") and os.getenv("AWS_SECRET_KEY"):
+        auth = AWS4Auth(os.getenv("AWS_ACCESS_KEY"), os.getenv("AWS_SECRET_KEY"),
+                        'eu-west-1', 'execute-api', session_token=os.getenv("AWS_SESSION_TOKEN"))
+    return sync_vendor_purchase_orders(supabase, get_spapi_access_token, spapi_session, auth=auth)
+
+
+def process_sync_vendor_pos_job(job: Dict[str, Any]) -> None:
+    try:
+        supabase.table("jobs").update({
+            "status": "in_progress",
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }).eq("id", job["id"]).execute()
+
+        result = _run_vendor_po_sync()
+
+        supabase.table("jobs").update({
+            "status": "done",
+            "result": result,
+            "finished_at": datetime.now(timezone.utc).isoformat()
+        }).eq("id", job["id"]).execute()
+    except Exception as e:
+        print("[worker] ERRORE sync ordini SP-API!", e, flush=True)
+        supabase.table("jobs").update({
+            "status": "failed",
+            "error": str(e),
+            "stacktrace": traceback.format_exc(),
+            "finished_at": datetime.now(timezone.utc).isoformat()
+        }).eq("id", job["id"]).execute()
+
 # -----------------------
 # FATTURE
 # -----------------------
@@ -1285,8 +1411,17 @@ def main_loop():
     print("WORKER AVVIATO - SONO IL VERO WORKER!", flush=True)
     sleep_s = 5          # parte reattivo
     MAX_SLEEP = 120       # massimo 120s a vuoto
+    next_po_sync = time.monotonic()
     while True:
         try:
+            # 0) sync periodico ordini Vendor da SP-API (se abilitato)
+            if SPAPI_PO_SYNC_MINUTES > 0 and time.monotonic() >= next_po_sync:
+                next_po_sync = time.monotonic() + SPAPI_PO_SYNC_MINUTES * 60
+                try:
+                    _run_vendor_po_sync()
+                except Exception as sync_err:
+                    print("[worker] ERRORE sync periodico SP-API:", sync_err, flush=True)
+
             # 1) Check leggero: HEAD con count per evitare di scaricare righe
             head = supabase.table("jobs") \
                 .select("id", count="exact", head=True) \
@@ -1321,6 +1456,8 @@ def main_loop():
                     process_genera_notecredito_amazon_reso_job(job)
                 elif jtype == "genera_nota_credito_da_fattura":
                     process_genera_nota_credito_da_fattura_job(job)
+                elif jtype == "sync_vendor_pos":
+                    process_sync_vendor_pos_job(job)
                 else:
                     print(f"[worker] Tipo job non gestito: {jtype}", flush=True)
 
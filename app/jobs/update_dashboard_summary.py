@@ -24,6 +24,11 @@ def update_dashboard_summary():
         return
 
     riepilogo_ids = [r.get("id") or r.get("riepilogo_id") for r in riepiloghi]
+    # WIP salvati a delta: ricostruisce dati dalle righe prima di leggerlo
+    try:
+        supabase.rpc("parziali_wip_materializza", {"p_riepilogo_ids": riepilogo_ids}).execute()
+    except Exception as ex:
+        print(f"[dashboard] ricostruzione dati WIP non disponibile: {ex}")
     parziali = supabase.table("ordini_vendor_parziali") \
         .select("riepilogo_id,numero_parziale,dati,conferma_collo") \
         .in_("riepilogo_id", riepilogo_ids) \
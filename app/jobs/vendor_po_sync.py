@@ -0,0 +1,300 @@
+# app/jobs/vendor_po_sync.py
+# -------------------------------------------------------------
+# Ingestione ordini Amazon Vendor da SP-API (vendor/orders/v1/purchaseOrders),
+# alternativa all'upload Excel (import_vendor_orders).
+#
+#   - pagina con nextToken sui PO cambiati dopo il watermark (changedAfter)
+#   - mappa ogni riga PO su ordini_vendor_items, chiave po_item_key = '<po>#<itemSequenceNumber>'
+#   - righe nuove inserite a blocchi (EAN dal catalogo prodotti); sulle righe già presenti,
+#     comprese quelle importate da Excel (po_item_key NULL, "adottate" per
+#     po_number/model_number/fulfillment_center), si aggiornano solo qty e finestra di consegna
+#   - riepilogo aggiornato solo per i gruppi (fulfillment_center, start_delivery) toccati
+#   - watermark salvato in spapi_sync_state solo a run completato
+#
+# Eseguito dal worker (process_jobs.main_loop) come job 'sync_vendor_pos' e ogni
+# SPAPI_PO_SYNC_MINUTES minuti. L'endpoint SP-API è configurabile (SPAPI_ENDPOINT)
+# per puntare a uno stand-in HTTP locale.
+# -------------------------------------------------------------
+
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+SPAPI_ENDPOINT = os.getenv("SPAPI_ENDPOINT", "https://sellingpartnerapi-eu.amazon.com")
+PO_PATH = "/vendor/orders/v1/purchaseOrders"
+PO_SYNC_NAME = "vendor_purchase_orders"
+PO_SYNC_INITIAL_DAYS = int(os.getenv("SPAPI_PO_INITIAL_DAYS", "7"))
+PO_SYNC_OVERLAP = timedelta(minutes=5)   # margine contro ritardi di indicizzazione lato Amazon
+PO_PAGE_LIMIT = 100
+PO_UPSERT_BATCH = 200
+PO_HTTP_RETRIES = 4
+
+
+def _iso(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _parse_ts(v: Any) -> Optional[datetime]:
+    if not v:
+        return None
+    try:
+        return datetime.fromisoformat(str(v).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _day(v: Any) -> Optional[str]:
+    s = str(v or "").strip()
+    return s[:10] if len(s) >= 10 else None
+
+
+# -----------------------
+# SP-API
+# -----------------------
+
+def fetch_purchase_orders(changed_after: datetime, changed_before: datetime,
+                          get_token: Callable[[], str], session,
+                          endpoint: str = SPAPI_ENDPOINT, auth=None) -> Iterator[dict]:
+    """PO cambiati nella finestra, pagina per pagina (nextToken). 429/5xx: attesa e riprova."""
+    params: Dict[str, Any] = {
+        "changedAfter": _iso(changed_after),
+        "changedBefore": _iso(changed_before),
+        "limit": PO_PAGE_LIMIT,
+        "sortOrder": "ASC",
+    }
+    url = endpoint.rstrip("/") + PO_PATH
+    while True:
+        for attempt in range(1, PO_HTTP_RETRIES + 1):
+            resp = session.get(url, params=params, auth=auth, timeout=30, headers={
+                "x-amz-access-token": get_token(),
+                "Content-Type": "application/json",
+            })
+            if resp.status_code == 429 or resp.status_code >= 500:
+                if attempt == PO_HTTP_RETRIES:
+                    resp.raise_for_status()
+                time.sleep(float(resp.headers.get("Retry-After") or attempt))
+                continue
+            resp.raise_for_status()
+            break
+        payload = (resp.json() or {}).get("payload") or {}
+        yield from payload.get("orders") or []
+        next_token = (payload.get("pagination") or {}).get("nextToken")
+        if not next_token:
+            return
+        params["nextToken"] = next_token
+
+
+def po_to_rows(po: dict) -> list:
+    """Un PO SP-API -> righe ordini_vendor_items (stessi campi dell'import Excel)."""
+    po_number = (po.get("purchaseOrderNumber") or "").strip()
+    det = po.get("orderDetails") or {}
+    start, _, end = str(det.get("deliveryWindow") or "").partition("--")
+    fc = ((det.get("shipToParty") or {}).get("partyId") or "").strip() or None
+    vendor_code = (det.get("sellingParty") or {}).get("partyId")
+    changed_at = det.get("purchaseOrderChangedDate") or det.get("purchaseOrderDate")
+
+    rows = []
+    for it in det.get("items") or []:
+        seq = str(it.get("itemSequenceNumber") or "").strip()
+        if not po_number or not seq:
+            continue
+        oq = it.get("orderedQuantity") or {}
+        qty = int(oq.get("amount") or 0)
+        if (oq.get("unitOfMeasure") or "").lower() == "cases":
+            qty *= int(oq.get("unitSize") or 1)
+        cost = (it.get("netCost") or {}).get("amount")
+        # vendorProductIdentifier è lo SKU del fornitore (= "Numero di modello" dell'Excel).
+        # vendor_product_id resta l'EAN: lo valorizza upsert_items dal catalogo prodotti.
+        rows.append({
+            "po_item_key": f"{po_number}#{seq}",
+            "po_number": po_number,
+            "model_number": it.get("vendorProductIdentifier"),
+            "asin": it.get("amazonProductIdentifier"),
+            "cost": float(cost) if cost not in (None, "") else None,
+            "qty_ordered": qty,
+            "start_delivery": _day(start),
+            "end_delivery": _day(end),
+            "vendor_code": vendor_code,
+            "fulfillment_center": fc,
+            "po_changed_at": changed_at,
+            "created_at": det.get("purchaseOrderDate") or changed_at,
+        })
+    return rows
+
+
+# -----------------------
+# DB
+# -----------------------
+
+# colonne che SP-API aggiorna sulle righe già presenti (anche quelle nate da Excel);
+# EAN, titolo, disponibilità, created_at ecc. restano di chi ha creato la riga
+PO_SYNC_OWNED = ("po_item_key", "qty_ordered", "po_changed_at", "start_delivery", "end_delivery")
+
+
+def _existing_ids(sb, rows: list) -> Dict[str, dict]:
+    """po_item_key -> {id, fulfillment_center, start_delivery} per le righe già sincronizzate in passato."""
+    keys = [r["po_item_key"] for r in rows]
+    found = sb.table("ordini_vendor_items") \
+        .select("id, po_item_key, fulfillment_center, start_delivery") \
+        .in_("po_item_key", keys) \
+        .execute().data or []
+    return {r["po_item_key"]: r for r in found}
+
+
+def _adopt_excel_rows(sb, rows: list) -> Dict[str, dict]:
+    """Righe Excel (po_item_key NULL) dello stesso PO/modello/FC: po_item_key -> riga da adottare."""
+    pos = sorted({r["po_number"] for r in rows})
+    if not pos:
+        return {}
+    legacy = sb.table("ordini_vendor_items") \
+        .select("id, po_number, model_number, fulfillment_center, start_delivery") \
+        .in_("po_number", pos) \
+        .is_("po_item_key", "null") \
+        .execute().data or []
+    free = defaultdict(list)
+    for r in legacy:
+        free[(r.get("po_number"), (r.get("model_number") or "").strip(),
+              (r.get("fulfillment_center") or "").strip())].append(r)
+    adopted = {}
+    for r in rows:
+        ids = free.get((r["po_number"], (r.get("model_number") or "").strip(),
+                        (r.get("fulfillment_center") or "").strip()))
+        if ids:
+            adopted[r["po_item_key"]] = ids.pop(0)
+    return adopted
+
+
+def _ean_per_modello(sb, rows: list) -> Dict[str, str]:
+    """EAN dal catalogo prodotti (products.sku = model_number), per le righe nuove."""
+    skus = sorted({r["model_number"] for r in rows if r.get("model_number")})
+    if not skus:
+        return {}
+    found = sb.table("products").select("sku, ean").in_("sku", skus).execute().data or []
+    return {p["sku"]: p["ean"] for p in found if p.get("ean")}
+
+
+def upsert_items(sb, rows: list) -> Dict[str, Any]:
+    """
+    Righe già presenti (sync precedenti o Excel adottate): update delle sole PO_SYNC_OWNED.
+    Righe nuove: insert a blocco, con l'EAN preso dal catalogo.
+    "gruppi_precedenti": (fulfillment_center, start_delivery) che le righe aggiornate
+    avevano prima dell'update, da ricalcolare anche se la data è cambiata.
+    """
+    out = {"inserted": 0, "updated": 0, "adopted": 0, "gruppi_precedenti": set()}
+    for i in range(0, len(rows), PO_UPSERT_BATCH):
+        batch = rows[i:i + PO_UPSERT_BATCH]
+        ids = _existing_ids(sb, batch)
+        adopted = _adopt_excel_rows(sb, [r for r in batch if r["po_item_key"] not in ids])
+        out["adopted"] += len(adopted)
+        ids.update(adopted)
+
+        nuove = [r for r in batch if r["po_item_key"] not in ids]
+        for r in batch:
+            old = ids.get(r["po_item_key"])
+            if old:
+                sb.table("ordini_vendor_items") \
+                    .update({k: r.get(k) for k in PO_SYNC_OWNED}) \
+                    .eq("id", old["id"]) \
+                    .execute()
+                out["gruppi_precedenti"].add((old.get("fulfillment_center"), old.get("start_delivery")))
+                out["updated"] += 1
+        if nuove:
+            ean = _ean_per_modello(sb, nuove)
+            sb.table("ordini_vendor_items").insert([
+                {**r, "vendor_product_id": ean.get(r.get("model_number"))} for r in nuove
+            ]).execute()
+            out["inserted"] += len(nuove)
+    return out
+
+
+def aggiorna_riepiloghi(sb, gruppi: Iterable[tuple]) -> int:
+    """Ricalcola po_list/totale_articoli solo per i gruppi (fulfillment_center, start_delivery) indicati."""
+    n = 0
+    for fc, data in sorted(set(gruppi), key=lambda g: (g[0] or "", g[1] or "")):
+        if not fc or not data:
+            continue
+        items = sb.table("ordini_vendor_items") \
+            .select("po_number, qty_ordered") \
+            .eq("fulfillment_center", fc) \
+            .eq("start_delivery", data) \
+            .execute().data or []
+        po_list = sorted({o["po_number"] for o in items if o.get("po_number")})
+        totale = sum(int(o.get("qty_ordered") or 0) for o in items)
+        res = sb.table("ordini_vendor_riepilogo") \
+            .select("id") \
+            .eq("fulfillment_center", fc) \
+            .eq("start_delivery", data) \
+            .execute()
+        if res.data:
+            sb.table("ordini_vendor_riepilogo") \
+                .update({"po_list": po_list, "totale_articoli": totale}) \
+                .eq("id", res.data[0]["id"]) \
+                .execute()
+        else:
+            sb.table("ordini_vendor_riepilogo").insert({
+                "fulfillment_center": fc,
+                "start_delivery": data,
+                "po_list": po_list,
+                "totale_articoli": totale,
+                "stato_ordine": "nuovo",
+            }).execute()
+        n += 1
+    return n
+
+
+def _read_watermark(sb) -> Optional[datetime]:
+    rows = sb.table("spapi_sync_state").select("watermark") \
+        .eq("name", PO_SYNC_NAME).limit(1).execute().data or []
+    return _parse_ts(rows[0].get("watermark")) if rows else None
+
+
+def _write_watermark(sb, watermark: datetime, result: dict) -> None:
+    sb.table("spapi_sync_state").upsert({
+        "name": PO_SYNC_NAME,
+        "watermark": watermark.isoformat(),
+        "last_result": result,
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }, on_conflict="name").execute()
+
+
+# -----------------------
+# Run
+# -----------------------
+
+def sync_vendor_purchase_orders(sb, get_token: Callable[[], str], session,
+                                endpoint: str = SPAPI_ENDPOINT, auth=None,
+                                now: Optional[datetime] = None) -> dict:
+    """
+    Un giro incrementale: PO cambiati da (watermark - overlap) a now.
+    Il watermark avanza solo se tutto il giro va a buon fine (altrimenti il
+    prossimo run riprende dalla stessa finestra; l'upsert rende il replay innocuo).
+    """
+    now = now or datetime.now(timezone.utc)
+    wm = _read_watermark(sb)
+    since = (wm - PO_SYNC_OVERLAP) if wm else now - timedelta(days=PO_SYNC_INITIAL_DAYS)
+
+    po_numbers, rows = set(), {}
+    for po in fetch_purchase_orders(since, now, get_token, session, endpoint=endpoint, auth=auth):
+        for r in po_to_rows(po):
+            rows[r["po_item_key"]] = r   # la stessa riga su più pagine: vince l'ultima
+            po_numbers.add(r["po_number"])
+
+    righe = list(rows.values())
+    stats = upsert_items(sb, righe)
+    gruppi = {(r["fulfillment_center"], r["start_delivery"]) for r in righe} | stats["gruppi_precedenti"]
+    riepiloghi = aggiorna_riepiloghi(sb, gruppi)
+
+    result = {
+        "since": since.isoformat(),
+        "until": now.isoformat(),
+        "po": len(po_numbers),
+        "righe": len(righe),
+        "adottate": stats["adopted"],
+        "riepiloghi": riepiloghi,
+        "po_list": sorted(po_numbers),
+    }
+    _write_watermark(sb, now, {k: v for k, v in result.items() if k != "po_list"})
+    print(f"[vendor_po_sync] {len(po_numbers)} PO, {len(righe)} righe, {riepiloghi} riepiloghi", flush=True)
+    return result
@@ -1,5 +1,8 @@
 # repositories/prelievo_repo.py
-from app.supabase import sb_table, supa_with_retry
+import logging
+
+from app.supabase import sb_table, supa_with_retry, supabase
+from app.common.supa_retry import is_missing_rpc
 
 
 def sel_date_importabili():
@@ -28,6 +31,42 @@ def sel_prelievi(data: str | None = None, radice: str | None = None, ids: list[i
     res = supa_with_retry(lambda: q.order("id").execute())
     return res.data or []
 
+# Colonne esponibili nella proiezione (?fields=...) della lista paginata
+PRELIEVO_FIELDS = (
+    "id", "sku", "ean", "qty", "radice", "start_delivery", "centri", "stato",
+    "riscontro", "plus", "note", "canale", "magazzino_usato", "mag_usato_by_canale",
+    "cavallotti",
+)
+
+def sel_prelievi_pagina(data: str | None = None, radice: str | None = None,
+                        stati: list[str] | None = None, canale: str | None = None,
+                        fields: list[str] | None = None, after_id: int | None = None,
+                        limit: int = 200) -> tuple[list[dict], int | None]:
+    """
+    Lista prelievi con paginazione keyset su id (indice start_delivery,id).
+    Ritorna (righe, next_cursor): next_cursor è l'id da passare come after_id
+    per la pagina successiva, None se non ci sono altre righe.
+    """
+    cols = list(dict.fromkeys(["id", *(fields or [])])) if fields else ["*"]
+    q = sb_table("prelievi_ordini_amazon").select(",".join(cols))
+    if data:
+        q = q.eq("start_delivery", data)
+    if radice:
+        q = q.eq("radice", radice)
+    if stati:
+        q = q.in_("stato", stati)
+    if canale:
+        q = q.eq("canale", canale)
+    if after_id is not None:
+        q = q.gt("id", after_id)
+    # una riga in più per sapere se esiste la pagina successiva
+    res = supa_with_retry(lambda: q.order("id").limit(limit + 1).execute())
+    rows = res.data or []
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, int(rows[-1]["id"])
+    return rows, None
+
 def upd_prelievo(pid:int, fields:dict):
     supa_with_retry(lambda: sb_table("prelievi_ordini_amazon").update(fields).eq("id", pid).execute())
 
@@ -44,20 +83,46 @@ def import_da_ordini(data: str) -> dict:
     """
     Importa i prelievi a partire dagli ordini Vendor "nuovi" della data indicata.
     Ritorna un piccolo report {ok, importati, totali, errors}.
+
+    Percorso principale: RPC `prelievi_import_da_ordini`, che aggrega lato DB
+    (vista v_prelievi_import_aggregati) e sostituisce i prelievi della data in
+    un'unica transazione. Se la funzione non è ancora deployata si ripiega sul
+    calcolo lato Python.
     """
     if not data:
         return {"ok": False, "error": "Data richiesta", "importati": 0, "totali": 0, "errors": []}
 
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("prelievi_import_da_ordini", {"p_data": data}).execute())
+        report = res.data
+        if isinstance(report, list):
+            report = report[0] if report else {}
+        report = report or {}
+        return {
+            "ok": bool(report.get("ok", True)),
+            "importati": int(report.get("importati") or 0),
+            "totali": int(report.get("totali") or 0),
+            "errors": report.get("errors") or [],
+        }
+    except Exception as ex:
+        if not is_missing_rpc(ex):
+            raise
+        logging.warning("[import_da_ordini] RPC prelievi_import_da_ordini assente, fallback Python: %s", ex)
+
+    return _import_da_ordini_py(data)
+
+
+def _import_da_ordini_py(data: str) -> dict:
+    """
+    Fallback lato Python di import_da_ordini (stessa semantica, non atomico).
+    """
     # 1) pulisco eventuali prelievi di quella data
-    supa_with_retry(lambda: sb_table("prelievi_ordini_amazon")
-                    .delete()
-                    .eq("start_delivery", data)
-                    .execute())
+    del_prelievi(data)
 
-    # 2) leggo items e riepiloghi "nuovi" della data
+    # 2) leggo items e riepiloghi "nuovi" della data (solo le colonne che servono)
     items_res = supa_with_retry(lambda: (
         sb_table("ordini_vendor_items")
-        .select("*")
+        .select("model_number,vendor_product_id,qty_ordered,fulfillment_center,start_delivery")
         .eq("start_delivery", data)
         .execute()
     ))
@@ -1,6 +1,7 @@
 from flask import Blueprint, jsonify, request, Response
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 from io import BytesIO
 import os
@@ -9,9 +10,12 @@ import math
 import time
 import uuid
 import logging
-import requests
 from fpdf.enums import XPos, YPos  # <-- necessario per il jitter nel retry
-from app.common.supa_retry import supa_with_retry
+from app.common.supa_retry import supa_with_retry, is_missing_rpc, is_missing_relation, is_lock_conflict
+from app.common.events import broker, publish, sse_response
+from app.common.log_sink import BufferedLogSink
+from app.common.spapi import get_spapi_access_token, spapi_session, spapi_tokens
+from app.services.catalog_index import catalogo, exact_score, split_query
 from postgrest.exceptions import APIError
 
 from requests_aws4auth import AWS4Auth
@@ -129,6 +133,34 @@ def enqueue_job(job_type: str, payload: dict) -> None:
 
 
 def _retarget_qty_to_date(src_id: int, new_start_delivery: str, qty: int, user_label: str) -> Optional[int]:
+    """
+    Sposta 'qty' della riga produzione src_id sulla data new_start_delivery e ritorna
+    l'id della riga target. Atomico lato DB (RPC retarget_qty_rpc, lock sulla sorgente);
+    se la RPC non è deployata usa il percorso Python.
+    """
+    if qty <= 0:
+        return None
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("retarget_qty_rpc", {
+            "p_src_id": int(src_id),
+            "p_new_date": str(new_start_delivery)[:10],
+            "p_qty": int(qty),
+            "p_user_label": user_label,
+        }).execute())
+    except APIError as ex:
+        if not is_missing_rpc(ex):
+            raise
+        logging.warning("[retarget_qty] RPC retarget_qty_rpc assente, fallback legacy: %s", ex)
+        return _retarget_qty_to_date_legacy(src_id, new_start_delivery, qty, user_label)
+    data = res.data
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if isinstance(data, dict):
+        data = next(iter(data.values()), None)
+    return int(data) if data else None
+
+
+def _retarget_qty_to_date_legacy(src_id: int, new_start_delivery: str, qty: int, user_label: str) -> Optional[int]:
     if qty <= 0:
         return None
 
@@ -190,7 +222,7 @@ def _retarget_qty_to_date(src_id: int, new_start_delivery: str, qty: int, user_l
                 motivo = f"Creazione {st} (retarget)"
                 log_movimento_produzione(
                     irow,
-                    utente=_current_user_label(),
+                    utente=user_label,
                     motivo=motivo,
                     stato_vecchio=None,
                     stato_nuovo=st,
@@ -255,26 +287,6 @@ def _reserved_open(prelievo_id: int) -> int:
 # -----------------------------------------------------------------------------
 # Utilità varie
 # -----------------------------------------------------------------------------
-def get_spapi_access_token():
-    url = "https://api.amazon.com/auth/o2/token"
-    data = {
-        "grant_type": "refresh_token",
-        "refresh_token": os.getenv("SPAPI_REFRESH_TOKEN"),
-        "client_id": os.getenv("SPAPI_CLIENT_ID"),
-        "client_secret": os.getenv("SPAPI_CLIENT_SECRET"),
-    }
-    resp = requests.post(url, data=data, timeout=20)
-    try:
-        resp.raise_for_status()
-    except Exception as e:
-        logging.error(f"[SPAPI] Token error: {resp.status_code} {resp.text}")
-        raise
-    j = resp.json()
-    if "access_token" not in j:
-        raise RuntimeError(f"[SPAPI] access_token mancante nella risposta: {j}")
-    return j["access_token"]
-
-
 def safe_value(v):
     if isinstance(v, float) and (math.isnan(v) or math.isinf(v)):
         return None
@@ -354,6 +366,11 @@ def search_products():
         q = (request.args.get("q") or "").strip()
         limit = min(int(request.args.get("limit", 20)), 50)
 
+        # indice in memoria (n-grammi); None finché non è caricato -> DB
+        hits = catalogo.search(q, limit)
+        if hits is not None:
+            return jsonify(hits)
+
         base = sb_table("products").select(
             "id, sku, ean, variant_title, product_title, image_url, price"
         )
@@ -362,17 +379,12 @@ def search_products():
             res = supa_with_retry(lambda: base.order("updated_at", desc=True).limit(limit).execute())
             return jsonify(res.data or [])
 
-        tokens = [t for t in q.split() if t]
-        exact_tokens = [t[:-1] for t in tokens if t.endswith(';')]
-        fuzzy_tokens = [t for t in tokens if not t.endswith(';')]
+        fuzzy_tokens, exact_tokens = split_query(q)
 
         query = base
 
-        for tok in fuzzy_tokens:
-            # 🔧 SANITIZZA: togli % e virgole (che rompono l'or=...)
-            t = (tok or "").replace("%", "").replace(",", " ").strip()
-            if not t:
-                continue
+        for t in fuzzy_tokens:
+            # token già sanitizzati (niente % e virgole, che rompono l'or=...)
             star = f"*{t}*"
             query = query.or_(
                 f"sku.ilike.{star},ean.ilike.{star},variant_title.ilike.{star},product_title.ilike.{star}"
@@ -381,16 +393,7 @@ def search_products():
         rows = supa_with_retry(lambda: query.limit(limit).execute()).data or []
 
         # ordina con "preferenza" per match esatti (token con ';')
-        def score(r):
-            s = (r.get("sku") or "").upper()
-            exact_hit = any(
-                (not et.isdigit() and et.upper() in s.split('-')) or
-                (et.isdigit() and (r.get("ean") or "") == et)
-                for et in exact_tokens
-            )
-            return (0 if exact_hit else 1, len(s), s)
-
-        rows.sort(key=score)
+        rows.sort(key=lambda r: exact_score(r, exact_tokens))
         return jsonify(rows)
     except Exception as ex:
         logging.exception("[search_products] Errore")
@@ -398,52 +401,113 @@ def search_products():
 
 
 # -----------------------------------------------------------------------------
-# Riepilogo ordini Sito per SKU (esclude annullati)
+# Riepilogo ordini Sito per SKU (solo ordini inevasi)
 # -----------------------------------------------------------------------------
-@bp.route('/api/orders/site/sku-summary', methods=['GET'])
-def site_orders_sku_summary():
-    sku = (request.args.get("sku") or "").strip()
-    if not sku:
-        return jsonify({"orders_count": 0, "total_qty": 0})
-    try:
-        # prendo solo ordini INEVASI (non annullati, non evasi)
-        orders = supa_with_retry(lambda: (
-            sb_table("orders")
-                .select("id, fulfillment_status")
-                .eq("fulfillment_status", "inevaso")   # <<< CAMBIATO QUI
-                .execute()
-        )).data or []
-        if not orders:
-            return jsonify({"orders_count": 0, "total_qty": 0})
+SITE_SUMMARY_MAX_SKUS = 500
+SITE_SUMMARY_CHUNK = 200
 
-        order_ids = [o["id"] for o in orders if o.get("id")]
-        if not order_ids:
-            return jsonify({"orders_count": 0, "total_qty": 0})
 
-        items = supa_with_retry(lambda: (
+def _site_orders_summary_legacy(skus: list) -> dict:
+    """
+    Fallback senza RPC: parte dalle righe degli SKU richiesti (non da tutti gli
+    ordini inevasi) e filtra gli ordini a blocchi, così il payload non cresce con l'arretrato.
+    """
+    items = []
+    for i in range(0, len(skus), SITE_SUMMARY_CHUNK):
+        chunk = skus[i:i + SITE_SUMMARY_CHUNK]
+        items += supa_with_retry(lambda: (
             sb_table("order_items")
                 .select("order_id, quantity, sku")
-                .in_("order_id", order_ids)
-                .eq("sku", sku)
+                .in_("sku", chunk)
                 .execute()
         )).data or []
 
-        total_qty = 0
-        orders_set = set()
-        for it in items:
-            try:
-                total_qty += int(it.get("quantity") or 0)
-                if it.get("order_id"):
-                    orders_set.add(it["order_id"])
-            except Exception:
-                pass
+    order_ids = sorted({it["order_id"] for it in items if it.get("order_id")})
+    inevasi = set()
+    for i in range(0, len(order_ids), SITE_SUMMARY_CHUNK):
+        chunk = order_ids[i:i + SITE_SUMMARY_CHUNK]
+        rows = supa_with_retry(lambda: (
+            sb_table("orders")
+                .select("id")
+                .in_("id", chunk)
+                .eq("fulfillment_status", "inevaso")
+                .execute()
+        )).data or []
+        inevasi.update(r["id"] for r in rows if r.get("id"))
+
+    out = {}
+    for it in items:
+        if it.get("order_id") not in inevasi:
+            continue
+        acc = out.setdefault(it.get("sku"), {"orders": set(), "total_qty": 0})
+        try:
+            acc["total_qty"] += int(it.get("quantity") or 0)
+        except Exception:
+            pass
+        acc["orders"].add(it["order_id"])
+    return {k: {"orders_count": len(v["orders"]), "total_qty": v["total_qty"]} for k, v in out.items()}
+
+
+def _site_orders_summary(skus: list) -> dict:
+    """
+    {sku: {orders_count, total_qty}} sugli ordini Sito inevasi, via RPC
+    site_orders_sku_summary (aggregata nel DB). SKU senza ordini -> 0/0.
+    """
+    skus = list(dict.fromkeys(s for s in skus if s))
+    if not skus:
+        return {}
+    try:
+        rows = supa_with_retry(lambda: supabase.rpc(
+            "site_orders_sku_summary", {"p_skus": skus}
+        ).execute()).data or []
+        found = {
+            r.get("sku"): {"orders_count": int(r.get("orders_count") or 0),
+                           "total_qty": int(r.get("total_qty") or 0)}
+            for r in rows
+        }
+    except APIError as ex:
+        if not is_missing_rpc(ex):
+            raise
+        logging.warning("[site_orders_sku_summary] RPC assente, fallback legacy: %s", ex)
+        found = _site_orders_summary_legacy(skus)
+    return {s: found.get(s, {"orders_count": 0, "total_qty": 0}) for s in skus}
 
-        return jsonify({"orders_count": len(orders_set), "total_qty": total_qty})
+
+@bp.route('/api/orders/site/sku-summary', methods=['GET'])
+def site_orders_sku_summary():
+    sku = (request.args.get("sku") or "").strip()
+    if not sku:
+        return jsonify({"orders_count": 0, "total_qty": 0})
+    try:
+        return jsonify(_site_orders_summary([sku])[sku])
     except Exception as ex:
         logging.exception("[site_orders_sku_summary] Errore")
         return jsonify({"orders_count": 0, "total_qty": 0})
 
 
+@bp.route('/api/orders/site/sku-summary/batch', methods=['GET', 'POST'])
+def site_orders_sku_summary_batch():
+    """
+    Riepilogo per una pagina di SKU in una chiamata.
+    GET ?skus=A,B,C  oppure  POST {"skus": ["A", "B", "C"]}
+    -> {"A": {"orders_count": n, "total_qty": q}, ...}
+    """
+    if request.method == "POST":
+        raw = (request.get_json(silent=True) or {}).get("skus") or []
+    else:
+        raw = (request.args.get("skus") or "").split(",")
+    if not isinstance(raw, list):
+        return jsonify({"error": "skus deve essere una lista"}), 400
+    skus = [str(s).strip() for s in raw if str(s or "").strip()]
+    if len(skus) > SITE_SUMMARY_MAX_SKUS:
+        return jsonify({"error": f"Massimo {SITE_SUMMARY_MAX_SKUS} SKU per chiamata"}), 400
+    try:
+        return jsonify(_site_orders_summary(skus))
+    except Exception as ex:
+        logging.exception("[site_orders_sku_summary_batch] Errore")
+        return jsonify({"error": f"Errore: {str(ex)}"}), 500
+
+
 # -----------------------------------------------------------------------------
 # Produzione: sync da prelievo (usata quando cambia un singolo prelievo)
 # -----------------------------------------------------------------------------
@@ -680,6 +744,23 @@ def upload_vendor_orders():
         logging.exception("Errore durante upload ordini vendor")
         return jsonify({"error": f"Errore upload: {e}"}), 500
 
+@bp.route('/api/amazon/vendor/orders/sync', methods=['POST'])
+def sync_vendor_orders():
+    """Accoda un sync incrementale degli ordini da SP-API (job 'sync_vendor_pos' del worker)."""
+    try:
+        job_res = supa_with_retry(lambda: sb_table('jobs').insert([{
+            "type": "sync_vendor_pos",
+            "payload": {},
+            "status": "pending",
+            "user_id": request.headers.get('X-USER-ID'),
+            "created_at": (datetime.now(timezone.utc)).isoformat()
+        }]).execute())
+        job_id = job_res.data[0]['id'] if job_res.data else None
+        return jsonify({"job_id": job_id}), 201
+    except Exception as e:
+        logging.exception("Errore accodamento sync ordini vendor")
+        return jsonify({"error": f"Errore sync: {e}"}), 500
+
 # -----------------------------------------------------------------------------
 # Riepilogo nuovi
 # -----------------------------------------------------------------------------
@@ -822,6 +903,25 @@ def get_riepilogo_id():
 # -----------------------------------------------------------------------------
 # Parziali (lista per riepilogo)
 # -----------------------------------------------------------------------------
+def _materializza_wip(riepilogo_ids) -> None:
+    """
+    I WIP salvati a delta hanno le righe nella proiezione e dati marcato stale:
+    prima di leggere il blob dati lo si ricostruisce (RPC parziali_wip_materializza).
+    Nessun effetto se non ci sono WIP stale o la RPC non è deployata.
+    """
+    try:
+        ids = sorted({int(i) for i in riepilogo_ids if i is not None})
+    except (TypeError, ValueError):
+        return
+    if not ids:
+        return
+    try:
+        supa_with_retry(lambda: supabase.rpc("parziali_wip_materializza", {"p_riepilogo_ids": ids}).execute())
+    except Exception as ex:
+        if not is_missing_rpc(ex):
+            logging.warning("[parziali_wip] ricostruzione dati fallita: %s", ex)
+
+
 @bp.route('/api/amazon/vendor/parziali', methods=['GET'])
 def get_parziali():
     riepilogo_id = request.args.get('riepilogo_id')
@@ -839,6 +939,7 @@ def get_parziali():
         return jsonify({"error": "Offset non valido"}), 400
 
     try:
+        _materializza_wip([riepilogo_id])
         res = supa_with_retry(lambda: exec_range_or_limit(
             sb_table("ordini_vendor_parziali")
             .select("*")
@@ -898,6 +999,7 @@ def save_parziale():
 @bp.route('/api/amazon/vendor/parziali/<int:riepilogo_id>', methods=['GET'])
 def get_parziali_riepilogo(riepilogo_id):
     try:
+        _materializza_wip([riepilogo_id])
         res = supa_with_retry(lambda: (
             sb_table("ordini_vendor_parziali")
             .select("*")
@@ -1004,9 +1106,10 @@ def get_parziali_wip():
             return jsonify([])
         riepilogo_id = rows[0]["id"]
 
+        _materializza_wip([riepilogo_id])
         pres = supa_with_retry(lambda: (
             sb_table("ordini_vendor_parziali")
-            .select("dati, numero_parziale, last_modified_at, conferma_collo")
+            .select("dati, numero_parziale, last_modified_at, conferma_collo, version")
             .eq("riepilogo_id", riepilogo_id)
             .eq("confermato", False)
             .order("numero_parziale", desc=True)
@@ -1020,8 +1123,9 @@ def get_parziali_wip():
                 "confermaCollo": row.get("conferma_collo", {}),
                 "numero_parziale": row.get("numero_parziale"),
                 "last_modified_at": row.get("last_modified_at"),
+                "version": row.get("version"),
             })
-        return jsonify({"parziali": [], "confermaCollo": {}, "numero_parziale": 1})
+        return jsonify({"parziali": [], "confermaCollo": {}, "numero_parziale": 1, "version": 0})
     except Exception as ex:
         logging.exception("[get_parziali_wip] Errore")
         return jsonify({"error": f"Errore: {str(ex)}"}), 500
@@ -1037,9 +1141,15 @@ def save_parziali_wip():
     conferma_collo = data.get("confermaCollo")
     merge = bool(data.get("merge"))
     client_ts = data.get("client_last_modified_at")
+    client_version = data.get("version")
 
     if not center or not start_delivery or parziali is None:
         return jsonify({"error": "center/data/parziali richiesti"}), 400
+    if client_version is not None:
+        try:
+            client_version = int(client_version)
+        except (TypeError, ValueError):
+            return jsonify({"error": "version deve essere un intero"}), 400
 
     try:
         rres = supa_with_retry(lambda: (
@@ -1055,9 +1165,10 @@ def save_parziali_wip():
         riepilogo_id = rows[0]["id"]
 
         # leggi ultimo WIP (non confermato)
+        _materializza_wip([riepilogo_id])
         latest = supa_with_retry(lambda: (
             sb_table("ordini_vendor_parziali")
-            .select("numero_parziale, dati, conferma_collo, last_modified_at")
+            .select("numero_parziale, dati, conferma_collo, last_modified_at, version")
             .eq("riepilogo_id", riepilogo_id)
             .eq("confermato", False)
             .order("numero_parziale", desc=True)
@@ -1068,11 +1179,17 @@ def save_parziali_wip():
             row = latest.data[0]
             numero_parziale = row["numero_parziale"]
             server_ts = row.get("last_modified_at")
+            server_version = row.get("version")
             server_parziali = row.get("dati") or []
             server_conferma = row.get("conferma_collo") or {}
 
-            # optimistic concurrency
-            if client_ts and server_ts and str(client_ts) != str(server_ts):
+            # optimistic concurrency: versione intera se il client la manda,
+            # altrimenti confronto su last_modified_at (client vecchi)
+            if client_version is not None and server_version is not None:
+                if client_version != int(server_version):
+                    return jsonify({"error": "Conflitto: dati aggiornati da altro client.",
+                                    "version": server_version}), 409
+            elif client_ts and server_ts and str(client_ts) != str(server_ts):
                 return jsonify({"error": "Conflitto: dati aggiornati da altro client."}), 409
 
             if merge:
@@ -1117,15 +1234,89 @@ def save_parziali_wip():
             "last_modified_at": (datetime.now(timezone.utc)).isoformat()
         }
 
-        supa_with_retry(lambda: (
+        ures = supa_with_retry(lambda: (
             sb_table("ordini_vendor_parziali")
             .upsert(parziale_data, on_conflict="riepilogo_id,numero_parziale")
         ).execute())
-        return jsonify({"ok": True, "numero_parziale": numero_parziale})
+        saved = (getattr(ures, "data", None) or [{}])[0]
+        _notify_riepilogo(center, start_delivery, "wip", {
+            "numero_parziale": numero_parziale,
+            "version": saved.get("version"),
+            "parziali": parziali_final,
+            "confermaCollo": conferma_final,
+            "last_modified_at": parziale_data["last_modified_at"],
+        })
+        return jsonify({"ok": True, "numero_parziale": numero_parziale, "version": saved.get("version")})
     except Exception as ex:
         logging.exception("[save_parziali_wip] Errore salvataggio parziali wip")
         return jsonify({"error": f"Errore salvataggio: {str(ex)}"}), 500
 
+
+WIP_DELTA_OPS = ("add", "update", "remove")
+
+@bp.route('/api/amazon/vendor/parziali-wip/delta', methods=['POST'])
+def save_parziali_wip_delta():
+    """
+    Salvataggio WIP a delta (una scansione = una scrittura di dimensione costante).
+    Body: { version, ops: [{op: add|update|remove, line: {po_number, model_number, collo, quantita, ...}}],
+            confermaCollo: {"<collo>": true|false|null} }
+    Applicato atomicamente lato DB (RPC parziali_wip_apply_delta) con controllo di versione.
+    """
+    center = request.args.get("center")
+    start_delivery = request.args.get("data")
+    data = request.json or {}
+    ops = data.get("ops") or []
+    conferma_collo = data.get("confermaCollo")
+    version = data.get("version")
+
+    if not center or not start_delivery:
+        return jsonify({"error": "center/data richiesti"}), 400
+    if not isinstance(ops, list) or any(
+        not isinstance(o, dict) or o.get("op") not in WIP_DELTA_OPS or not isinstance(o.get("line"), dict)
+        for o in ops
+    ):
+        return jsonify({"error": "ops non valide (op: add|update|remove, line: oggetto)"}), 400
+    if conferma_collo is not None and not isinstance(conferma_collo, dict):
+        return jsonify({"error": "confermaCollo deve essere un oggetto"}), 400
+    if not ops and conferma_collo is None:
+        return jsonify({"error": "nessuna modifica"}), 400
+    if version is not None:
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            return jsonify({"error": "version deve essere un intero"}), 400
+
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("parziali_wip_apply_delta", {
+            "p_center": center,
+            "p_start_delivery": str(start_delivery)[:10],
+            "p_ops": ops,
+            "p_conferma_collo": conferma_collo,
+            "p_version": version,
+        }).execute())
+        out = res.data or {}
+        _notify_riepilogo(center, start_delivery, "wip_delta", {
+            "numero_parziale": out.get("numero_parziale"),
+            "version": out.get("version"),
+            "ops": ops,
+            "confermaCollo": conferma_collo,
+        })
+        return jsonify({"ok": True, **out})
+    except APIError as ex:
+        msg = ex.args[0] if ex.args else {}
+        message = (msg.get("message") if isinstance(msg, dict) else None) or str(ex)
+        if is_missing_rpc(ex):
+            return jsonify({"error": "salvataggio a delta non disponibile, usa il salvataggio completo"}), 501
+        if "Conflitto" in message:
+            return jsonify({"error": message}), 409
+        if "riepilogo non trovato" in message or "operazione non valida" in message:
+            return jsonify({"error": message}), 400
+        logging.exception("[save_parziali_wip_delta] Errore salvataggio delta")
+        return jsonify({"error": f"Errore salvataggio: {message}"}), 500
+    except Exception as ex:
+        logging.exception("[save_parziali_wip_delta] Errore salvataggio delta")
+        return jsonify({"error": f"Errore salvataggio: {str(ex)}"}), 500
+
 # -----------------------------------------------------------------------------
 # Conferma parziale singolo (imposta stato ordine "parziale")
 # -----------------------------------------------------------------------------
@@ -1196,6 +1387,9 @@ def conferma_parziale():
             logging.error("[conferma_parziale] Stato ordine NON aggiornato a 'parziale'!")
             return jsonify({"error": "Stato ordine non aggiornato, riprova."}), 500
 
+        _notify_riepilogo(center, start_delivery, "confermato",
+                          {"numero_parziale": num_parz, "stato_ordine": "parziale"}, refresh_badges=True)
+
         # 6) Spostamento a Trasferito (best-effort) + report
         report = {"moved": 0, "failures": []}
         try:
@@ -1227,6 +1421,209 @@ def conferma_parziale():
         return jsonify({"error": f"Errore conferma: {str(ex)}"}), 500
 
 
+# -----------------------------------------------------------------------------
+# Conferma parziali in blocco (più centri/date)
+# -----------------------------------------------------------------------------
+CONFERMA_BULK_MAX_WORKERS = 4
+
+def _skus_parziale(dati) -> set:
+    if isinstance(dati, str):
+        try:
+            dati = json.loads(dati)
+        except Exception:
+            dati = []
+    return {r.get("model_number") or r.get("sku") for r in (dati or [])
+            if isinstance(r, dict) and (r.get("model_number") or r.get("sku"))}
+
+
+def _ondate_sku_disgiunti(jobs: list[dict]) -> list[list[dict]]:
+    """Raggruppa i job in ondate in cui nessuna coppia condivide SKU (greedy, ordine stabile)."""
+    waves: list[tuple[set, list]] = []
+    for job in jobs:
+        for used, wave in waves:
+            if not (used & job["skus"]):
+                used |= job["skus"]
+                wave.append(job)
+                break
+        else:
+            waves.append((set(job["skus"]), [job]))
+    return [w for _, w in waves]
+
+
+@bp.route('/api/amazon/vendor/parziali-wip/conferma-parziali-bulk', methods=['POST'])
+def conferma_parziali_bulk():
+    """
+    Conferma l'ultimo WIP di più destinazioni.
+    Body: { items: [{ center, data }, ...] }
+    Lookup/conferma/stato/verifica con query batch; i trasferimenti in 'Trasferito'
+    girano in parallelo per ondate di parziali senza SKU in comune.
+    Ritorna un report per destinazione.
+    """
+    try:
+        items = (request.json or {}).get("items") or []
+        pairs = []
+        for it in items:
+            c = str((it or {}).get("center") or "").strip()
+            d = str((it or {}).get("data") or "").strip()[:10]
+            if c and d and (c, d) not in pairs:
+                pairs.append((c, d))
+        if not pairs:
+            return jsonify({"error": "items (center/data) richiesti"}), 400
+
+        report = {k: {"center": k[0], "data": k[1], "ok": False} for k in pairs}
+
+        # 1) riepiloghi in una query
+        rres = supa_with_retry(lambda: (
+            sb_table("ordini_vendor_riepilogo")
+            .select("id, fulfillment_center, start_delivery")
+            .in_("fulfillment_center", sorted({c for c, _ in pairs}))
+            .in_("start_delivery", sorted({d for _, d in pairs}))
+            .execute()
+        ))
+        riep_by_pair = {}
+        for r in (rres.data or []):
+            k = (r.get("fulfillment_center"), str(r.get("start_delivery") or "")[:10])
+            if k in report and k not in riep_by_pair:
+                riep_by_pair[k] = r["id"]
+        for k in pairs:
+            if k not in riep_by_pair:
+                report[k]["error"] = "riepilogo non trovato"
+
+        # 2) ultimo WIP per riepilogo in una query
+        wip_by_riep = {}
+        if riep_by_pair:
+            _materializza_wip(riep_by_pair.values())
+            wres = supa_with_retry(lambda: (
+                sb_table("ordini_vendor_parziali")
+                .select("riepilogo_id, numero_parziale, dati")
+                .in_("riepilogo_id", list(riep_by_pair.values()))
+                .eq("confermato", False)
+                .execute()
+            ))
+            for w in (wres.data or []):
+                cur = wip_by_riep.get(w["riepilogo_id"])
+                if cur is None or int(w["numero_parziale"]) > int(cur["numero_parziale"]):
+                    wip_by_riep[w["riepilogo_id"]] = w
+        todo = []
+        for k, rid in riep_by_pair.items():
+            w = wip_by_riep.get(rid)
+            if not w:
+                report[k]["error"] = "nessun parziale da confermare"
+                continue
+            report[k]["numero_parziale"] = int(w["numero_parziale"])
+            todo.append({"key": k, "riepilogo_id": rid, "numero_parziale": int(w["numero_parziale"]),
+                         "skus": _skus_parziale(w.get("dati"))})
+
+        if todo:
+            # 3) conferma WIP + 4) stato ordine -> parziale: una update ciascuna
+            cond = ",".join(f"and(riepilogo_id.eq.{j['riepilogo_id']},numero_parziale.eq.{j['numero_parziale']})"
+                            for j in todo)
+            supa_with_retry(lambda: (
+                sb_table("ordini_vendor_parziali")
+                .update({"confermato": True})
+                .or_(cond)
+                .execute()
+            ))
+            rids = [j["riepilogo_id"] for j in todo]
+            supa_with_retry(lambda: (
+                sb_table("ordini_vendor_riepilogo")
+                .update({"stato_ordine": "parziale"})
+                .in_("id", rids)
+                .execute()
+            ))
+
+            # 5) verifica in una lettura
+            vres = supa_with_retry(lambda: (
+                sb_table("ordini_vendor_riepilogo")
+                .select("id, stato_ordine")
+                .in_("id", rids)
+                .execute()
+            ))
+            stato_by_id = {v["id"]: v.get("stato_ordine") for v in (vres.data or [])}
+            confermati = []
+            for j in todo:
+                if stato_by_id.get(j["riepilogo_id"]) != "parziale":
+                    report[j["key"]]["error"] = "Stato ordine non aggiornato, riprova."
+                    continue
+                confermati.append(j)
+                _notify_riepilogo(j["key"][0], j["key"][1], "confermato",
+                                  {"numero_parziale": j["numero_parziale"], "stato_ordine": "parziale"})
+
+            # 6) trasferimenti: ondate senza SKU condivisi, in parallelo dentro l'ondata.
+            #    Un conflitto di lock (deadlock ecc.) annulla l'intero trasferimento lato DB:
+            #    quei parziali vengono rieseguiti in sequenza dopo le ondate.
+            #    Niente request context nei thread: il trasferimento non ne ha bisogno.
+            def _transfer(job, retry_on_conflict=True):
+                center, data = job["key"]
+                try:
+                    return job, _move_parziale_to_trasferito(center, data, job["numero_parziale"])
+                except APIError as ex:
+                    if retry_on_conflict and is_lock_conflict(ex):
+                        logging.warning("[conferma_parziali_bulk] conflitto di lock %s %s, riprovo in sequenza: %s",
+                                        center, data, ex)
+                        return job, None
+                    logging.exception("[conferma_parziali_bulk] trasferimento fallito %s %s", center, data)
+                except Exception:
+                    logging.exception("[conferma_parziali_bulk] trasferimento fallito %s %s", center, data)
+                return job, {"moved": 0, "failures": [{"error": "eccezione", "sku": None, "take": None}]}
+
+            transfers, retry = [], []
+            for wave in _ondate_sku_disgiunti(confermati):
+                workers = min(CONFERMA_BULK_MAX_WORKERS, len(wave))
+                if workers <= 1:
+                    done = [_transfer(j) for j in wave]
+                else:
+                    with ThreadPoolExecutor(max_workers=workers) as pool:
+                        done = list(pool.map(_transfer, wave))
+                transfers += [(job, tr) for job, tr in done if tr is not None]
+                retry += [job for job, tr in done if tr is None]
+            transfers += [_transfer(job, retry_on_conflict=False) for job in retry]
+
+            for job, tr in transfers:
+                k = job["key"]
+                report[k]["ok"] = True
+                report[k]["transfer_report"] = tr
+                if tr.get("failures"):
+                    report[k]["warning"] = "Qualcosa non ha funzionato nel trasferimento. Contatta l’assistenza."
+                    enqueue_job("move_to_trasferito_failed", {
+                        "center": k[0],
+                        "start_delivery": k[1],
+                        "numero_parziale": job["numero_parziale"],
+                        "report": tr,
+                    })
+
+            if confermati and broker.subscribers(SSE_TOPIC_VENDOR):
+                publish(SSE_TOPIC_VENDOR, "badges", _badge_counts_payload(fresh=True))
+
+        results = [report[k] for k in pairs]
+        return jsonify({"ok": all(r["ok"] for r in results), "results": results}), 200
+
+    except Exception as ex:
+        logging.exception("Errore conferma parziali bulk")
+        return jsonify({"error": f"Errore conferma: {str(ex)}"}), 500
+
+
+def _sync_qty_confirmed(riepilogo_id: int, include_wip: bool = False,
+                        reset_missing: bool = False) -> Optional[dict]:
+    """
+    Aggrega i parziali del riepilogo e scrive qty_confirmed sugli items in un
+    solo UPDATE (RPC ordini_vendor_sync_qty_confirmed). Ritorna {model_number: qty},
+    oppure None se la RPC non è deployata (il chiamante usa il percorso per-riga).
+    """
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("ordini_vendor_sync_qty_confirmed", {
+            "p_riepilogo_id": int(riepilogo_id),
+            "p_include_wip": bool(include_wip),
+            "p_reset_missing": bool(reset_missing),
+        }).execute())
+    except APIError as ex:
+        if is_missing_rpc(ex):
+            logging.warning("[qty_confirmed] RPC assente, fallback per-riga: %s", ex)
+            return None
+        raise
+    return {k: int(v or 0) for k, v in (res.data or {}).items()}
+
+
 # -----------------------------------------------------------------------------
 # Conferma e chiusura ordine (aggiorna qty_confirmed e stato)
 # -----------------------------------------------------------------------------
@@ -1263,7 +1660,6 @@ def conferma_chiudi_ordine():
         if not wip.data:
             return jsonify({"error": "nessun parziale da confermare"}), 400
         num_parz = wip.data[0]["numero_parziale"]
-        dati_wip = wip.data[0]["dati"]
 
         supa_with_retry(lambda: (
             sb_table("ordini_vendor_parziali")
@@ -1273,29 +1669,29 @@ def conferma_chiudi_ordine():
             .execute()
         ))
 
-        storici = supa_with_retry(lambda: (
-            sb_table("ordini_vendor_parziali")
-            .select("dati")
-            .eq("riepilogo_id", riepilogo_id)
-            .eq("confermato", True)
-            .order("numero_parziale")
-            .execute()
-        ))
-        totali_sku = defaultdict(int)
-        for p in (storici.data or []):
-            for r in p.get("dati", []):
-                totali_sku[r["model_number"]] += int(r["quantita"])
-        for r in dati_wip:
-            totali_sku[r["model_number"]] += int(r["quantita"])
-
-        for model_number, qty in totali_sku.items():
-            supa_with_retry(lambda mn=model_number, q=qty: (
-                sb_table("ordini_vendor_items")
-                .update({"qty_confirmed": q})
-                .in_("po_number", po_list)
-                .eq("model_number", mn)
+        # il WIP è ora confermato: i totali sono la somma dei soli parziali confermati
+        if _sync_qty_confirmed(riepilogo_id) is None:
+            storici = supa_with_retry(lambda: (
+                sb_table("ordini_vendor_parziali")
+                .select("dati")
+                .eq("riepilogo_id", riepilogo_id)
+                .eq("confermato", True)
+                .order("numero_parziale")
                 .execute()
             ))
+            totali_sku = defaultdict(int)
+            for p in (storici.data or []):
+                for r in p.get("dati", []):
+                    totali_sku[r["model_number"]] += int(r["quantita"])
+
+            for model_number, qty in totali_sku.items():
+                supa_with_retry(lambda mn=model_number, q=qty: (
+                    sb_table("ordini_vendor_items")
+                    .update({"qty_confirmed": q})
+                    .in_("po_number", po_list)
+                    .eq("model_number", mn)
+                    .execute()
+                ))
 
         supa_with_retry(lambda: (
             sb_table("ordini_vendor_riepilogo")
@@ -1303,6 +1699,8 @@ def conferma_chiudi_ordine():
             .eq("id", riepilogo_id)
             .execute()
         ))
+        _notify_riepilogo(center, start_delivery, "confermato",
+                          {"numero_parziale": num_parz, "stato_ordine": "parziale"}, refresh_badges=True)
         return jsonify({"ok": True})
     except Exception as ex:
         logging.exception("Errore chiusura ordine")
@@ -1376,106 +1774,113 @@ def chiudi_ordine():
             # Mock di test: tabella senza .select
             fallback_mode = True
 
-        # --- Leggo i parziali confermati (e l'eventuale WIP)
-        parziali = []
+        # --- Percorso rapido: aggregazione + update items in una sola RPC
+        qty_per_model = None
+        wip = None
         if not fallback_mode:
-            # percorso normale con riepilogo_id
-            offset = 0
-            limit = 100
-            while True:
-                pres = supa_with_retry(lambda off=offset: (
+            qty_per_model = _sync_qty_confirmed(riepilogo_id, include_wip=True, reset_missing=True)
+
+        if qty_per_model is None:
+            # --- Leggo i parziali confermati (e l'eventuale WIP)
+            parziali = []
+            if not fallback_mode:
+                # percorso normale con riepilogo_id
+                offset = 0
+                limit = 100
+                while True:
+                    pres = supa_with_retry(lambda off=offset: (
+                        sb_table("ordini_vendor_parziali")
+                        .select("dati")
+                        .eq("riepilogo_id", riepilogo_id)
+                        .eq("confermato", True)
+                        .order("numero_parziale")
+                        .range(off, off + limit - 1)
+                        .execute()
+                    ))
+                    batch = pres.data or []
+                    if not batch:
+                        break
+                    parziali.extend(batch)
+                    if len(batch) < limit:
+                        break
+                    offset += limit
+
+                wip = supa_with_retry(lambda: (
                     sb_table("ordini_vendor_parziali")
                     .select("dati")
                     .eq("riepilogo_id", riepilogo_id)
-                    .eq("confermato", True)
-                    .order("numero_parziale")
-                    .range(off, off + limit - 1)
+                    .eq("confermato", False)
+                    .order("numero_parziale", desc=True)
+                    .limit(1)
+                    .execute()
+                ))
+            else:
+                # Fallback per i test: uso i flag dentro select(**kwargs) come i fake del test
+                pres = supa_with_retry(lambda: (
+                    sb_table("ordini_vendor_parziali")
+                    .select("dati", confermato=True)   # i mock guardano il kwargs
+                    .execute()
+                ))
+                parziali.extend(pres.data or [])
+                wip = supa_with_retry(lambda: (
+                    sb_table("ordini_vendor_parziali")
+                    .select("dati", confermato=False)  # i mock guardano il kwargs
+                    .limit(1)
                     .execute()
                 ))
-                batch = pres.data or []
-                if not batch:
-                    break
-                parziali.extend(batch)
-                if len(batch) < limit:
-                    break
-                offset += limit
-
-            wip = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_parziali")
-                .select("dati")
-                .eq("riepilogo_id", riepilogo_id)
-                .eq("confermato", False)
-                .order("numero_parziale", desc=True)
-                .limit(1)
-                .execute()
-            ))
-        else:
-            # Fallback per i test: uso i flag dentro select(**kwargs) come i fake del test
-            pres = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_parziali")
-                .select("dati", confermato=True)   # i mock guardano il kwargs
-                .execute()
-            ))
-            parziali.extend(pres.data or [])
-            wip = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_parziali")
-                .select("dati", confermato=False)  # i mock guardano il kwargs
-                .limit(1)
-                .execute()
-            ))
-
-        if getattr(wip, "data", None):
-            parziali.append(wip.data[0])
-
-        # --- Aggrego quantità per modello (accetto sia model_number/quantita che sku/qty)
-        qty_per_model = {}
-        for p in parziali:
-            dati_list = p.get("dati") or []
-            if isinstance(dati_list, str):
-                try:
-                    dati_list = json.loads(dati_list)
-                except Exception:
-                    dati_list = []
-            for r in dati_list:
-                model = r.get("model_number") or r.get("sku")
-                qval = r.get("quantita")
-                if qval is None:
-                    qval = r.get("qty")
-                try:
-                    qty_per_model[model] = qty_per_model.get(model, 0) + int(qval or 0)
-                except Exception:
-                    pass
 
-        # --- Items da aggiornare
-        if not fallback_mode:
-            ares = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_items")
-                .select("id, model_number")
-                .in_("po_number", po_list)
-                .execute()
-            ))
-            articoli = ares.data or []
-        else:
-            # Fallback test: prendo tutti gli items (il mock restituisce solo quelli di interesse)
-            ares = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_items")
-                .select("id, model_number, po_number")
-                .execute()
-            ))
-            articoli = ares.data or []
-            # se non avevamo po_list, proviamo a derivarlo
-            if not po_list:
-                po_list = sorted(list({a.get("po_number") for a in articoli if a.get("po_number")}))
+            if getattr(wip, "data", None):
+                parziali.append(wip.data[0])
 
-        # --- Update qty_confirmed
-        for art in articoli:
-            nuova_qty = qty_per_model.get(art["model_number"], 0)
-            supa_with_retry(lambda aid=art["id"], q=nuova_qty:
-                sb_table("ordini_vendor_items")
-                .update({"qty_confirmed": q})
-                .eq("id", aid)
-                .execute()
-            )
+            # --- Aggrego quantità per modello (accetto sia model_number/quantita che sku/qty)
+            qty_per_model = {}
+            for p in parziali:
+                dati_list = p.get("dati") or []
+                if isinstance(dati_list, str):
+                    try:
+                        dati_list = json.loads(dati_list)
+                    except Exception:
+                        dati_list = []
+                for r in dati_list:
+                    model = r.get("model_number") or r.get("sku")
+                    qval = r.get("quantita")
+                    if qval is None:
+                        qval = r.get("qty")
+                    try:
+                        qty_per_model[model] = qty_per_model.get(model, 0) + int(qval or 0)
+                    except Exception:
+                        pass
+
+            # --- Items da aggiornare
+            if not fallback_mode:
+                ares = supa_with_retry(lambda: (
+                    sb_table("ordini_vendor_items")
+                    .select("id, model_number")
+                    .in_("po_number", po_list)
+                    .execute()
+                ))
+                articoli = ares.data or []
+            else:
+                # Fallback test: prendo tutti gli items (il mock restituisce solo quelli di interesse)
+                ares = supa_with_retry(lambda: (
+                    sb_table("ordini_vendor_items")
+                    .select("id, model_number, po_number")
+                    .execute()
+                ))
+                articoli = ares.data or []
+                # se non avevamo po_list, proviamo a derivarlo
+                if not po_list:
+                    po_list = sorted(list({a.get("po_number") for a in articoli if a.get("po_number")}))
+
+            # --- Update qty_confirmed
+            for art in articoli:
+                nuova_qty = qty_per_model.get(art["model_number"], 0)
+                supa_with_retry(lambda aid=art["id"], q=nuova_qty:
+                    sb_table("ordini_vendor_items")
+                    .update({"qty_confirmed": q})
+                    .eq("id", aid)
+                    .execute()
+                )
 
         # --- Stato riepilogo -> completato (anche in fallback: l’ID non è verificato dal test)
         supa_with_retry(lambda: (
@@ -1486,7 +1891,7 @@ def chiudi_ordine():
         ))
 
         # --- Se esiste WIP non confermato, marcane l’ultimo come confermato
-        if getattr(wip, "data", None):
+        if wip is None or getattr(wip, "data", None):
             nres = supa_with_retry(lambda: (
                 sb_table("ordini_vendor_parziali")
                 .select("numero_parziale")
@@ -1506,6 +1911,8 @@ def chiudi_ordine():
                     .execute()
                 ))
 
+        _notify_riepilogo(center, start_delivery, "chiuso",
+                          {"stato_ordine": "completato", "qty_confirmed": qty_per_model}, refresh_badges=True)
         return jsonify({"ok": True, "qty_confirmed": qty_per_model})
     except Exception as ex:
         logging.exception("Errore chiusura ordine")
@@ -1637,7 +2044,9 @@ def list_vendor_pos():
             "x-amz-access-token": access_token,
             "Content-Type": "application/json"
         }
-        resp = requests.get(url, auth=awsauth, headers=headers, params=params)
+        resp = spapi_session.get(url, auth=awsauth, headers=headers, params=params, timeout=30)
+        if resp.status_code in (401, 403):
+            spapi_tokens.invalidate()
         logging.info(f"Amazon Vendor Orders Response: {resp.status_code} {resp.text[:200]}")
         return (resp.text, resp.status_code, {'Content-Type': 'application/json'})
     except Exception as ex:
@@ -1867,7 +2276,9 @@ def test_asn_submit():
         logging.warning(f"ASN SUBMIT HEADERS: {headers}")
         logging.warning(f"ASN SUBMIT BODY: {payload}")
 
-        resp = requests.post(url, json=payload, headers=headers)
+        resp = spapi_session.post(url, json=payload, headers=headers, timeout=30)
+        if resp.status_code in (401, 403):
+            spapi_tokens.invalidate()
 
         logging.warning(f"ASN SUBMIT RESPONSE STATUS: {resp.status_code}")
         logging.warning(f"ASN SUBMIT RESPONSE TEXT: {resp.text}")
@@ -1944,14 +2355,27 @@ def find_items_by_barcode():
                 a["qty_inserted"] = 0
             return jsonify(articoli)
 
-        pres = supa_with_retry(lambda: (
-            sb_table("ordini_vendor_parziali")
-            .select("dati")
-            .in_("riepilogo_id", riepilogo_ids)
-            .execute()
-        ))
         qty_inserted_map = defaultdict(int)
-        for p in (pres.data or []):
+        parziali_dati = []   # solo nel fallback: blob dati da aggregare in Python
+        try:
+            # totali già aggregati dalla proiezione righe parziali
+            models = sorted({a["model_number"] for a in articoli if a.get("model_number")})
+            qres = supa_with_retry(lambda: supabase.rpc("parziali_qty_inserted", {
+                "p_riepilogo_ids": riepilogo_ids,
+                "p_model_numbers": models,
+            }).execute())
+            for q in (qres.data or []):
+                qty_inserted_map[(q.get("po_number"), q.get("model_number"))] += int(q.get("quantita") or 0)
+        except Exception as ex:
+            logging.warning(f"[find_items_by_barcode] aggregato parziali non disponibile, fallback dati: {ex}")
+            pres = supa_with_retry(lambda: (
+                sb_table("ordini_vendor_parziali")
+                .select("dati")
+                .in_("riepilogo_id", riepilogo_ids)
+                .execute()
+            ))
+            parziali_dati = pres.data or []
+        for p in parziali_dati:
             dati = p.get("dati")
             if isinstance(dati, str):
                 try:
@@ -2001,12 +2425,19 @@ def riepilogo_dashboard_parziali():
         riepilogo_ids = [r.get("id") or r.get("riepilogo_id") for r in riepiloghi]
 
         # ⬇️ Aggiungo "confermato" così possiamo derivare parziale_chiuso
-        pres = supa_with_retry(lambda: (
-            sb_table("ordini_vendor_parziali")
-            .select("riepilogo_id,numero_parziale,dati,conferma_collo,confermato")
-            .in_("riepilogo_id", riepilogo_ids)
-            .execute()
-        ))
+        # colli_totali già contati lato SQL (righe parziali): niente download di dati
+        try:
+            pres = supa_with_retry(lambda: supabase.rpc("parziali_dashboard_colli", {
+                "p_riepilogo_ids": riepilogo_ids,
+            }).execute())
+        except Exception as ex:
+            logging.warning(f"[riepilogo_dashboard_parziali] aggregato colli non disponibile, fallback dati: {ex}")
+            pres = supa_with_retry(lambda: (
+                sb_table("ordini_vendor_parziali")
+                .select("riepilogo_id,numero_parziale,dati,conferma_collo,confermato")
+                .in_("riepilogo_id", riepilogo_ids)
+                .execute()
+            ))
         parziali = pres.data or []
 
         parziali_per_riep = defaultdict(list)
@@ -2042,19 +2473,23 @@ def riepilogo_dashboard_parziali():
             for p in my_parziali:
                 numero_parziale = p.get("numero_parziale") or 1
 
-                # colli totali dai dati
-                dati = p.get("dati", [])
-                if isinstance(dati, str):
-                    try:
-                        dati = json.loads(dati)
-                    except Exception:
-                        dati = []
-                colli_totali_set = set()
-                if isinstance(dati, list):
-                    for d in dati:
-                        collo = d.get("collo")
-                        if collo is not None:
-                            colli_totali_set.add(collo)
+                # colli totali: dall'aggregato SQL oppure dai dati
+                if "colli_totali" in p:
+                    colli_totali = int(p.get("colli_totali") or 0)
+                else:
+                    dati = p.get("dati", [])
+                    if isinstance(dati, str):
+                        try:
+                            dati = json.loads(dati)
+                        except Exception:
+                            dati = []
+                    colli_totali_set = set()
+                    if isinstance(dati, list):
+                        for d in dati:
+                            collo = d.get("collo")
+                            if collo is not None:
+                                colli_totali_set.add(collo)
+                    colli_totali = len(colli_totali_set)
 
                 # colli confermati da conferma_collo
                 conferma_collo = p.get("conferma_collo") or {}
@@ -2083,7 +2518,7 @@ def riepilogo_dashboard_parziali():
                     "start_delivery": start_delivery,
                     "stato_ordine": stato_ordine,
                     "numero_parziale": numero_parziale,
-                    "colli_totali": len(colli_totali_set),
+                    "colli_totali": colli_totali,
                     "colli_confermati": len(colli_confermati_set),
                     "po_list": po_list,
                     "riepilogo_id": riepilogo_id,
@@ -2270,6 +2705,36 @@ def _log_sync_summary(*, utente: str, motivo: str, scope: str, dettaglio: dict):
 
 
 
+def _insert_movimenti(rows: list) -> None:
+    supa_with_retry(lambda: sb_table("movimenti_produzione_vendor").insert(rows).execute())
+
+
+def _insert_movimento(payload: dict) -> None:
+    """Insert singolo; PARACADUTE: su violazione FK (23503) reinserisce senza produzione_id."""
+    try:
+        _insert_movimenti([payload])
+    except Exception as ex:
+        msg = str(ex).lower()
+        if "23503" not in msg and "foreign key" not in msg:
+            raise
+        payload2 = dict(payload)
+        payload2["produzione_id"] = None
+        _insert_movimenti([payload2])
+
+
+# log scritti a blocchi da un thread di background (vedi app/common/log_sink.py)
+movimenti_sink = BufferedLogSink("movimenti_amazon_vendor", _insert_movimenti, _insert_movimento)
+
+
+@bp.teardown_request
+def _flush_movimenti_a_fine_richiesta(exc=None):
+    if movimenti_sink.mode == "request":
+        try:
+            movimenti_sink.flush()
+        except Exception as ex:
+            logging.warning(f"[log_movimento_produzione] flush fine richiesta fallito: {ex}")
+
+
 def log_movimento_produzione(row, utente, motivo,
                              stato_vecchio=None, stato_nuovo=None,
                              qty_vecchia=None, qty_nuova=None,
@@ -2288,25 +2753,15 @@ def log_movimento_produzione(row, utente, motivo,
         "plus_nuovo": plus_nuovo,         # <—
         "motivo": motivo,
         "utente": utente,
-        "dettaglio": dettaglio or {}
+        "dettaglio": dettaglio or {},
+        # timestamp dell'evento, non del flush
+        "created_at": datetime.now(timezone.utc).isoformat(),
     }
 
     try:
-        supa_with_retry(lambda: sb_table("movimenti_produzione_vendor")
-                        .insert(payload).execute())
+        movimenti_sink.write(payload)
     except Exception as ex:
-        msg = str(ex).lower()
-        # PARACADUTE: se è una violazione FK (23503), reinserisci senza produzione_id
-        if "23503" in msg or "foreign key" in msg:
-            try:
-                payload2 = dict(payload)
-                payload2["produzione_id"] = None
-                supa_with_retry(lambda: sb_table("movimenti_produzione_vendor")
-                                .insert(payload2).execute())
-                return
-            except Exception:
-                pass
-        # altri errori: logga e vai avanti senza bloccare il flusso operativo
+        # non bloccare il flusso operativo
         logging.warning(f"[log_movimento_produzione] errore log: {ex}")
 
 
@@ -2574,45 +3029,167 @@ def sync_produzione(prelievi_modificati, utente=None, motivo="Modifica prelievo"
     # -----------------------------------------------------------------------------
 # Badge counts
 # -----------------------------------------------------------------------------
-@bp.route('/api/amazon/vendor/orders/badge-counts', methods=['GET'])
-def badge_counts():
+BADGE_CACHE_SECONDS = float(os.getenv("BADGE_CACHE_SECONDS", "5"))
+_badge_cache = {"at": 0.0, "data": None}
+
+
+def _badge_counts_payload(fresh: bool = False) -> dict:
+    """
+    Badge ordini {nuovi, parziali}: count raggruppato lato DB (RPC badge_counters_get),
+    in cache BADGE_CACHE_SECONDS per il polling; fresh=True dopo una scrittura.
+    Fallback count(exact).
+    """
+    # 1) una sola chiamata aggregata, condivisa tra i client per pochi secondi
+    now = time.monotonic()
+    if not fresh and _badge_cache["data"] is not None and now - _badge_cache["at"] < BADGE_CACHE_SECONDS:
+        return dict(_badge_cache["data"])
     try:
-        res_nuovi = supa_with_retry(lambda: (
-            sb_table("ordini_vendor_riepilogo")
-            .select("id", count="exact", head=True)
-            .eq("stato_ordine", "nuovo")
-            .execute()
-        ))
-        res_parz = supa_with_retry(lambda: (
+        res = supa_with_retry(lambda: supabase.rpc("badge_counters_get", {"p_scope": "vendor"}).execute())
+        per_stato = ((res.data or {}).get("vendor") or {}).get("stato_ordine") or {}
+        data = {"nuovi": int(per_stato.get("nuovo") or 0),
+                "parziali": int(per_stato.get("parziale") or 0)}
+        _badge_cache.update(at=now, data=data)
+        return dict(data)
+    except Exception as ex:
+        logging.warning(f"[badge_counts] conteggio aggregato non disponibile, fallback count: {ex}")
+
+    # 2) fallback: count(exact) dirette
+    res_nuovi = supa_with_retry(lambda: (
+        sb_table("ordini_vendor_riepilogo")
+        .select("id", count="exact", head=True)
+        .eq("stato_ordine", "nuovo")
+        .execute()
+    ))
+    res_parz = supa_with_retry(lambda: (
+        sb_table("ordini_vendor_riepilogo")
+        .select("id", count="exact", head=True)
+        .eq("stato_ordine", "parziale")
+        .execute()
+    ))
+
+    def _count_or_fallback(status, head_res):
+        cnt = getattr(head_res, "count", None)
+        if cnt is not None:
+            return cnt
+        # fallback per ambienti test/mock che non popolano .count
+        data_res = supa_with_retry(lambda: (
             sb_table("ordini_vendor_riepilogo")
-            .select("id", count="exact", head=True)
-            .eq("stato_ordine", "parziale")
+            .select("id")
+            .eq("stato_ordine", status)
             .execute()
         ))
+        return len(data_res.data or [])
 
-        def _count_or_fallback(status, head_res):
-            cnt = getattr(head_res, "count", None)
-            if cnt is not None:
-                return cnt
-            # fallback per ambienti test/mock che non popolano .count
-            data_res = supa_with_retry(lambda: (
-                sb_table("ordini_vendor_riepilogo")
-                .select("id")
-                .eq("stato_ordine", status)
-                .execute()
-            ))
-            return len(data_res.data or [])
+    return {"nuovi": _count_or_fallback("nuovo", res_nuovi),
+            "parziali": _count_or_fallback("parziale", res_parz)}
 
-        n_nuovi = _count_or_fallback("nuovo", res_nuovi)
-        n_parz  = _count_or_fallback("parziale", res_parz)
 
-        return jsonify({"nuovi": n_nuovi, "parziali": n_parz})
+@bp.route('/api/amazon/vendor/orders/badge-counts', methods=['GET'])
+def badge_counts():
+    try:
+        return jsonify(_badge_counts_payload())
     except Exception as ex:
         logging.exception("Errore badge_counts")
         return jsonify({"nuovi": 0, "parziali": 0}), 200
 
 
+# -----------------------------------------------------------------------------
+# Stream SSE: parziali per riepilogo + badge/dashboard globali
+# -----------------------------------------------------------------------------
+SSE_TOPIC_VENDOR = "vendor"
+
+def _sse_topic_riepilogo(center: str, start_delivery: str) -> str:
+    return f"parziali:{(center or '').strip()}|{str(start_delivery or '')[:10]}"
+
+
+def _notify_riepilogo(center: str, start_delivery: str, event: str, data: dict,
+                      refresh_badges: bool = False) -> None:
+    """
+    Push verso i client aperti sul riepilogo e (per cambi di stato ordine)
+    verso lo stream globale: evento 'riepilogo' + badge aggiornati.
+    Best-effort: non solleva mai.
+    """
+    publish(_sse_topic_riepilogo(center, start_delivery), event, data)
+    publish(SSE_TOPIC_VENDOR, "riepilogo", {
+        "fulfillment_center": center,
+        "start_delivery": str(start_delivery or "")[:10],
+        "event": event,
+        "numero_parziale": data.get("numero_parziale"),
+    })
+    if refresh_badges and broker.subscribers(SSE_TOPIC_VENDOR):
+        try:
+            publish(SSE_TOPIC_VENDOR, "badges", _badge_counts_payload(fresh=True))
+        except Exception as ex:
+            logging.warning(f"[sse] badge non pubblicati: {ex}")
+
+
+@bp.route('/api/amazon/vendor/stream/parziali', methods=['GET'])
+def stream_parziali():
+    """
+    SSE per riepilogo (center+data). Eventi:
+      wip        -> stato completo del WIP dopo un salvataggio completo
+      wip_delta  -> operazioni applicate da un salvataggio a delta (+ version)
+      confermato / chiuso -> parziale confermato / ordine chiuso
+    """
+    center = request.args.get("center")
+    start_delivery = request.args.get("data")
+    if not center or not start_delivery:
+        return jsonify({"error": "center/data richiesti"}), 400
+    return sse_response([_sse_topic_riepilogo(center, start_delivery)])
+
+
+@bp.route('/api/amazon/vendor/stream/badges', methods=['GET'])
+def stream_badges():
+    """SSE globale: 'badges' (contatori, inviati anche alla connessione) e 'riepilogo' (cosa è cambiato)."""
+    try:
+        initial = ("badges", _badge_counts_payload())
+    except Exception:
+        initial = None
+    return sse_response([SSE_TOPIC_VENDOR], initial=initial)
+
+
 def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parziale: int):
+    """
+    Sposta in 'Trasferito' la produzione coperta dal parziale confermato (e i residui
+    in 'Deposito'): una sola RPC transfer_parziale, stessa logica e stesso report
+    {moved, failures, deposited}. Se la RPC non è deployata usa il percorso Python.
+    """
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("transfer_parziale", {
+            "p_center": center,
+            "p_start_delivery": str(start_delivery)[:10],
+            "p_numero_parziale": int(numero_parziale),
+        }).execute())
+    except APIError as ex:
+        if not is_missing_rpc(ex):
+            raise
+        logging.warning("[move_to_trasferito] RPC transfer_parziale assente, fallback legacy: %s", ex)
+        return _move_parziale_to_trasferito_legacy(center, start_delivery, numero_parziale)
+
+    out = res.data or {}
+    return {
+        "moved": int(out.get("moved") or 0),
+        "failures": list(out.get("failures") or []),
+        "deposited": int(out.get("deposited") or 0),
+    }
+
+
+def _need_riscontro_first(curr_sku: dict, confermato_sku: dict, riscontro_sku: dict) -> dict:
+    """
+    Pezzi da spostare per SKU (regola "riscontro-first"), come transfer_parziale sul
+    registro ordini_vendor_totali_giorno: precedenti = confermato del giorno - corrente
+    (tutti gli altri parziali confermati, non solo quelli creati prima).
+    """
+    out: dict[str, int] = {}
+    for sku, q_curr in curr_sku.items():
+        q_curr = int(q_curr)
+        prec = max(0, int(confermato_sku.get(sku, 0)) - q_curr)
+        risc_residuo = max(0, int(riscontro_sku.get(sku, 0)) - prec)
+        out[sku] = max(0, q_curr - risc_residuo)
+    return out
+
+
+def _move_parziale_to_trasferito_legacy(center: str, start_delivery: str, numero_parziale: int):
     
     report = {"moved": 0, "failures": [], "deposited": 0}
 
@@ -2669,7 +3246,7 @@ def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parzia
         parziale_exact_curr[(sku, ean)] = parziale_exact_curr.get((sku, ean), 0) + q
 
 
-    #    -> confronto temporale: created_at < curr_ts
+    # 3) confermato del giorno per SKU (tutti i centri, corrente incluso)
     riep_ids = _rows(lambda: (
         sb_table("ordini_vendor_riepilogo")
         .select("id")
@@ -2678,22 +3255,16 @@ def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parzia
     ))
     riep_id_list = [int(r["id"]) for r in riep_ids if r.get("id") is not None]
 
-    sum_parz_prec_sku: dict[str,int] = {}
+    confermato_sku: dict[str,int] = {}
     if riep_id_list:
-        parz_prec_all = _rows(lambda: (
+        parz_conf_all = _rows(lambda: (
             sb_table("ordini_vendor_parziali")
-            .select("numero_parziale, dati, confermato, created_at, riepilogo_id")
+            .select("numero_parziale, dati, confermato, riepilogo_id")
             .in_("riepilogo_id", riep_id_list)
-            .order("created_at")  # asc
+            .eq("confermato", True)
             .execute()
         ))
-        for p in parz_prec_all:
-            if not p.get("confermato"):
-                continue
-            p_ts = p.get("created_at")
-            # escludi quelli NON "precedenti" al parziale corrente
-            if p_ts and p_ts >= p_curr.get("created_at"):
-                continue
+        for p in parz_conf_all:
             dati = p.get("dati") or []
             if isinstance(dati, str):
                 try: dati = json.loads(dati)
@@ -2702,7 +3273,7 @@ def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parzia
                 sku = r.get("model_number") or r.get("sku")
                 q   = int(r.get("quantita") or r.get("qty") or 0)
                 if sku and q > 0:
-                    sum_parz_prec_sku[sku] = sum_parz_prec_sku.get(sku, 0) + q
+                    confermato_sku[sku] = confermato_sku.get(sku, 0) + q
 
     # 4) Riscontro/Ordinato totali del giorno (solo Vendor)
     prelievi_same_date = _rows(lambda: (
@@ -2729,10 +3300,7 @@ def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parzia
             pass
 
     # 5) 'need' per SKU: regola "riscontro-first"
-    to_move_sku: dict[str, int] = {}
-    for sku, q_curr in parziale_sku_curr.items():
-        risc_residuo = max(0, int(riscontro_sku.get(sku, 0)) - int(sum_parz_prec_sku.get(sku, 0)))
-        to_move_sku[sku] = max(0, int(q_curr) - risc_residuo)
+    to_move_sku = _need_riscontro_first(parziale_sku_curr, confermato_sku, riscontro_sku)
 
     # 6) Selezione candidati attivi e movimenti verso 'Trasferito'
     stati_attivi = ["Stampato", "Calandrato", "Cucito", "Confezionato"]
@@ -2926,8 +3494,8 @@ def _move_parziale_to_trasferito(center: str, start_delivery: str, numero_parzia
         ))
         active_total = sum(int(r.get("da_produrre") or 0) for r in active_rows)
 
-        # NEW: somma complessiva dei parziali confermati (prima + corrente)
-        confirmed_total = int(sum_parz_prec_sku.get(sku, 0)) + int(parziale_sku_curr.get(sku, 0))
+        # somma complessiva dei parziali confermati del giorno (corrente incluso)
+        confirmed_total = max(int(confermato_sku.get(sku, 0)), int(parziale_sku_curr.get(sku, 0)))
 
         should_drain = ((transferred + risc) >= ordered) or (confirmed_total >= ordered)
 
@@ -2984,23 +3552,31 @@ def _read_prelievi_prenotati_per_canale(keys, supa_with_retry, sb_table):
     Aggrega prenotati dai prelievi ATTIVI (stato in ACTIVE_PRELIEVO_STATES)
     keys: set([(sku, ean_or_None), ...]) della pagina corrente
     ritorna: dict[(sku,ean)] -> { "Amazon Vendor": x, "Sito": y, "Amazon Seller": z }
+
+    Percorso legacy: usato solo se la proiezione magazzino_disponibilita non esiste.
     """
     import json as _json
 
-    skus = list({k[0] for k in keys})
-    eans = list({k[1] for k in keys if k[1]})
-
-    pq = sb_table("prelievi_ordini_amazon").select("sku, ean, mag_usato_by_canale, stato").in_("sku", skus)
-    # filtro stati lato SQL (ampio) + filtro difensivo lato Python
-    pq = pq.in_("stato", list(ACTIVE_PRELIEVO_STATES))
-    if eans and len(eans) <= 500:
-        pq = pq.in_("ean", eans)
-
-    try:
-        prelievi_rows = supa_with_retry(lambda: pq.execute()).data or []
-    except Exception as ex:
-        logging.warning(f"[giacenze estese] prelievi APIError: {ex}")
-        prelievi_rows = []
+    # indice SKU -> coppie in pagina (evita la scansione lineare per ogni prelievo)
+    keys_by_sku = defaultdict(list)
+    for kk in keys:
+        keys_by_sku[kk[0]].append(kk)
+
+    CHUNK = 200
+    skus_all = sorted(keys_by_sku.keys())
+    prelievi_rows = []
+    for i in range(0, len(skus_all), CHUNK):
+        skus = skus_all[i:i + CHUNK]
+        eans = sorted({kk[1] for s_ in skus for kk in keys_by_sku[s_] if kk[1]})
+        pq = sb_table("prelievi_ordini_amazon").select("sku, ean, mag_usato_by_canale, stato").in_("sku", skus)
+        # filtro stati lato SQL (ampio) + filtro difensivo lato Python
+        pq = pq.in_("stato", list(ACTIVE_PRELIEVO_STATES))
+        if eans:
+            pq = pq.in_("ean", eans)
+        try:
+            prelievi_rows.extend(supa_with_retry(lambda q=pq: q.execute()).data or [])
+        except Exception as ex:
+            logging.warning(f"[giacenze estese] prelievi APIError: {ex}")
 
     # filtro difensivo su stati
     out = {}
@@ -3013,7 +3589,7 @@ def _read_prelievi_prenotati_per_canale(keys, supa_with_retry, sb_table):
             k = (pr.get("sku"), pr.get("ean") or None)
             if k not in keys:
                 # fallback per SKU: se in pagina c'è una sola coppia per quello SKU, mappa lì
-                candidates = [kk for kk in keys if kk[0] == k[0]]
+                candidates = keys_by_sku.get(k[0], [])
                 if len(candidates) == 1:
                     k = candidates[0]
                 else:
@@ -3043,10 +3619,139 @@ def _read_prelievi_prenotati_per_canale(keys, supa_with_retry, sb_table):
 
     return out
 
+
+def _giacenza_payload(sku, ean, per_canale: dict, pren_per: dict) -> dict:
+    """
+    Riga della griglia giacenze: per canale mostrato = stock attuale + prenotati.
+    """
+    vendor_pren  = int(pren_per.get("Amazon Vendor", 0))
+    sito_pren    = int(pren_per.get("Sito", 0))
+    seller_pren  = int(pren_per.get("Amazon Seller", 0))
+
+    vendor_show  = int(per_canale.get("Amazon Vendor", 0)) + vendor_pren
+    sito_show    = int(per_canale.get("Sito", 0)) + sito_pren
+    seller_show  = int(per_canale.get("Amazon Seller", 0)) + seller_pren
+
+    return {
+        "sku": sku,
+        "ean": ean,
+        "giacenza_totale": int(vendor_show + sito_show + seller_show),
+        "prenotati_totali": int(vendor_pren + sito_pren + seller_pren),
+        "vendor_qta": int(vendor_show),
+        "vendor_prenotati": int(vendor_pren),
+        "sito_qta": int(sito_show),
+        "sito_prenotati": int(sito_pren),
+        "seller_qta": int(seller_show),
+        "seller_prenotati": int(seller_pren),
+    }
+
+
+DISPONIBILITA_COLS = ("sku, ean, vendor_qty, sito_qty, seller_qty, "
+                      "vendor_prenotati, sito_prenotati, seller_prenotati")
+
+def _disponibilita_to_payload(r: dict) -> dict:
+    """Riga di magazzino_disponibilita (ean '' = assente) -> payload griglia."""
+    per_canale = {
+        "Amazon Vendor": int(r.get("vendor_qty") or 0),
+        "Sito": int(r.get("sito_qty") or 0),
+        "Amazon Seller": int(r.get("seller_qty") or 0),
+    }
+    pren_per = {
+        "Amazon Vendor": int(r.get("vendor_prenotati") or 0),
+        "Sito": int(r.get("sito_prenotati") or 0),
+        "Amazon Seller": int(r.get("seller_prenotati") or 0),
+    }
+    return _giacenza_payload(r.get("sku"), (r.get("ean") or None), per_canale, pren_per)
+
+
+def _read_disponibilita(sku: str | None = None, ean: str | None = None,
+                        q_text: str | None = None, offset: int = 0, limit: int = 50) -> list[dict]:
+    """
+    Legge la proiezione magazzino_disponibilita (giacenza + prenotati per canale,
+    mantenuta dai trigger DB) con UNA query paginata per (sku, ean).
+    Solleva l'eccezione di PostgREST se la tabella non esiste (-> fallback legacy).
+    """
+    q = sb_table("magazzino_disponibilita").select(DISPONIBILITA_COLS)
+    if sku:
+        q = q.eq("sku", sku).eq("ean", ean or "")
+        return supa_with_retry(lambda: q.limit(1).execute()).data or []
+    if q_text:
+        q = q.or_(f"sku.ilike.*{q_text}*,ean.ilike.*{q_text}*")
+    return supa_with_retry(
+        lambda: q.order("sku").order("ean").range(offset, offset + limit - 1).execute()
+    ).data or []
+
+# -----------------------------------------------------------------------------
+# Retarget in blocco della produzione su una nuova finestra di consegna
+# -----------------------------------------------------------------------------
+@bp.route('/api/amazon/vendor/produzione/retarget', methods=['POST'])
+def retarget_produzione_bulk():
+    """
+    Body: { start_delivery: "YYYY-MM-DD", items: [{ id, qty? }, ...] }  (qty assente = tutta la riga)
+    Una RPC retarget_qty_bulk (una transazione); fallback riga per riga se non deployata.
+    Ritorna { ok, moved_qty, moved: [{src_id, target_id, qty}], skipped: [id...] }.
+    """
+    try:
+        body = request.json or {}
+        new_date = str(body.get("start_delivery") or "").strip()[:10]
+        try:
+            datetime.strptime(new_date, "%Y-%m-%d")
+        except ValueError:
+            return jsonify({"error": "start_delivery non valida (YYYY-MM-DD)"}), 400
+        items = []
+        for it in (body.get("items") or []):
+            try:
+                sid = int(it["id"])
+                q = it.get("qty")
+                q = int(q) if q not in (None, "") else None
+            except (KeyError, TypeError, ValueError):
+                return jsonify({"error": "items non validi (id intero, qty intera opzionale)"}), 400
+            if q is not None and q <= 0:
+                return jsonify({"error": "qty deve essere > 0"}), 400
+            items.append({"src_id": sid, "qty": q})
+        if not items:
+            return jsonify({"error": "items richiesti"}), 400
+
+        user_label = _current_user_label()
+        try:
+            res = supa_with_retry(lambda: supabase.rpc("retarget_qty_bulk", {
+                "p_items": items, "p_new_date": new_date, "p_user_label": user_label,
+            }).execute())
+            out = res.data or {}
+            return jsonify({"ok": True, "moved_qty": int(out.get("moved_qty") or 0),
+                            "moved": out.get("moved") or [], "skipped": out.get("skipped") or []})
+        except APIError as ex:
+            if not is_missing_rpc(ex):
+                raise
+            logging.warning("[retarget_produzione_bulk] RPC retarget_qty_bulk assente, fallback: %s", ex)
+
+        moved, skipped, total = [], [], 0
+        rows = supa_with_retry(lambda: (
+            sb_table("produzione_vendor").select("id, da_produrre, start_delivery")
+            .in_("id", [i["src_id"] for i in items]).execute()
+        )).data or []
+        by_id = {int(r["id"]): r for r in rows}
+        for it in sorted(items, key=lambda i: i["src_id"]):
+            r = by_id.get(it["src_id"])
+            take = 0
+            if r and str(r.get("start_delivery") or "")[:10] != new_date:
+                avail = int(r.get("da_produrre") or 0)
+                take = min(avail, it["qty"] if it["qty"] is not None else avail)
+            tgt = _retarget_qty_to_date_legacy(it["src_id"], new_date, take, user_label) if take > 0 else None
+            if tgt:
+                moved.append({"src_id": it["src_id"], "target_id": tgt, "qty": take})
+                total += take
+            else:
+                skipped.append(it["src_id"])
+        return jsonify({"ok": True, "moved_qty": total, "moved": moved, "skipped": skipped})
+    except Exception as ex:
+        logging.exception("[retarget_produzione_bulk] errore")
+        return jsonify({"error": f"Errore retarget: {str(ex)}"}), 500
+
+
 @bp.route('/api/magazzino/giacenze', methods=['GET'])
 def api_magazzino_giacenze():
     try:
-        import json
         sku = (request.args.get("sku") or "").strip()
         ean = (request.args.get("ean") or "").strip()
         q_text = (request.args.get("q") or "").strip()
@@ -3060,9 +3765,21 @@ def api_magazzino_giacenze():
 
         # sanifica
         ean = ean.replace("%", "").replace(",", " ").strip() or None
+        q_text = q_text.replace("%", "").replace(",", " ").strip()
 
         # -------------------- BRANCH A: DETTAGLIO SKU/EAN --------------------
         if sku:
+            if mode == "esteso":
+                # proiezione disponibilità (1 riga); fallback legacy se non ancora migrata
+                try:
+                    rows = _read_disponibilita(sku=sku, ean=ean)
+                    if rows:
+                        return jsonify(_disponibilita_to_payload(rows[0])), 200
+                    return jsonify(_giacenza_payload(sku, ean, {}, {})), 200
+                except Exception as ex:
+                    if not is_missing_relation(ex):
+                        logging.warning(f"[giacenze estese] disponibilita det: {ex}")
+
             # Giacenze per canale
             q = sb_table("magazzino_giacenze").select("canale, qty").eq("sku", sku)
             if ean:
@@ -3081,38 +3798,25 @@ def api_magazzino_giacenze():
                 except Exception:
                     pass
 
+            if mode != "esteso":
+                return jsonify([{"canale": k, "qty": v} for k, v in per_canale.items()]), 200
+
             # Prenotati dai prelievi attivi (usa solo mag_usato_by_canale)
             keys = {(sku, ean)}
             pren_map = _read_prelievi_prenotati_per_canale(keys, supa_with_retry, sb_table)
-            pren_per = pren_map.get((sku, ean), {})
-
-            # Per canale: mostrato = stock attuale + prenotati di quel canale
-            vendor_pren  = int(pren_per.get("Amazon Vendor", 0))
-            sito_pren    = int(pren_per.get("Sito", 0))
-            seller_pren  = int(pren_per.get("Amazon Seller", 0))
-
-            vendor_show  = int(per_canale.get("Amazon Vendor", 0)) + vendor_pren
-            sito_show    = int(per_canale.get("Sito", 0)) + sito_pren
-            seller_show  = int(per_canale.get("Amazon Seller", 0)) + seller_pren
-
-            tot_show     = vendor_show + sito_show + seller_show
-            pren_tot     = vendor_pren + sito_pren + seller_pren
-
-            payload = {
-                "sku": sku,
-                "ean": ean,
-                "giacenza_totale": int(tot_show),
-                "prenotati_totali": int(pren_tot),
-                "vendor_qta": int(vendor_show),
-                "vendor_prenotati": int(vendor_pren),
-                "sito_qta": int(sito_show),
-                "sito_prenotati": int(sito_pren),
-                "seller_qta": int(seller_show),
-                "seller_prenotati": int(seller_pren),
-            }
-            return jsonify(payload if mode == "esteso" else [{"canale": k, "qty": v} for k, v in per_canale.items()]), 200
+            return jsonify(_giacenza_payload(sku, ean, per_canale, pren_map.get((sku, ean), {}))), 200
 
         # -------------------- BRANCH B: LIST MODE (pagina) -------------------
+        # Percorso principale: una sola query paginata sulla proiezione
+        try:
+            disp_rows = _read_disponibilita(q_text=q_text, offset=offset, limit=limit)
+            return jsonify([_disponibilita_to_payload(r) for r in disp_rows]), 200
+        except Exception as ex:
+            if not is_missing_relation(ex):
+                logging.warning(f"[giacenze estese] LIST disponibilita APIError: {ex}")
+                return jsonify([]), 200
+
+        # Fallback legacy: pagina su magazzino_giacenze + prenotati calcolati in Python
         base = sb_table("magazzino_giacenze").select("sku, ean, canale, qty")
         if q_text:
             base = base.or_(f"sku.ilike.*{q_text}*,ean.ilike.*{q_text}*")
@@ -3142,128 +3846,157 @@ def api_magazzino_giacenze():
         # Prenotati dai prelievi attivi per la pagina
         pren_map = _read_prelievi_prenotati_per_canale(keys, supa_with_retry, sb_table)
 
-        out = []
-        for (sku_i, ean_i) in keys:
-            per_canale = gi_map.get((sku_i, ean_i), {})
-            pren_per   = pren_map.get((sku_i, ean_i), {})
-
-            vendor_pren  = int(pren_per.get("Amazon Vendor", 0))
-            sito_pren    = int(pren_per.get("Sito", 0))
-            seller_pren  = int(pren_per.get("Amazon Seller", 0))
-
-            vendor_show  = int(per_canale.get("Amazon Vendor", 0)) + vendor_pren
-            sito_show    = int(per_canale.get("Sito", 0)) + sito_pren
-            seller_show  = int(per_canale.get("Amazon Seller", 0)) + seller_pren
-
-            tot_show     = vendor_show + sito_show + seller_show
-            pren_tot     = vendor_pren + sito_pren + seller_pren
-
-            out.append({
-                "sku": sku_i,
-                "ean": ean_i,
-                "giacenza_totale": int(tot_show),
-                "prenotati_totali": int(pren_tot),
-                "vendor_qta": int(vendor_show),
-                "vendor_prenotati": int(vendor_pren),
-                "sito_qta": int(sito_show),
-                "sito_prenotati": int(sito_pren),
-                "seller_qta": int(seller_show),
-                "seller_prenotati": int(seller_pren),
-            })
-
+        out = [
+            _giacenza_payload(sku_i, ean_i, gi_map.get((sku_i, ean_i), {}), pren_map.get((sku_i, ean_i), {}))
+            for (sku_i, ean_i) in keys
+        ]
         return jsonify(out), 200
 
     except Exception as ex:
         logging.exception("[api_magazzino_giacenze] errore")
         return jsonify({"error": str(ex)}), 500
     
-@bp.route('/api/magazzino/trasferisci', methods=['POST'])
-def api_magazzino_trasferisci():
-    try:
-        data = request.get_json(force=True) or {}
-        sku = (data.get("sku") or "").strip()
-        ean = (data.get("ean") or "").strip()
-        from_pool_raw = (data.get("from") or "").strip()
-        to_pool_raw = (data.get("to") or "").strip()
-        quantita = int(data.get("quantita") or 0)
-
-        if not sku or not ean:
-            return jsonify({"error": "sku e ean sono obbligatori"}), 400
-        if quantita <= 0:
-            return jsonify({"error": "quantita deve essere > 0"}), 400
-
-        # normalizza canali in ingresso
-        def canon(c: str) -> str:
-            c = (c or "").strip().lower()
-            if c in ("vendor", "amazon vendor"):        return "Amazon Vendor"
-            if c in ("sito", "shopify", "web"):         return "Sito"
-            if c in ("seller", "amazon seller"):        return "Amazon Seller"
-            return c.title()
-
-        from_pool = canon(from_pool_raw)
-        to_pool   = canon(to_pool_raw)
-
-        ALLOWED = {"Amazon Vendor", "Sito", "Amazon Seller"}
-        if from_pool not in ALLOWED or to_pool not in ALLOWED:
-            return jsonify({"error": "canale non valido (usa: Amazon Vendor | Sito | Amazon Seller)"}), 400
-        if from_pool == to_pool:
-            return jsonify({"error": "from e to devono essere diversi"}), 400
-
-        # helper lettura qty: se riga manca => 0 (usa maybe_single)
-        def read_qty(canale: str) -> int:
-            res = supa_with_retry(lambda:
-                sb_table("magazzino_giacenze")
-                .select("qty")
-                .eq("sku", sku)
-                .eq("ean", ean)
-                .eq("canale", canale)
-                .maybe_single()              # <— evita 406 PGRST116
-                .execute()
-            )
-            row = res.data or {}
-            try:
-                return int(row.get("qty") or 0)
-            except Exception:
-                return 0
+MAGAZZINO_CANALI = ("Amazon Vendor", "Sito", "Amazon Seller")
 
-        from_qty = read_qty(from_pool)
-        if quantita > from_qty:
-            return jsonify({
-                "error": f"quantita oltre disponibile nel pool '{from_pool}'",
-                "disponibile": from_qty
-            }), 409
+def _canon_pool(c: str) -> str:
+    """Normalizza il canale passato dal frontend (vendor/sito/seller...)."""
+    c = (c or "").strip().lower()
+    if c in ("vendor", "amazon vendor"):        return "Amazon Vendor"
+    if c in ("sito", "shopify", "web"):         return "Sito"
+    if c in ("seller", "amazon seller"):        return "Amazon Seller"
+    return c.title()
 
-        to_qty   = read_qty(to_pool)
 
-        # aggiorna origine (upsert) e destinazione (upsert)
-        supa_with_retry(lambda:
-            sb_table("magazzino_giacenze")
-            .upsert({"sku": sku, "ean": ean, "canale": from_pool, "qty": from_qty - quantita})
-            .execute()
-        )
-        supa_with_retry(lambda:
+def _parse_trasferimento(data: dict) -> dict:
+    """Valida un trasferimento {sku, ean, from, to, quantita|qty}; ValueError se non valido."""
+    sku = (data.get("sku") or "").strip()
+    ean = (data.get("ean") or "").strip()
+    try:
+        quantita = int(data.get("quantita") if data.get("quantita") is not None else (data.get("qty") or 0))
+    except (TypeError, ValueError):
+        raise ValueError("quantita non valida")
+    from_pool = _canon_pool(data.get("from"))
+    to_pool = _canon_pool(data.get("to"))
+
+    if not sku or not ean:
+        raise ValueError("sku e ean sono obbligatori")
+    if quantita <= 0:
+        raise ValueError("quantita deve essere > 0")
+    if from_pool not in MAGAZZINO_CANALI or to_pool not in MAGAZZINO_CANALI:
+        raise ValueError("canale non valido (usa: Amazon Vendor | Sito | Amazon Seller)")
+    if from_pool == to_pool:
+        raise ValueError("from e to devono essere diversi")
+    return {"sku": sku, "ean": ean, "from": from_pool, "to": to_pool, "qty": quantita}
+
+
+def _trasferisci_legacy(t: dict) -> dict:
+    """
+    Fallback non transazionale (RPC magazzino_trasferisci non deployata):
+    read -> check -> upsert origine/destinazione -> log.
+    """
+    sku, ean, from_pool, to_pool, quantita = t["sku"], t["ean"], t["from"], t["to"], t["qty"]
+
+    def read_qty(canale: str) -> int:
+        res = supa_with_retry(lambda:
             sb_table("magazzino_giacenze")
-            .upsert({"sku": sku, "ean": ean, "canale": to_pool, "qty": to_qty + quantita})
+            .select("qty")
+            .eq("sku", sku)
+            .eq("ean", ean)
+            .eq("canale", canale)
+            .maybe_single()              # <— evita 406 PGRST116
             .execute()
         )
+        row = (res.data if res else None) or {}
+        try:
+            return int(row.get("qty") or 0)
+        except Exception:
+            return 0
 
-        # log movimento
-        supa_with_retry(lambda:
-            sb_table("magazzino_movimenti")
-            .insert({
-                "sku": sku,
-                "ean": ean,
-                "canale": f"{from_pool}->{to_pool}",
-                "qty": quantita,
-                "motivo": "trasferimento_manual",
-            })
-            .execute()
-        )
+    from_qty = read_qty(from_pool)
+    if quantita > from_qty:
+        raise LookupError(f"quantita oltre disponibile nel pool '{from_pool}'", from_qty)
+    to_qty = read_qty(to_pool)
+
+    supa_with_retry(lambda:
+        sb_table("magazzino_giacenze")
+        .upsert({"sku": sku, "ean": ean, "canale": from_pool, "qty": from_qty - quantita})
+        .execute()
+    )
+    supa_with_retry(lambda:
+        sb_table("magazzino_giacenze")
+        .upsert({"sku": sku, "ean": ean, "canale": to_pool, "qty": to_qty + quantita})
+        .execute()
+    )
+    supa_with_retry(lambda:
+        sb_table("magazzino_movimenti")
+        .insert({
+            "sku": sku,
+            "ean": ean,
+            "canale": f"{from_pool}->{to_pool}",
+            "qty": quantita,
+            "motivo": "trasferimento_manual",
+        })
+        .execute()
+    )
+    return {**t, "from_qty": from_qty - quantita, "to_qty": to_qty + quantita}
 
+
+@bp.route('/api/magazzino/trasferisci', methods=['POST'])
+def api_magazzino_trasferisci():
+    """
+    Trasferimento di giacenza tra canali, atomico via RPC magazzino_trasferisci.
+    Body singolo: { sku, ean, from, to, quantita }
+    Body bulk:    { items: [{ sku, ean, from, to, quantita }, ...] }  (tutto o niente)
+    Senza RPC (fallback legacy non transazionale) il bulk con più item risponde 501.
+    """
+    try:
+        data = request.get_json(force=True) or {}
+        bulk = isinstance(data.get("items"), list)
+        raw_items = data["items"] if bulk else [data]
+        if not raw_items:
+            return jsonify({"error": "items vuoto"}), 400
+        try:
+            items = [_parse_trasferimento(it or {}) for it in raw_items]
+        except ValueError as ve:
+            return jsonify({"error": str(ve)}), 400
+
+        try:
+            res = supa_with_retry(lambda: supabase.rpc("magazzino_trasferisci", {"p_items": items}).execute())
+            results = res.data or []
+        except APIError as ex:
+            if is_missing_rpc(ex):
+                if len(items) > 1:
+                    # il fallback applica un item alla volta: il "tutto o niente" del bulk non è garantito
+                    return jsonify({"error": "trasferimento multiplo non disponibile: "
+                                             "RPC magazzino_trasferisci non deployata"}), 501
+                logging.warning("[api_magazzino_trasferisci] RPC assente, fallback legacy: %s", ex)
+                results = []
+                try:
+                    for t in items:
+                        results.append(_trasferisci_legacy(t))
+                except LookupError as le:
+                    return jsonify({"error": le.args[0], "disponibile": le.args[1], "done": results}), 409
+            else:
+                message = getattr(ex, "message", None) or str(ex)
+                if getattr(ex, "code", None) == "P0001":
+                    if "oltre il disponibile" not in message:
+                        return jsonify({"error": message}), 400
+                    # detail JSON della RPC: {sku, ean, from, disponibile}
+                    try:
+                        detail = json.loads(getattr(ex, "details", None) or "{}")
+                    except ValueError:
+                        detail = {}
+                    return jsonify({"error": message, "disponibile": detail.get("disponibile"),
+                                    "sku": detail.get("sku"), "done": []}), 409
+                raise
+
+        if bulk:
+            return jsonify({"ok": True, "results": results}), 200
+        r = results[0] if results else {}
         return jsonify({
             "ok": True,
-            "from": {"canale": from_pool, "qty": from_qty - quantita},
-            "to": {"canale": to_pool, "qty": to_qty + quantita}
+            "from": {"canale": r.get("from"), "qty": r.get("from_qty")},
+            "to": {"canale": r.get("to"), "qty": r.get("to_qty")}
         }), 200
 
     except Exception as ex:
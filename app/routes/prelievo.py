@@ -8,6 +8,7 @@ from app.services.prelievo_service import (
     date_importabili,
     importa_prelievi_da_data,
     lista_prelievi,
+    lista_prelievi_pagina,
     aggiorna_prelievo,
     aggiorna_prelievi_bulk,
     svuota_prelievi,
@@ -37,8 +38,8 @@ def post_importa():
         data = (request.json or {}).get("data")
         if not data:
             return jsonify({"error": "Data richiesta"}), 400
-        importa_prelievi_da_data(data)
-        return jsonify({"ok": True})
+        report = importa_prelievi_da_data(data)
+        return jsonify(report)
     except Exception as ex:
         logging.exception("[post_importa] errore import prelievi")
         return jsonify({"error": str(ex)}), 500
@@ -59,6 +60,33 @@ def get_prelievi():
         return jsonify({"error": str(ex)}), 500
 
 
+# ------------------------------------------------------------
+# Lista prelievi paginata (keyset) con proiezione e ETag
+# Query: data, radice, stato (csv), canale, fields (csv), cursor, limit
+# ------------------------------------------------------------
+@bp.route('/api/prelievi/page', methods=['GET'])
+def get_prelievi_page():
+    try:
+        out = lista_prelievi_pagina(
+            data=request.args.get("data"),
+            radice=request.args.get("radice"),
+            stato=request.args.get("stato"),
+            canale=request.args.get("canale"),
+            fields=request.args.get("fields"),
+            cursor=request.args.get("cursor"),
+            limit=request.args.get("limit"),
+        )
+        resp = jsonify(out)
+        # ETag sul contenuto: se la pagina non è cambiata il client riceve 304 senza body
+        resp.add_etag()
+        return resp.make_conditional(request)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as ex:
+        logging.exception("[get_prelievi_page] errore lista paginata")
+        return jsonify({"error": str(ex)}), 500
+
+
 # ------------------------------------------------------------
 # Patch singolo prelievo
 # ------------------------------------------------------------
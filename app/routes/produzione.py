@@ -4,18 +4,24 @@
 from __future__ import annotations
 
 # Flask
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, Response, g
 
 # Stdlib
+import os
+import time
 import logging
 import json
-import time
+import re
+import base64
+import hashlib
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from bisect import bisect_left
 from typing import Any, Dict, List, Optional, Tuple
 from postgrest.exceptions import APIError
-from app.common.supa_retry import supa_with_retry
+from app.common.supa_retry import supa_with_retry, is_missing_rpc
+from app.common.log_sink import BufferedLogSink
 # Supabase client (come nel tuo progetto)
 from app.supabase_client import supabase
 from app import supabase_client  # per note_success / reset
@@ -29,48 +35,49 @@ bp = Blueprint("produzione", __name__)
 # Helper & Utilities
 # =============================================================================
 
+_UTENTI_SISTEMA = ("", "postgres", "postgrest", "supabase", "sistema")
+
+
+def _log_dt(l: dict) -> Optional[datetime]:
+    try:
+        dt = datetime.fromisoformat(str(l.get("created_at")).replace("Z", "+00:00"))
+    except Exception:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
 def _coalesce_logs(logs, window_seconds=3):
     """
     Deduplica i trigger tecnici a ridosso di un'azione umana.
     Regola: se entro 'window_seconds' c'è un log dell'operatore
     che descrive la stessa azione, nascondi il Trigger INSERT/UPDATE.
+    Le azioni umane sono indicizzate per (sku, ean, stato_nuovo, qty_nuova) con
+    timestamp ordinati: ogni trigger fa una bisect invece di scorrerle tutte.
     """
-    out = []
-    # indicizza per (sku, ean, stato_nuovo, qty_nuova) entro la finestra
-    human_events = []
+    # indicizza per (sku, ean, stato_nuovo, qty_nuova) -> istanti ordinati
+    human_events: Dict[tuple, List[float]] = defaultdict(list)
     for l in logs:
-        when = None
-        try:
-            when = datetime.fromisoformat(str(l.get("created_at")).replace("Z", "+00:00"))
-        except Exception:
-            pass
-        l["_dt"] = when
-        is_human = (l.get("utente") or "").strip().lower() not in ("", "postgres", "postgrest", "supabase", "sistema")
-        if is_human:
-            human_events.append(l)
+        is_human = (l.get("utente") or "").strip().lower() not in _UTENTI_SISTEMA
+        dt = _log_dt(l)
+        if is_human and dt:
+            key = (l.get("sku"), l.get("ean"), l.get("stato_nuovo"), l.get("qty_nuova"))
+            human_events[key].append(dt.timestamp())
+    for ts in human_events.values():
+        ts.sort()
 
+    out = []
     for l in logs:
-        motivo_low = (l.get("motivo") or "").strip().lower()
-        if motivo_low.startswith("trigger"):
-            # cerca human match nella finestra temporale
-            dt = l.get("_dt")
+        if (l.get("motivo") or "").strip().lower().startswith("trigger"):
+            dt = _log_dt(l)
             if dt:
-                for h in human_events:
-                    if h.get("sku")==l.get("sku") and h.get("ean")==l.get("ean"):
-                        if h.get("stato_nuovo")==l.get("stato_nuovo") and h.get("qty_nuova")==l.get("qty_nuova"):
-                            hdt = h.get("_dt")
-                            if hdt and abs((hdt - dt).total_seconds()) <= window_seconds:
-                                # drop questo trigger
-                                break
-                else:
-                    out.append(l)
-            else:
-                out.append(l)
-        else:
-            out.append(l)
-    # pulizia
-    for l in out:
-        l.pop("_dt", None)
+                ts = human_events.get((l.get("sku"), l.get("ean"), l.get("stato_nuovo"), l.get("qty_nuova")))
+                if ts:
+                    t = dt.timestamp()
+                    k = bisect_left(ts, t - window_seconds)
+                    if k < len(ts) and ts[k] <= t + window_seconds:
+                        # drop questo trigger
+                        continue
+        out.append(l)
     return out
 
 def sb_table(name: str):
@@ -153,6 +160,37 @@ def _is_fk_error(ex: Exception) -> bool:
         return False
     
     
+def _insert_movimenti(rows: list) -> None:
+    supa_with_retry(lambda: sb_table("movimenti_produzione_vendor").insert(rows).execute())
+
+
+def _insert_movimento(payload: dict) -> None:
+    """Insert singolo con paracadute FK (riga produzione già cancellata)."""
+    try:
+        _insert_movimenti([payload])
+    except Exception as ex:
+        if not _is_fk_error(ex):
+            raise
+        payload2 = dict(payload); payload2["produzione_id"] = None
+        det2 = dict(payload2.get("dettaglio") or {}); det2["_fk_fallback"] = True
+        det2["_missing_produzione_id"] = payload.get("produzione_id")
+        payload2["dettaglio"] = det2
+        _insert_movimenti([payload2])
+
+
+# log scritti a blocchi da un thread di background (vedi app/common/log_sink.py)
+movimenti_sink = BufferedLogSink("movimenti_produzione", _insert_movimenti, _insert_movimento)
+
+
+@bp.teardown_request
+def _flush_movimenti_a_fine_richiesta(exc=None):
+    if movimenti_sink.mode == "request":
+        try:
+            movimenti_sink.flush()
+        except Exception as ex:
+            logging.warning(f"[log_movimento_produzione] flush fine richiesta fallito: {ex}")
+
+
 def log_movimento_produzione(row, utente, motivo,
                              stato_vecchio=None, stato_nuovo=None,
                              qty_vecchia=None, qty_nuova=None,
@@ -176,22 +214,14 @@ def log_movimento_produzione(row, utente, motivo,
         "plus_nuovo": plus_nuovo,                  # <—
         "motivo": motivo,
         "utente": utente,
-        "dettaglio": det
+        "dettaglio": det,
+        # timestamp dell'evento, non del flush (la coalescenza dei log lavora a secondi)
+        "created_at": datetime.now(timezone.utc).isoformat(),
     }
 
     try:
-        supa_with_retry(lambda: sb_table("movimenti_produzione_vendor").insert(payload).execute())
+        movimenti_sink.write(payload)
     except Exception as ex:
-        if _is_fk_error(ex):
-            payload2 = dict(payload); payload2["produzione_id"] = None
-            det2 = dict(payload2.get("dettaglio") or {}); det2["_fk_fallback"] = True
-            det2["_missing_produzione_id"] = payload.get("produzione_id")
-            payload2["dettaglio"] = det2
-            try:
-                supa_with_retry(lambda: sb_table("movimenti_produzione_vendor").insert(payload2).execute())
-                return
-            except Exception as ex2:
-                logging.warning(f"[log_movimento_produzione] fallback FK fallito: {ex2}")
         logging.warning(f"[log_movimento_produzione] errore log: {ex}")
 
 
@@ -229,49 +259,216 @@ def log_unified_edges(produzione_id: int):
 # -----------------------------------------------------------------------------
 # Lista produzione + badge
 # -----------------------------------------------------------------------------
+BADGE_CACHE_SECONDS = float(os.getenv("BADGE_CACHE_SECONDS", "5"))
+_badge_cache = {"at": 0.0, "version": None, "data": None}
+
+
+def _badge_produzione(version: Any = None) -> Tuple[Dict[str, int], Dict[str, int], Dict[str, int]]:
+    """
+    Badge (stati, radici, canali) della produzione.
+    Count raggruppato lato DB (RPC badge_counters_get, una chiamata), in cache
+    BADGE_CACHE_SECONDS tra le liste; se non disponibile ricade sull'aggregazione
+    Python dell'intera tabella. Con la versione della tabella (ETag) la cache vale
+    solo per la stessa versione: una risposta con ETag nuovo non porta badge vecchi.
+    """
+    now = time.monotonic()
+    if (_badge_cache["data"] is not None and _badge_cache["version"] == version
+            and now - _badge_cache["at"] < BADGE_CACHE_SECONDS):
+        return tuple(dict(d) for d in _badge_cache["data"])
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("badge_counters_get", {"p_scope": "produzione"}).execute())
+        dims = (res.data or {}).get("produzione") or {}
+        data = (
+            {k: int(v) for k, v in (dims.get("stato_produzione") or {}).items()},
+            {k: int(v) for k, v in (dims.get("radice") or {}).items()},
+            {k: int(v) for k, v in (dims.get("canale") or {}).items()},
+        )
+        _badge_cache.update(at=now, version=version, data=data)
+        return tuple(dict(d) for d in data)
+    except Exception as ex:
+        logging.warning(f"[lista_produzione] conteggio aggregato non disponibile, fallback: {ex}")
+
+    all_rows = supa_with_retry(lambda: (
+        sb_table("produzione_vendor").select("stato_produzione,radice,canale").execute()
+    )).data
+
+    badge_stati, badge_radici, badge_canali = {}, {}, {}
+    for r in (all_rows or []):
+        s = r.get("stato_produzione") or "Da Stampare"
+        badge_stati[s] = badge_stati.get(s, 0) + 1
+        rd = r.get("radice") or "?"
+        badge_radici[rd] = badge_radici.get(rd, 0) + 1
+        c = r.get("canale") or "?"
+        badge_canali[c] = badge_canali.get(c, 0) + 1
+    return badge_stati, badge_radici, badge_canali
+
+
+PRODUZIONE_PAGE_LIMIT_MAX = 1000
+PRODUZIONE_KEYSET_COLS = ("id", "start_delivery", "sku")
+_FIELD_RE = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def _pack_cursor(values: list) -> str:
+    raw = json.dumps(values, default=str)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _unpack_cursor(cursor: str) -> list:
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except Exception:
+        raise ValueError("cursor non valido")
+
+
+def _encode_cursor(row: dict) -> str:
+    return _pack_cursor([row.get("start_delivery"), row.get("sku"), row["id"]])
+
+
+def _decode_cursor(cursor: str) -> Tuple[Optional[str], str, int]:
+    try:
+        d, s, i = _unpack_cursor(cursor)
+        return (str(d) if d is not None else None), str(s or ""), int(i)
+    except Exception:
+        raise ValueError("cursor non valido")
+
+
+def _pg_quote(v: str) -> str:
+    # valori dentro or=(...) di PostgREST: virgolette per virgole/parentesi nello SKU
+    return '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _keyset_after(cursor: str) -> str:
+    """Filtro or_ per le righe successive a (start_delivery, sku, id) con start_delivery NULLS FIRST."""
+    d, s, i = _decode_cursor(cursor)
+    sq = _pg_quote(s)
+    if d is None:
+        return (f"start_delivery.not.is.null,"
+                f"and(start_delivery.is.null,sku.gt.{sq}),"
+                f"and(start_delivery.is.null,sku.eq.{sq},id.gt.{i})")
+    return (f"start_delivery.gt.{d},"
+            f"and(start_delivery.eq.{d},sku.gt.{sq}),"
+            f"and(start_delivery.eq.{d},sku.eq.{sq},id.gt.{i})")
+
+
+def _produzione_version() -> Any:
+    """
+    Versione della tabella (contatore incrementato al commit di ogni transazione che
+    la modifica). None se non disponibile (migrazione non applicata).
+    """
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("produzione_vendor_version_get", {}).execute())
+    except Exception as ex:
+        logging.warning(f"[lista_produzione] versione non disponibile, ETag sul contenuto: {ex}")
+        return None
+    return res.data
+
+
+def _produzione_etag(version: Any) -> Optional[str]:
+    """ETag della lista senza rileggere le righe: versione della tabella + parametri della richiesta."""
+    if version is None:
+        return None
+    args = sorted(request.args.items(multi=True))
+    key = json.dumps([version, args], default=str)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _filtra_produzione(query, stato, radice, canale, search):
+    """Filtri della lista (stessi per le righe e per il totale)."""
+    if stato:
+        query = query.eq("stato_produzione", stato)
+    if radice:
+        query = query.eq("radice", radice)
+    if canale:
+        query = query.eq("canale", canale)
+    if search:
+        s = search.replace("%", "").replace(",", " ").strip()
+        star = f"%{s}%"
+        query = query.or_(f"sku.ilike.{star},ean.ilike.{star}")
+    return query
+
+
 @bp.route('/api/produzione', methods=['GET'])
 def lista_produzione():
-    
+    """
+    Lista produzione.
+    Query: stato_produzione, radice, canale, search, fields (csv), limit, cursor.
+    Con limit/cursor la lista è paginata keyset su (start_delivery, sku, id) e la
+    risposta include next_cursor; senza, ritorna tutte le righe come prima.
+    Supporta If-None-Match (304 senza interrogare le righe se nulla è cambiato).
+    """
     try:
         stato = request.args.get("stato_produzione")
         radice = request.args.get("radice")
         search = request.args.get("search", "").strip()
         canale = request.args.get("canale")  # NEW
+        cursor = (request.args.get("cursor") or "").strip()
+        limit_arg = (request.args.get("limit") or "").strip()
 
-        query = sb_table("produzione_vendor").select("*")
-        if stato:
-            query = query.eq("stato_produzione", stato)
-        if radice:
-            query = query.eq("radice", radice)
-        if canale:
-            query = query.eq("canale", canale)  # NEW
-        if search:
-            s = search.replace("%", "").replace(",", " ").strip()
-            star = f"%{s}%"
-            query = query.or_(f"sku.ilike.{star},ean.ilike.{star}")
-        query = query.order("start_delivery", desc=False, nullsfirst=True).order("sku")
-        rows = supa_with_retry(lambda: query.execute()).data
-
-        all_rows = supa_with_retry(lambda: (
-            sb_table("produzione_vendor").select("stato_produzione,radice,canale").execute()
-        )).data
+        cols = [f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()]
+        bad = [c for c in cols if not _FIELD_RE.match(c)]
+        if bad:
+            return jsonify({"error": f"Campi non validi: {', '.join(bad)}"}), 400
+        select = ",".join(dict.fromkeys([*PRODUZIONE_KEYSET_COLS, *cols])) if cols else "*"
+
+        limit = None
+        if limit_arg or cursor:
+            try:
+                limit = int(limit_arg) if limit_arg else 200
+            except ValueError:
+                return jsonify({"error": "limit non valido"}), 400
+            if limit <= 0:
+                return jsonify({"error": "limit non valido (>0)"}), 400
+            limit = min(limit, PRODUZIONE_PAGE_LIMIT_MAX)
+
+        version = _produzione_version()
+        etag = _produzione_etag(version)
+        if etag and request.if_none_match.contains(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag)
+            return resp
+
+        badge_stati, badge_radici, badge_canali = _badge_produzione(version)
+
+        filtri = (stato, radice, canale, search)
+        if any(filtri):
+            # totale delle righe che rispettano i filtri (non dell'intera tabella)
+            total = supa_with_retry(lambda: _filtra_produzione(
+                sb_table("produzione_vendor").select("id", count="exact", head=True), *filtri
+            ).execute()).count or 0
+        else:
+            total = sum(badge_stati.values())
 
-        badge_stati, badge_radici, badge_canali = {}, {}, {}
-        for r in (all_rows or []):
-            s = r.get("stato_produzione", "Da Stampare")
-            badge_stati[s] = badge_stati.get(s, 0) + 1
-            rd = r.get("radice") or "?"
-            badge_radici[rd] = badge_radici.get(rd, 0) + 1
-            c = r.get("canale") or "?"
-            badge_canali[c] = badge_canali.get(c, 0) + 1
-
-        return jsonify({
-            "data": rows or [],
+        query = _filtra_produzione(sb_table("produzione_vendor").select(select), *filtri)
+        if cursor:
+            try:
+                query = query.or_(_keyset_after(cursor))
+            except ValueError as ve:
+                return jsonify({"error": str(ve)}), 400
+        query = query.order("start_delivery", desc=False, nullsfirst=True).order("sku").order("id")
+        if limit is not None:
+            # una riga in più per sapere se esiste la pagina successiva
+            query = query.limit(limit + 1)
+        rows = supa_with_retry(lambda: query.execute()).data or []
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = _encode_cursor(rows[-1])
+
+        resp = jsonify({
+            "data": rows,
+            "next_cursor": next_cursor,
+            "total": total,
             "badge_stati": badge_stati,
             "badge_radici": badge_radici,
             "badge_canali": badge_canali,
-            "all_radici": sorted(set(r.get("radice") for r in (all_rows or []) if r.get("radice")))
+            "all_radici": sorted(k for k in badge_radici if k != "?")
         })
+        if etag:
+            resp.set_etag(etag)
+        else:
+            resp.add_etag()
+        return resp.make_conditional(request)
     except Exception as ex:
         logging.exception("[lista_produzione] Errore nella GET produzione")
         return jsonify({"error": f"Errore: {str(ex)}"}), 500
@@ -393,6 +590,22 @@ def patch_produzione_bulk():
 
         # CASO 2: cambio stato -> usa MERGE (niente update in-place che collide con l’unico)
         to_state = update_fields["stato_produzione"]
+        other_updates = {k: v for k, v in update_fields.items() if k != "stato_produzione"}
+
+        # merge/cancellazione/log di tutte le righe in una transazione (RPC)
+        try:
+            res = supa_with_retry(lambda: supabase.rpc("produzione_move_bulk", {
+                "p_moves": [{"from_id": i, "to_state": to_state} for i in ids],
+                "p_fields": other_updates,
+                "p_user_label": utente,
+            }).execute())
+            report = res.data or {}
+            return jsonify({"ok": True, "moved_qty": int(report.get("moved_qty") or 0)})
+        except Exception as ex:
+            if not is_missing_rpc(ex):
+                raise
+            logging.warning(f"[patch_produzione_bulk] RPC produzione_move_bulk assente, fallback: {ex}")
+
         rows = supa_with_retry(lambda: (
             sb_table("produzione_vendor").select("*").in_("id", ids).execute()
         )).data or []
@@ -401,9 +614,9 @@ def patch_produzione_bulk():
         for r in rows:
             q = int(r.get("da_produrre") or 0)
 
-            # se non c'è quantità, applica solo eventuali altri campi (es. plus/note) e continua
-            other_updates = {k: v for k, v in update_fields.items() if k != "stato_produzione"}
-            if q <= 0:
+            # se non c'è quantità (o la riga è già nello stato), applica solo eventuali
+            # altri campi (es. plus/note) e continua: come la RPC, niente merge su sé stessa
+            if q <= 0 or r.get("stato_produzione") == to_state:
                 if other_updates:
                     supa_with_retry(lambda: (
                         sb_table("produzione_vendor").update(other_updates).eq("id", r["id"]).execute()
@@ -477,83 +690,191 @@ def get_produzione_by_id(id):
 # -----------------------------------------------------------------------------
 # Log storico di una riga produzione
 # -----------------------------------------------------------------------------
-@bp.route('/api/produzione/<int:id>/log', methods=['GET'])
-def get_log_movimenti(id):
-    try:
-        logs = supa_with_retry(lambda: (
-            sb_table("movimenti_produzione_vendor")
-            .select("*")
-            .eq("produzione_id", id)
-            .order("created_at", desc=True)
+def _canale_da_log(l: dict) -> Optional[str]:
+    """Canale scritto nel log (colonna o meta/dettaglio JSON), senza query."""
+    c = l.get("canale")
+    if c:
+        return c
+    for k in ("meta", "dettaglio"):
+        raw = l.get(k)
+        if isinstance(raw, dict) and raw.get("canale"):
+            return raw["canale"]
+        if isinstance(raw, str):
+            try:
+                j = json.loads(raw)
+                if j.get("canale"):
+                    return j["canale"]
+            except Exception:
+                pass
+    return None
+
+
+def _log_key(l: dict) -> Tuple[Any, Any, Optional[str]]:
+    sd = l.get("start_delivery")
+    return (l.get("sku"), l.get("ean"), str(sd)[:10] if sd else None)
+
+
+def _risolvi_canali(logs: List[dict]) -> None:
+    """
+    Valorizza canale_label su ogni log.
+    I log senza canale (storici, prima del trigger in scrittura) vengono risolti con
+    UNA query su produzione_vendor per tutti gli SKU mancanti; la prima riga per id
+    compatibile con (sku, ean, start_delivery) vince, come nella vecchia lookup per riga.
+    Memo sulla richiesta (flask.g) per non ripetere la query.
+    """
+    memo = g.setdefault("_canale_memo", {})
+    missing = set()
+    for l in logs:
+        c = _canale_da_log(l)
+        l["canale_label"] = c
+        if c is None and _log_key(l) not in memo:
+            missing.add(_log_key(l))
+
+    skus = sorted({k[0] for k in missing if k[0] is not None})
+    if skus:
+        rows = supa_with_retry(lambda: (
+            sb_table("produzione_vendor")
+            .select("id, sku, ean, start_delivery, canale")
+            .in_("sku", skus)
+            .order("id")
             .execute()
         )).data or []
+        for r in rows:
+            memo.setdefault(_log_key(r), r.get("canale"))
+    for k in missing:
+        memo.setdefault(k, None)
 
-        # arricchisci canale / etichette user-friendly
-        def _canale_label(l):
-            # 1) se già presente in riga
-            c = l.get("canale")
-            if c: return c
-            # 2) prova da meta/dettaglio JSON
-            for k in ("meta", "dettaglio"):
-                raw = l.get(k)
-                if isinstance(raw, dict) and raw.get("canale"):
-                    return raw["canale"]
-                if isinstance(raw, str):
-                    try:
-                        j = json.loads(raw)
-                        if j.get("canale"):
-                            return j["canale"]
-                    except Exception:
-                        pass
-            # 3) fallback: prendo una riga produzione compatibile
-            q = sb_table("produzione_vendor").select("canale").eq("sku", l.get("sku"))
-            q = _eq_or_is_null(q, "ean", l.get("ean"))
-            q = _eq_or_is_null(q, "start_delivery", l.get("start_delivery"))
-            r = supa_with_retry(lambda: q.order("id").limit(1).execute()).data or []
-            return (r[0]["canale"] if r else None)
-
-        def _humanize(l):
-            motivo_raw = (l.get("motivo") or "").strip()
-            motivo_low = motivo_raw.lower()
-            if motivo_low.startswith("trigger insert"):
-                motivo = "Creazione riga (sistema)"
-            elif motivo_low.startswith("trigger update"):
-                motivo = "Aggiornamento automatico (sistema)"
-            else:
-                motivo = motivo_raw or "Aggiornamento"
-
-            utente = (l.get("utente") or "").strip()
-            if not utente or utente.lower() in ("postgres","postgrest","supabase"):
-                utente = "Sistema"
-
-            l["motivo"] = motivo
-            l["utente"] = utente
-            l["canale_label"] = _canale_label(l)
-            return l
-
-        logs = [_humanize(l) for l in logs]
-
-        # dedupe: se esiste "Inserimento manuale" nello stesso secondo e stesso stato/qty,
-        # nascondi "Creazione riga (sistema)"
-        seen_keys = set()
-        out = []
-        for l in logs:
-            ts = l.get("created_at")
-            sec = int(datetime.fromisoformat(str(ts).replace("Z","+00:00")).timestamp()) if ts else 0
-            key = (sec, l.get("stato_nuovo"), l.get("qty_nuova"))
-
-            if l.get("motivo") == "Inserimento manuale":
-                seen_keys.add(key)
-                out.append(l)
-                continue
+    for l in logs:
+        if l["canale_label"] is None:
+            l["canale_label"] = memo.get(_log_key(l))
+
+
+LOG_COALESCE_WINDOW_SECONDS = 3
+LOG_PAGE_LIMIT_MAX = 500
 
-            if l.get("motivo") == "Creazione riga (sistema)" and key in seen_keys:
-                # salta il trigger duplicato
-                continue
 
-            out.append(l)
+def _humanize_log(l: dict) -> dict:
+    motivo_raw = (l.get("motivo") or "").strip()
+    motivo_low = motivo_raw.lower()
+    if motivo_low.startswith("trigger insert"):
+        motivo = "Creazione riga (sistema)"
+    elif motivo_low.startswith("trigger update"):
+        motivo = "Aggiornamento automatico (sistema)"
+    else:
+        motivo = motivo_raw or "Aggiornamento"
 
-        return jsonify(_coalesce_logs(out, window_seconds=3))
+    utente = (l.get("utente") or "").strip()
+    if not utente or utente.lower() in ("postgres","postgrest","supabase"):
+        utente = "Sistema"
+
+    l["motivo"] = motivo
+    l["utente"] = utente
+    return l
+
+
+def _dedup_inserimenti(logs: List[dict]) -> List[dict]:
+    """
+    Se esiste "Inserimento manuale" nello stesso secondo e stesso stato/qty,
+    nasconde "Creazione riga (sistema)" (indipendente dall'ordine dei log).
+    """
+    def _key(l):
+        dt = _log_dt(l)
+        return (int(dt.timestamp()) if dt else 0, l.get("stato_nuovo"), l.get("qty_nuova"))
+
+    manuali = {_key(l) for l in logs if l.get("motivo") == "Inserimento manuale"}
+    return [l for l in logs
+            if not (l.get("motivo") == "Creazione riga (sistema)" and _key(l) in manuali)]
+
+
+def _log_page(produzione_id: int, before: str, limit: int) -> Tuple[List[dict], List[dict], Optional[str]]:
+    """
+    Pagina di log (created_at desc, id desc) precedente al cursore 'before'.
+    Ritorna (pagina, contesto, next_before): il contesto sono i log entro la finestra di
+    coalescenza ai bordi della pagina, servono solo per la deduplica.
+    """
+    q = (sb_table("movimenti_produzione_vendor").select("*")
+         .eq("produzione_id", produzione_id))
+    if before:
+        try:
+            b_ts, b_id = _unpack_cursor(before)
+            b_id = int(b_id)
+        except Exception:
+            raise ValueError("cursor non valido")
+        bq = _pg_quote(b_ts)
+        q = q.or_(f"created_at.lt.{bq},and(created_at.eq.{bq},id.lt.{b_id})")
+    rows = supa_with_retry(lambda: (
+        q.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    )).data or []
+
+    next_before = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before = _pack_cursor([rows[-1].get("created_at"), rows[-1]["id"]])
+
+    dts = [d for d in (_log_dt(l) for l in rows) if d]
+    context: List[dict] = []
+    if dts:
+        w = timedelta(seconds=LOG_COALESCE_WINDOW_SECONDS)
+        ids = {l["id"] for l in rows}
+        ctx = supa_with_retry(lambda: (
+            sb_table("movimenti_produzione_vendor").select("*")
+            .eq("produzione_id", produzione_id)
+            .gte("created_at", (min(dts) - w).isoformat())
+            .lte("created_at", (max(dts) + w).isoformat())
+            .execute()
+        )).data or []
+        context = [l for l in ctx if l.get("id") not in ids]
+    return rows, context, next_before
+
+
+@bp.route('/api/produzione/<int:id>/log', methods=['GET'])
+def get_log_movimenti(id):
+    """
+    Log movimenti di una riga produzione, deduplicati lato server.
+    Senza parametri ritorna l'intero storico (lista).
+    Con limit/before ritorna {data, next_before}: pagina dal più recente e cursore
+    opaco per caricare i log più vecchi.
+    """
+    try:
+        before = (request.args.get("before") or "").strip()
+        limit_arg = (request.args.get("limit") or "").strip()
+        paged = bool(before or limit_arg)
+
+        if paged:
+            try:
+                limit = int(limit_arg) if limit_arg else 100
+            except ValueError:
+                return jsonify({"error": "limit non valido"}), 400
+            if limit <= 0:
+                return jsonify({"error": "limit non valido (>0)"}), 400
+            try:
+                logs, context, next_before = _log_page(id, before, min(limit, LOG_PAGE_LIMIT_MAX))
+            except ValueError as ve:
+                return jsonify({"error": str(ve)}), 400
+        else:
+            logs = supa_with_retry(lambda: (
+                sb_table("movimenti_produzione_vendor")
+                .select("*")
+                .eq("produzione_id", id)
+                .order("created_at", desc=True)
+                .execute()
+            )).data or []
+            context, next_before = [], None
+
+        # coalescenza sui motivi grezzi ("Trigger ..."), poi etichette user-friendly;
+        # i log di contesto partecipano alla deduplica ma non finiscono nella risposta
+        for l in context:
+            l["_ctx"] = True
+        kept = _coalesce_logs(logs + context, window_seconds=LOG_COALESCE_WINDOW_SECONDS)
+        kept = _dedup_inserimenti([_humanize_log(l) for l in kept])
+        out = [l for l in kept if not l.pop("_ctx", False)]
+
+        # arricchisci canale
+        _risolvi_canali(out)
+
+        if paged:
+            return jsonify({"data": out, "next_before": next_before})
+        return jsonify(out)
     except Exception as ex:
         logging.exception(f"[get_log_movimenti] Errore GET log movimenti produzione {id}")
         return jsonify({"error": f"Errore: {str(ex)}"}), 500
@@ -572,22 +893,30 @@ def delete_produzione_bulk():
         if not ids:
             return jsonify({"error": "Nessun id"}), 400
 
-        BATCH_SIZE = 100
+        # righe + log in una transazione (RPC)
+        try:
+            res = supa_with_retry(lambda: supabase.rpc("produzione_delete_bulk", {"p_ids": ids}).execute())
+            report = res.data or {}
+            return jsonify({"ok": True, "deleted_count": int(report.get("deleted") or 0)})
+        except Exception as ex:
+            if not is_missing_rpc(ex):
+                raise
+            logging.warning(f"[delete_produzione_bulk] RPC produzione_delete_bulk assente, fallback: {ex}")
+
+        BATCH_SIZE = 500
+        deleted = 0
         for i in range(0, len(ids), BATCH_SIZE):
             batch_ids = ids[i:i + BATCH_SIZE]
             supa_with_retry(lambda ids=batch_ids: (
                 sb_table("movimenti_produzione_vendor").delete().in_("produzione_id", ids).execute()
             ))
-            time.sleep(0.05)
-
-        for i in range(0, len(ids), BATCH_SIZE):
-            batch_ids = ids[i:i + BATCH_SIZE]
-            supa_with_retry(lambda ids=batch_ids: (
+            res = supa_with_retry(lambda ids=batch_ids: (
                 sb_table("produzione_vendor").delete().in_("id", ids).execute()
             ))
-            time.sleep(0.05)
+            # righe davvero cancellate, come il conteggio della RPC
+            deleted += len(res.data or [])
 
-        return jsonify({"ok": True, "deleted_count": len(ids)})
+        return jsonify({"ok": True, "deleted_count": deleted})
     except Exception as ex:
         logging.exception("[delete_produzione_bulk] Errore DELETE bulk produzione")
         return jsonify({"error": f"Errore: {str(ex)}"}), 500
@@ -596,109 +925,207 @@ def delete_produzione_bulk():
 # -----------------------------------------------------------------------------
 # Inserimento manuale in produzione (canali: Amazon Seller, Sito)
 # -----------------------------------------------------------------------------
-@bp.route('/api/produzione/manuale', methods=['POST'])
-def crea_produzione_manuale():
+MANUALE_BATCH_MAX = 500
+
+
+def _parse_manuale(data: dict) -> dict:
+    """Valida una voce di inserimento manuale; ValueError con messaggio per il client."""
+    canale = (data.get("canale") or "").strip()
+    if canale not in ("Amazon Seller", "Sito"):
+        raise ValueError("Canale non valido. Usa 'Amazon Seller' o 'Sito'.")
+
+    sku = (data.get("sku") or "").strip()
+    ean = (data.get("ean") or "").strip() or None
+    start_delivery = (data.get("start_delivery") or "").strip() or None  # opzionale per Sito
+    note = (data.get("note") or "").strip()
     try:
-        data = request.json or {}
-        canale = (data.get("canale") or "").strip()
-        if canale not in ("Amazon Seller", "Sito"):
-            return jsonify({"error": "Canale non valido. Usa 'Amazon Seller' o 'Sito'."}), 400
-
-        sku = (data.get("sku") or "").strip()
-        ean = (data.get("ean") or "").strip() or None
-        qty = data.get("qty")
-        start_delivery = (data.get("start_delivery") or "").strip() or None  # opzionale per Sito
-        note = (data.get("note") or "").strip()
         plus = int(data.get("plus") or 0)
-        cavallotti = bool(data.get("cavallotti") or False)
-        radice = estrai_radice(sku)
+    except Exception:
+        raise ValueError("plus deve essere un intero")
 
-        if not sku:
-            return jsonify({"error": "sku obbligatorio"}), 400
+    if not sku:
+        raise ValueError("sku obbligatorio")
+    try:
+        qty = int(data.get("qty"))
+    except Exception:
+        raise ValueError("qty deve essere un intero >= 1")
+    if qty < 1:
+        raise ValueError("qty deve essere >= 1")
+    if len(note) > 255:
+        raise ValueError("Nota troppo lunga (max 255)")
+    if start_delivery:
         try:
-            qty = int(qty)
-        except Exception:
-            return jsonify({"error": "qty deve essere un intero >= 1"}), 400
-        if qty < 1:
-            return jsonify({"error": "qty deve essere >= 1"}), 400
-        if len(note) > 255:
-            return jsonify({"error": "Nota troppo lunga (max 255)"}), 400
-
-        # tenta aggregazione su riga "Da Stampare" esistente
-        # tenta aggregazione su riga "Da Stampare" esistente (stessa chiave logica)
-        def _build_existing_query():
-            q = (sb_table("produzione_vendor")
-                .select("id, da_produrre, qty, plus")
-                .eq("sku", sku)
-                .eq("stato_produzione", "Da Stampare")
-                .eq("canale", canale))
-            q = _eq_or_is_null(q, "ean", ean)
-            q = _eq_or_is_null(q, "start_delivery", start_delivery)
-            return q.order("id").limit(1).execute()
-
-        existing = supa_with_retry(_build_existing_query).data or []
-
-        if existing:
-            r = existing[0]
-            new_qty = int(r.get("da_produrre") or 0) + qty + plus
-            # merge
-            supa_with_retry(lambda: (
-                sb_table("produzione_vendor")
-                .update({
-                    "da_produrre": new_qty,
-                    "qty": new_qty,
-                    "plus": 0,
-                    "note": note or None,
-                    "cavallotti": cavallotti
-                }).eq("id", r["id"]).execute()
-            ))
-            return jsonify({"ok": True, "id": r["id"], "aggregated": True})
-
-        nuovo = {
-            "prelievo_id": None,
-            "sku": sku,
-            "ean": ean,
-            "qty": qty,
-            "riscontro": 0,
-            "plus": plus,
-            "start_delivery": start_delivery,
-            "stato": "manuale",
-            "stato_produzione": "Da Stampare",
-            "da_produrre": qty + plus,
-            "cavallotti": cavallotti,
-            "note": note or None,
-            "canale": canale
-        }
-        inserted = supa_with_retry(lambda: sb_table("produzione_vendor").insert(nuovo).execute()).data or []
-        new_id = inserted[0]["id"] if inserted else None
+            datetime.strptime(start_delivery[:10], "%Y-%m-%d")
+        except ValueError:
+            raise ValueError("start_delivery non valida (YYYY-MM-DD)")
+
+    return {
+        "sku": sku, "ean": ean, "canale": canale, "qty": qty, "plus": plus,
+        "start_delivery": start_delivery, "note": note or None,
+        "cavallotti": bool(data.get("cavallotti") or False),
+    }
+
 
-        # ---- NEW: log esplicito “Inserimento manuale” ----
+def _aggrega_manuale(items: List[dict]) -> List[dict]:
+    """
+    Voci con la stessa chiave logica (sku, ean, canale, start_delivery) sommate in una,
+    come fa la RPC: qty/plus sommati, note/cavallotti dell'ultima voce.
+    """
+    out: Dict[tuple, dict] = {}
+    for it in items:
+        key = (it["sku"], it["ean"], it["canale"], it["start_delivery"])
+        acc = out.get(key)
+        if acc is None:
+            out[key] = dict(it)
+            continue
+        acc["qty"] += it["qty"]
+        acc["plus"] += it["plus"]
+        acc["note"], acc["cavallotti"] = it["note"], it["cavallotti"]
+    return list(out.values())
+
+
+def _upsert_manuale(items: List[dict]) -> Optional[List[dict]]:
+    """
+    Aggrega-o-inserisce le voci con una RPC (INSERT ... ON CONFLICT sulla chiave logica).
+    None se la RPC non è deployata.
+    """
+    try:
+        res = supa_with_retry(lambda: supabase.rpc("produzione_manuale_upsert", {
+            "p_items": items, "p_user_label": _current_user_label(),
+        }).execute())
+    except APIError as ex:
+        if not is_missing_rpc(ex):
+            raise
+        logging.warning(f"[produzione_manuale] RPC produzione_manuale_upsert assente, fallback: {ex}")
+        return None
+    return list(res.data or [])
+
+
+@bp.route('/api/produzione/manuale/batch', methods=['POST'])
+def crea_produzione_manuale_batch():
+    """
+    Inserimento manuale di più SKU in una richiesta.
+    Body: { items: [{ canale, sku, ean?, qty, plus?, start_delivery?, note?, cavallotti? }] }
+    Ritorna { ok, righe: [{ id, sku, ..., aggregated }] }.
+    """
+    try:
+        raw = (request.json or {}).get("items") or []
+        if not raw:
+            return jsonify({"error": "items richiesti"}), 400
+        if len(raw) > MANUALE_BATCH_MAX:
+            return jsonify({"error": f"Massimo {MANUALE_BATCH_MAX} voci per richiesta"}), 400
+        items = []
+        for i, it in enumerate(raw):
+            try:
+                items.append(_parse_manuale(it or {}))
+            except ValueError as ve:
+                return jsonify({"error": f"Voce {i + 1}: {ve}"}), 400
+
+        righe = _upsert_manuale(items)
+        if righe is None:
+            righe = [_crea_manuale_legacy(it) for it in _aggrega_manuale(items)]
+        return jsonify({"ok": True, "righe": righe})
+    except Exception as ex:
+        logging.exception("[crea_produzione_manuale_batch] Errore inserimento manuale")
+        return jsonify({"error": f"Errore: {str(ex)}"}), 500
+
+
+@bp.route('/api/produzione/manuale', methods=['POST'])
+def crea_produzione_manuale():
+    try:
         try:
-            user_label = _current_user_label()
-            if inserted:
-                irow = inserted[0]
-                log_movimento_produzione(
-                    irow,
-                    utente=user_label,
-                    motivo="Inserimento manuale",
-                    stato_vecchio=None,
-                    stato_nuovo="Da Stampare",
-                    qty_vecchia=None,
-                    qty_nuova=irow.get("da_produrre"),
-                    plus_vecchio=None,
-                    plus_nuovo=irow.get("plus") or 0,
-                    dettaglio={"canale": irow.get("canale")}
-                )
-        except Exception:
-            pass
-        # ---------------------------------------------------
+            item = _parse_manuale(request.json or {})
+        except ValueError as ve:
+            return jsonify({"error": str(ve)}), 400
 
-        return jsonify({"ok": True, "id": new_id, "aggregated": False})
+        righe = _upsert_manuale([item])
+        r = righe[0] if righe else _crea_manuale_legacy(item)
+        return jsonify({"ok": True, "id": r.get("id"), "aggregated": bool(r.get("aggregated"))})
     except Exception as ex:
         logging.exception("[crea_produzione_manuale] Errore inserimento manuale")
         return jsonify({"error": f"Errore: {str(ex)}"}), 500
-    
-    # -----------------------------------------------------------------------------
+
+
+def _crea_manuale_legacy(item: dict) -> dict:
+    """Percorso senza RPC: lookup riga 'Da Stampare' + update o insert + log."""
+    sku, ean, canale = item["sku"], item["ean"], item["canale"]
+    qty, plus = item["qty"], item["plus"]
+    start_delivery, note, cavallotti = item["start_delivery"], item["note"], item["cavallotti"]
+
+    # tenta aggregazione su riga "Da Stampare" esistente (stessa chiave logica)
+    def _build_existing_query():
+        q = (sb_table("produzione_vendor")
+            .select("id, da_produrre, qty, plus")
+            .eq("sku", sku)
+            .eq("stato_produzione", "Da Stampare")
+            .eq("canale", canale))
+        q = _eq_or_is_null(q, "ean", ean)
+        q = _eq_or_is_null(q, "start_delivery", start_delivery)
+        return q.order("id").limit(1).execute()
+
+    existing = supa_with_retry(_build_existing_query).data or []
+
+    if existing:
+        r = existing[0]
+        new_qty = int(r.get("da_produrre") or 0) + qty + plus
+        # merge
+        supa_with_retry(lambda: (
+            sb_table("produzione_vendor")
+            .update({
+                "da_produrre": new_qty,
+                "qty": new_qty,
+                "plus": 0,
+                "note": note,
+                "cavallotti": cavallotti
+            }).eq("id", r["id"]).execute()
+        ))
+        return {"id": r["id"], "sku": sku, "ean": ean, "canale": canale,
+                "start_delivery": start_delivery, "da_produrre": new_qty, "aggregated": True}
+
+    nuovo = {
+        "prelievo_id": None,
+        "sku": sku,
+        "ean": ean,
+        "qty": qty,
+        "riscontro": 0,
+        "plus": plus,
+        "start_delivery": start_delivery,
+        "stato": "manuale",
+        "stato_produzione": "Da Stampare",
+        "da_produrre": qty + plus,
+        "cavallotti": cavallotti,
+        "note": note,
+        "canale": canale
+    }
+    inserted = supa_with_retry(lambda: sb_table("produzione_vendor").insert(nuovo).execute()).data or []
+    new_id = inserted[0]["id"] if inserted else None
+
+    # ---- NEW: log esplicito “Inserimento manuale” ----
+    try:
+        user_label = _current_user_label()
+        if inserted:
+            irow = inserted[0]
+            log_movimento_produzione(
+                irow,
+                utente=user_label,
+                motivo="Inserimento manuale",
+                stato_vecchio=None,
+                stato_nuovo="Da Stampare",
+                qty_vecchia=None,
+                qty_nuova=irow.get("da_produrre"),
+                plus_vecchio=None,
+                plus_nuovo=irow.get("plus") or 0,
+                dettaglio={"canale": irow.get("canale")}
+            )
+    except Exception:
+        pass
+    # ---------------------------------------------------
+
+    return {"id": new_id, "sku": sku, "ean": ean, "canale": canale,
+            "start_delivery": start_delivery, "da_produrre": qty + plus, "aggregated": False}
+
+
+# -----------------------------------------------------------------------------
 # Sposta parte dei pezzi di una riga produzione in un altro stato
 # -----------------------------------------------------------------------------
 def _merge_into_target(row_src: dict, to_state: str, qty: int, *, log_merge: bool = True):
@@ -9,6 +9,7 @@ import time
 import httpx
 from app.supabase_client import supabase
 from app.services.supabase_write import upsert_variant
+from app.services.catalog_index import catalogo
 from app.routes.bulk_sync import normalize_gid
 
 webhook = Blueprint("webhook", __name__)
@@ -96,6 +97,7 @@ def handle_product_delete():
         .eq("shopify_product_id", shopify_product_id)
     )
 
+    catalogo.remove_product(shopify_product_id)
     logging.info("🗑️ Prodotto eliminato: %s — %s", shopify_product_id, response)
     return jsonify({"status": "deleted", "shopify_product_id": shopify_product_id}), 200
 
@@ -0,0 +1,301 @@
+# app/services/catalog_index.py
+# -------------------------------------------------------------
+# Indice in memoria del catalogo prodotti per l'autocomplete (/api/products/search).
+#   - sku, ean: trigrammi, ricerca per sottostringa (come ilike '*tok*')
+#   - variant_title, product_title: prefisso (3 caratteri) di ogni parola, il token
+#     deve comparire a inizio parola ("cuc" trova "Tappeto cucina", "ucina" no)
+# Token più corti di 3 caratteri: scansione delle righe, senza postings dedicati.
+# L'indice resta piccolo (poche voci per prodotto) e il lock è tenuto solo per
+# raccogliere i candidati: filtro e ordinamento girano fuori dal lock.
+#
+# Caricato all'avvio (run.py) e aggiornato:
+#   - incrementalmente da upsert_variant (webhook prodotto + bulk sync) e dal webhook delete
+#   - con un ricaricamento completo ogni CATALOG_INDEX_TTL_SECONDS (rete di sicurezza
+#     per modifiche fuori banda e per gli altri processi, che vedono solo i propri webhook)
+# Finché l'indice non è pronto search() ritorna None e il chiamante usa il DB.
+# -------------------------------------------------------------
+
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Iterable, Optional
+
+from app.supabase import sb_table, supa_with_retry
+
+CATALOG_INDEX_ENABLED = os.getenv("CATALOG_INDEX", "1") not in ("0", "false", "FALSE")
+CATALOG_INDEX_TTL_SECONDS = float(os.getenv("CATALOG_INDEX_TTL_SECONDS", "900"))
+CATALOG_PAGE_SIZE = 1000
+
+# campi restituiti dall'autocomplete (come la select del percorso DB)
+CATALOG_FIELDS = ("id", "sku", "ean", "variant_title", "product_title", "image_url", "price")
+SEARCH_FIELDS = ("sku", "ean", "variant_title", "product_title")
+_LOAD_SELECT = ",".join(CATALOG_FIELDS + ("shopify_variant_id", "shopify_product_id", "updated_at"))
+_SEP = "\x00"   # separatore tra campi: nessun token lo contiene, i match restano dentro un campo
+_GRAM = 3
+_NON_WORD = re.compile(r"\W+")
+
+
+def _row_key(row: dict) -> Optional[str]:
+    k = row.get("shopify_variant_id") or row.get("id")
+    return str(k) if k not in (None, "") else None
+
+
+def _words(s: str) -> str:
+    """Testo normalizzato a parole separate da spazio (senza spazi ai bordi)."""
+    return _NON_WORD.sub(" ", s.lower()).strip()
+
+
+def _text(row: dict) -> tuple:
+    """(codici, titoli): sku/ean per la sottostringa; titoli a parole, ognuna preceduta da spazio, per i prefissi."""
+    codes = _SEP.join(str(row.get(f) or "").lower() for f in ("sku", "ean"))
+    titles = _SEP.join(" " + _words(str(row.get(f) or "")) for f in ("variant_title", "product_title"))
+    return codes, titles
+
+
+def _grams(s: str, n: int = _GRAM) -> set:
+    return {s[i:i + n] for i in range(len(s) - n + 1) if _SEP not in s[i:i + n]}
+
+
+def _prefixes(titles: str) -> set:
+    return {"^" + w[:_GRAM] for w in titles.replace(_SEP, " ").split() if len(w) >= _GRAM}
+
+
+def _keys_of(text: tuple) -> set:
+    codes, titles = text
+    return _grams(codes) | _prefixes(titles)
+
+
+def _match(tok: str, words_tok: str, text: tuple) -> bool:
+    codes, titles = text
+    return tok in codes or (bool(words_tok) and (" " + words_tok) in titles)
+
+
+def exact_score(row: dict, exact_tokens: list) -> tuple:
+    """Preferenza per i token esatti ('ABC;' = segmento SKU, '123;' = EAN), poi SKU più corti."""
+    s = (row.get("sku") or "").upper()
+    exact_hit = any(
+        (not et.isdigit() and et.upper() in s.split('-')) or
+        (et.isdigit() and (row.get("ean") or "") == et)
+        for et in exact_tokens
+    )
+    return (0 if exact_hit else 1, len(s), s)
+
+
+def split_query(q: str) -> tuple:
+    """Token fuzzy (sanitizzati come per l'or= di PostgREST) e token esatti (suffisso ';')."""
+    tokens = [t for t in (q or "").split() if t]
+    exact = [t[:-1] for t in tokens if t.endswith(';')]
+    fuzzy = []
+    for tok in tokens:
+        if tok.endswith(';'):
+            continue
+        t = tok.replace("%", "").replace(",", " ").strip()
+        if t:
+            fuzzy.append(t)
+    return fuzzy, exact
+
+
+def _fetch_products() -> Iterable[dict]:
+    """Tutti i prodotti, a pagine keyset su id."""
+    last_id = None
+    while True:
+        q = sb_table("products").select(_LOAD_SELECT)
+        if last_id is not None:
+            q = q.gt("id", last_id)
+        rows = supa_with_retry(lambda: q.order("id").limit(CATALOG_PAGE_SIZE).execute()).data or []
+        yield from rows
+        if len(rows) < CATALOG_PAGE_SIZE:
+            return
+        last_id = rows[-1]["id"]
+
+
+class CatalogIndex:
+    """Indice trigrammi/prefissi thread-safe; le letture non bloccano durante un ricaricamento."""
+
+    def __init__(self, loader: Callable[[], Iterable[dict]] = _fetch_products,
+                 ttl: float = CATALOG_INDEX_TTL_SECONDS):
+        self._loader = loader
+        self._ttl = ttl
+        self._lock = threading.RLock()
+        self._rows: dict = {}
+        self._text: dict = {}
+        self._grams: dict = defaultdict(set)
+        self._by_product: dict = defaultdict(set)
+        self._loaded_at: Optional[float] = None
+        self._loading = False
+        self._during_load: list = []
+
+    # -- stato -------------------------------------------------------------
+    @property
+    def ready(self) -> bool:
+        return self._loaded_at is not None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def stale(self) -> bool:
+        return self._loaded_at is None or (time.monotonic() - self._loaded_at) > self._ttl
+
+    # -- caricamento -------------------------------------------------------
+    def refresh(self) -> int:
+        """Ricarica completa (sincrona): costruisce un nuovo indice e lo sostituisce."""
+        with self._lock:
+            if self._loading:
+                return len(self._rows)
+            self._loading = True
+            self._during_load = []
+        try:
+            fresh = CatalogIndex(loader=self._loader, ttl=self._ttl)
+            for row in self._loader():
+                fresh._add(row)
+            with self._lock:
+                self._rows, self._text = fresh._rows, fresh._text
+                self._grams, self._by_product = fresh._grams, fresh._by_product
+                # webhook arrivati durante il caricamento: riapplicati sopra lo snapshot
+                for op, arg in self._during_load:
+                    self._remove_product(arg) if op == "del" else self._replace(arg)
+                self._loaded_at = time.monotonic()
+            logging.info(f"[catalog_index] caricati {len(self._rows)} prodotti")
+            return len(self._rows)
+        finally:
+            with self._lock:
+                self._loading = False
+                self._during_load = []
+
+    def refresh_async(self) -> None:
+        if not CATALOG_INDEX_ENABLED or self._loading:
+            return
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception as ex:
+                logging.warning(f"[catalog_index] caricamento fallito: {ex}")
+
+        threading.Thread(target=_run, name="catalog-index-load", daemon=True).start()
+
+    # -- aggiornamenti incrementali ------------------------------------------
+    def upsert(self, row: dict) -> None:
+        if not row or _row_key(row) is None:
+            return
+        row = dict(row)
+        row.setdefault("updated_at", time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()))
+        with self._lock:
+            if self._loading:
+                self._during_load.append(("put", row))
+            self._replace(row)
+
+    def remove_product(self, shopify_product_id) -> None:
+        pid = str(shopify_product_id or "")
+        if not pid:
+            return
+        with self._lock:
+            if self._loading:
+                self._during_load.append(("del", pid))
+            self._remove_product(pid)
+
+    # -- ricerca -----------------------------------------------------------
+    def search(self, q: str, limit: int = 20) -> Optional[list]:
+        """
+        Stessa semantica del percorso DB: ogni token fuzzy deve comparire (case-insensitive)
+        in almeno uno dei campi; i token esatti ordinano. None se l'indice non è pronto.
+        """
+        if not CATALOG_INDEX_ENABLED:
+            return None
+        if self.stale():
+            self.refresh_async()
+        if not self.ready:
+            return None
+
+        fuzzy, exact = split_query(q)
+        toks = sorted((t.lower() for t in fuzzy), key=len, reverse=True)
+        # sotto lock solo la raccolta dei candidati (righe e testi vengono sostituiti,
+        # mai modificati, dagli aggiornamenti); filtro e ordinamento girano fuori
+        with self._lock:
+            keys = self._candidates(toks[0]) if toks else None
+            if keys is None:
+                rows_map, text_map = self._rows.copy(), self._text.copy()
+            else:
+                rows_map = {k: self._rows[k] for k in keys}
+                text_map = {k: self._text[k] for k in keys}
+
+        if not fuzzy and not exact:
+            top = heapq.nlargest(limit, rows_map.values(), key=lambda r: str(r.get("updated_at") or ""))
+            return [self._project(r) for r in top]
+
+        norm = [(t, _words(t)) for t in toks]
+        rows = [r for k, r in rows_map.items() if all(_match(t, w, text_map[k]) for t, w in norm)]
+        if exact:
+            best = heapq.nsmallest(limit, rows, key=lambda r: exact_score(r, exact))
+        else:
+            # senza token esatti exact_score si riduce a (lunghezza, sku)
+            best = heapq.nsmallest(limit, rows, key=lambda r: (len(r.get("sku") or ""), (r.get("sku") or "").upper()))
+        return [self._project(r) for r in best]
+
+    # -- interni -------------------------------------------------------------
+    def _candidates(self, tok: str) -> Optional[set]:
+        """Superinsieme delle righe che contengono tok (sotto lock); None = tutte (token corti)."""
+        first = (_words(tok).split() or [""])[0]
+        codes = _grams(tok)
+        if not codes or len(first) < _GRAM:
+            return None
+        posting = sorted((self._grams.get(g, frozenset()) for g in codes), key=len)
+        out = set(posting[0])
+        for p in posting[1:]:
+            out &= p
+            if not out:
+                break
+        out |= self._grams.get("^" + first[:_GRAM], set())
+        return out
+
+    def _add(self, row: dict) -> None:
+        key = _row_key(row)
+        if key is None:
+            return
+        text = _text(row)
+        self._rows[key] = row
+        self._text[key] = text
+        for g in _keys_of(text):
+            self._grams[g].add(key)
+        pid = str(row.get("shopify_product_id") or "")
+        if pid:
+            self._by_product[pid].add(key)
+
+    def _drop(self, key: str) -> None:
+        row = self._rows.pop(key, None)
+        text = self._text.pop(key, None)
+        if text is not None:
+            for g in _keys_of(text):
+                s = self._grams.get(g)
+                if s is not None:
+                    s.discard(key)
+                    if not s:
+                        del self._grams[g]
+        pid = str((row or {}).get("shopify_product_id") or "")
+        if pid and pid in self._by_product:
+            self._by_product[pid].discard(key)
+            if not self._by_product[pid]:
+                del self._by_product[pid]
+
+    def _replace(self, row: dict) -> None:
+        key = _row_key(row)
+        old = self._rows.get(key)
+        if old is not None:
+            row = {**old, **row}
+            self._drop(key)
+        self._add(row)
+
+    def _remove_product(self, pid: str) -> None:
+        for key in list(self._by_product.get(pid, ())):
+            self._drop(key)
+
+    @staticmethod
+    def _project(row: dict) -> dict:
+        return {f: row.get(f) for f in CATALOG_FIELDS}
+
+
+catalogo = CatalogIndex()
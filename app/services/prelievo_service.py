@@ -2,8 +2,8 @@
 
 from typing import Any
 from app.repositories.prelievo_repo import (
-    sel_date_importabili, sel_prelievi, upd_prelievo, upd_prelievi_bulk,
-    del_prelievi, import_da_ordini
+    sel_date_importabili, sel_prelievi, sel_prelievi_pagina, upd_prelievo, upd_prelievi_bulk,
+    del_prelievi, import_da_ordini, PRELIEVO_FIELDS
 )
 from app.services.produzione_service import sync_produzione_from_prelievo_ids
 from app.supabase_client import supabase
@@ -44,12 +44,52 @@ def date_importabili():
     return sel_date_importabili()
 
 def importa_prelievi_da_data(data:str):
-    del_prelievi(data=data)
+    # import_da_ordini sostituisce già i prelievi della data (delete+insert atomico)
     return import_da_ordini(data)
 
 def lista_prelievi(data:str|None, radice:str|None):
     return sel_prelievi(data=data, radice=radice)
 
+PAGE_LIMIT_DEFAULT = 200
+PAGE_LIMIT_MAX = 1000
+
+def lista_prelievi_pagina(data: str | None, radice: str | None = None, stato: str | None = None,
+                          canale: str | None = None, fields: str | None = None,
+                          cursor: str | None = None, limit: str | int | None = None) -> dict:
+    """
+    Pagina di prelievi (keyset su id) con filtri server-side e proiezione colonne.
+    stato/fields accettano liste separate da virgola.
+    Ritorna {"data": [...], "next_cursor": int|None}.
+    """
+    cols = [f.strip() for f in (fields or "").split(",") if f.strip()]
+    unknown = [c for c in cols if c not in PRELIEVO_FIELDS]
+    if unknown:
+        raise ValueError(f"Campi non validi: {', '.join(unknown)}")
+
+    stati = [s.strip() for s in (stato or "").split(",") if s.strip()]
+
+    after_id = _parse_cursor(cursor)
+    lim = _to_int_or_none(limit) if limit not in (None, "") else PAGE_LIMIT_DEFAULT
+    if lim is None or lim <= 0:
+        raise ValueError("limit non valido (>0)")
+    lim = min(lim, PAGE_LIMIT_MAX)
+
+    rows, next_cursor = sel_prelievi_pagina(
+        data=data, radice=radice, stati=stati or None, canale=canale,
+        fields=cols or None, after_id=after_id, limit=lim,
+    )
+    return {"data": rows, "next_cursor": next_cursor}
+
+def _parse_cursor(cursor: str | None) -> int | None:
+    """Cursore = ultimo id della pagina precedente; assente = prima pagina."""
+    if cursor is None or cursor == "":
+        return None
+    s = str(cursor).strip()
+    if not s.isdigit():
+        # mai ripiegare sulla prima pagina: il client ricomincerebbe all'infinito
+        raise ValueError("cursor non valido")
+    return int(s)
+
 def _to_int_or_none(v: Any):
     if v is None:
         return None
@@ -1,4 +1,5 @@
 from app.supabase_client import supabase
+from app.services.catalog_index import catalogo
 
 def upsert_variant(record: dict):
     try:
@@ -13,6 +14,12 @@ def upsert_variant(record: dict):
             print("📦 Payload:", record)
             return False
 
+        # aggiorna l'indice autocomplete (riga completa: id/updated_at dal DB)
+        try:
+            catalogo.upsert(response.data[0])
+        except Exception as ex:
+            print(f"⚠️ catalog index non aggiornato per SKU {record.get('sku')}: {ex}")
+
         return True
 
     except Exception as e:
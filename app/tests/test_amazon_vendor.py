@@ -18,6 +18,7 @@ import builtins
 import importlib
 import types
 import pytest
+from postgrest.exceptions import APIError
 from flask import Flask
 
 # -------------------------------------------------------------
@@ -174,6 +175,48 @@ def test_badge_counts(client):
     assert payload["parziali"] == 0
 
 
+def test_badge_counts_aggregati_in_cache(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    payload = {"vendor": {"stato_ordine": {"nuovo": 4, "parziale": 2, "chiuso": 9}}}
+    calls = []
+
+    def rpc(name, args):
+        calls.append(name)
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=payload))
+
+    monkeypatch.setattr(mod.supabase, "rpc", rpc, raising=False)
+    monkeypatch.setattr(mod, "_badge_cache", {"at": 0.0, "data": None})
+
+    res = client.get("/api/amazon/vendor/orders/badge-counts")
+    assert res.get_json() == {"nuovi": 4, "parziali": 2}
+    client.get("/api/amazon/vendor/orders/badge-counts")
+    assert calls == ["badge_counters_get"]                      # polling servito dalla cache
+    payload["vendor"]["stato_ordine"]["nuovo"] = 5
+    assert mod._badge_counts_payload(fresh=True)["nuovi"] == 5  # dopo una scrittura
+
+
+def test_badge_produzione_in_cache(monkeypatch):
+    mod = importlib.import_module("app.routes.produzione")
+    payload = {"produzione": {"stato_produzione": {"Cucito": 2}, "radice": {"R": 2}, "canale": {"Sito": 2}}}
+    calls = []
+
+    def rpc(name, args):
+        calls.append(name)
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=payload))
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(rpc=rpc))
+    monkeypatch.setattr(mod, "_badge_cache", {"at": 0.0, "version": None, "data": None})
+
+    stati, _, _ = mod._badge_produzione()
+    stati["Cucito"] = 99                                         # copia, la cache resta intatta
+    assert mod._badge_produzione() == ({"Cucito": 2}, {"R": 2}, {"Sito": 2})
+    assert calls == ["badge_counters_get"]                      # seconda lista servita dalla cache
+    monkeypatch.setattr(mod, "BADGE_CACHE_SECONDS", 0)
+    mod._badge_produzione()
+    assert calls == ["badge_counters_get"] * 2                  # scaduta: nuovo group by
+
+
 def test_riepilogo_nuovi_basic(client):
     res = client.get("/api/amazon/vendor/orders/riepilogo/nuovi")
     assert res.status_code == 200
@@ -215,12 +258,12 @@ def test_find_items_by_barcode_merges_qty_inserted(client, monkeypatch):
 
 
 def test_list_vendor_pos_pass_through(client, monkeypatch):
-    # mock requests.get used in the pass‑through endpoint
+    # mock della sessione SP-API usata dal pass‑through
     import app.routes.amazon_vendor as mod
     class _R:
         status_code = 200
         text = "{\"purchaseOrders\": []}"
-    monkeypatch.setattr(mod.requests, "get", lambda *a, **k: _R())
+    monkeypatch.setattr(mod.spapi_session, "get", lambda *a, **k: _R())
 
     resp = client.get("/api/amazon/vendor/orders/list")
     assert resp.status_code == 200
@@ -595,9 +638,9 @@ def test_list_vendor_pos_ok_even_without_aws_keys(client, monkeypatch):
     # mock variabili d'ambiente vuote -> awsauth None -> ok
     monkeypatch.setenv("AWS_ACCESS_KEY", "")
     monkeypatch.setenv("AWS_SECRET_KEY", "")
-    # mock requests.get
+    # mock della sessione SP-API
     class _R: status_code=200; text='{"purchaseOrders":[]}'
-    monkeypatch.setattr(mod.requests, "get", lambda *a, **k: _R())
+    monkeypatch.setattr(mod.spapi_session, "get", lambda *a, **k: _R())
 
     resp = client.get("/api/amazon/vendor/orders/list")
     assert resp.status_code == 200
@@ -756,4 +799,1170 @@ def test_conferma_parziale_sposta_in_trasferito(client, monkeypatch):
                        json={"center":"FC9","data":"2025-08-11"})
     assert resp.status_code == 200
     # Il helper è stato chiamato subito dopo la conferma
-    assert called["args"] == ("FC9", "2025-08-11", 3)
\ No newline at end of file
+    assert called["args"] == ("FC9", "2025-08-11", 3)
+
+def test_giacenze_list_usa_proiezione_disponibilita(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    disp = [{"sku": "SKU-1", "ean": "", "vendor_qty": 5, "sito_qty": 1, "seller_qty": 0,
+             "vendor_prenotati": 2, "sito_prenotati": 0, "seller_prenotati": 0}]
+    touched = []
+
+    class T:
+        def __init__(self, name): self.name = name; touched.append(name)
+        def select(self, *a, **k): return self
+        def or_(self, *a, **k): return self
+        def order(self, *a, **k): return self
+        def range(self, *a, **k): return self
+        def execute(self): return type("R", (), {"data": disp})
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", type("S", (), {"table": lambda name: T(name)})())
+
+    res = client.get("/api/magazzino/giacenze?limit=10")
+    js = res.get_json()
+    assert res.status_code == 200
+    assert touched == ["magazzino_disponibilita"]   # una sola query, niente prelievi
+    assert js[0]["ean"] is None
+    assert js[0]["vendor_qta"] == 7 and js[0]["vendor_prenotati"] == 2
+    assert js[0]["giacenza_totale"] == 8
+
+
+def test_trasferisci_usa_rpc_atomica(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    calls = []
+
+    class Rpc:
+        def __init__(self, name, args): calls.append((name, args)); self.args = args
+        def execute(self):
+            it = self.args["p_items"][0]
+            if it["qty"] > 5:
+                raise APIError({"code": "P0001", "message": "Quantità oltre il disponibile nel pool 'Sito'",
+                                "details": json.dumps({"sku": it["sku"], "ean": it["ean"],
+                                                       "from": it["from"], "disponibile": 5})})
+            return type("R", (), {"data": [{**it, "from_qty": 5 - it["qty"], "to_qty": it["qty"]}]})
+
+    def _no_table(name):
+        raise AssertionError(f"nessuna query diretta attesa su {name}")
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", type("S", (), {"rpc": staticmethod(Rpc), "table": staticmethod(_no_table)})())
+
+    res = client.post("/api/magazzino/trasferisci",
+                      json={"sku": "SKU-1", "ean": "E1", "from": "sito", "to": "vendor", "quantita": 2})
+    assert res.status_code == 200
+    assert res.get_json() == {"ok": True, "from": {"canale": "Sito", "qty": 3},
+                              "to": {"canale": "Amazon Vendor", "qty": 2}}
+    assert calls[0][0] == "magazzino_trasferisci"
+
+    res = client.post("/api/magazzino/trasferisci",
+                      json={"items": [{"sku": "SKU-1", "ean": "E1", "from": "sito", "to": "vendor", "quantita": 9}]})
+    assert res.status_code == 409
+    assert res.get_json()["disponibile"] == 5 and res.get_json()["sku"] == "SKU-1"
+
+    res = client.post("/api/magazzino/trasferisci",
+                      json={"sku": "SKU-1", "ean": "E1", "from": "sito", "to": "sito", "quantita": 1})
+    assert res.status_code == 400
+
+    # RPC non deployata: il bulk non può essere tutto-o-niente -> 501 senza toccare le giacenze
+    def _missing(name, args):
+        raise APIError({"code": "PGRST202", "message": "Could not find the function"})
+    monkeypatch.setattr(mod, "supabase", type("S", (), {"rpc": staticmethod(_missing),
+                                                        "table": staticmethod(_no_table)})())
+    it = {"sku": "SKU-1", "ean": "E1", "from": "sito", "to": "vendor", "quantita": 1}
+    res = client.post("/api/magazzino/trasferisci", json={"items": [it, {**it, "sku": "SKU-2"}]})
+    assert res.status_code == 501
+
+
+def test_move_parziale_to_trasferito_usa_rpc(monkeypatch):
+    mod = importlib.import_module("app.routes.amazon_vendor")
+    calls = []
+
+    def _rpc(name, args):
+        calls.append((name, args))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(
+            data={"moved": 4, "deposited": 2, "failures": []}))
+
+    def _no_table(name):
+        raise AssertionError(f"nessuna query diretta attesa su {name}")
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(rpc=_rpc))
+    monkeypatch.setattr(mod, "sb_table", _no_table)
+
+    report = mod._move_parziale_to_trasferito("FC1", "2025-08-11T00:00:00", 2)
+    assert report == {"moved": 4, "failures": [], "deposited": 2}
+    assert calls == [("transfer_parziale", {"p_center": "FC1", "p_start_delivery": "2025-08-11",
+                                            "p_numero_parziale": 2})]
+
+
+def test_need_riscontro_first_conta_tutti_i_confermati():
+    mod = importlib.import_module("app.routes.amazon_vendor")
+    # parziale corrente 4 pz, un altro confermato (anche se creato dopo) 5 pz, riscontro 5:
+    # il riscontro è già consumato dall'altro parziale -> si spostano tutti i 4 pezzi
+    assert mod._need_riscontro_first({"SKU-A": 4}, {"SKU-A": 9}, {"SKU-A": 5}) == {"SKU-A": 4}
+    # solo il corrente confermato: il riscontro copre 3 pezzi su 4
+    assert mod._need_riscontro_first({"SKU-A": 4}, {"SKU-A": 4}, {"SKU-A": 3}) == {"SKU-A": 1}
+    # riscontro residuo parziale: 6 - (7 - 4) = 3 coperti
+    assert mod._need_riscontro_first({"SKU-A": 4, "SKU-B": 2}, {"SKU-A": 7, "SKU-B": 2},
+                                     {"SKU-A": 6}) == {"SKU-A": 1, "SKU-B": 2}
+
+
+def test_chiudi_ordine_qty_confirmed_via_rpc(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    calls, updates = [], []
+
+    class T:
+        def __init__(self, name): self.name = name
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def order(self, *a, **k): return self
+        def limit(self, *a, **k): return self
+        def update(self, d): updates.append((self.name, d)); return self
+        def execute(self):
+            if self.name == "ordini_vendor_riepilogo":
+                return SimpleNamespace(data=[{"id": 7, "po_list": ["PO-A"]}])
+            if self.name == "ordini_vendor_items":
+                raise AssertionError("nessun update per-riga atteso sugli items")
+            return SimpleNamespace(data=[])
+
+    def _rpc(name, args):
+        calls.append((name, args))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data={"SKU-A": 5}))
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=T, rpc=_rpc))
+
+    resp = client.post("/api/amazon/vendor/parziali-wip/chiudi", json={"center": "FC1", "data": "2025-01-10"})
+    assert resp.status_code == 200
+    assert resp.get_json()["qty_confirmed"] == {"SKU-A": 5}
+    assert calls == [("ordini_vendor_sync_qty_confirmed",
+                      {"p_riepilogo_id": 7, "p_include_wip": True, "p_reset_missing": True})]
+    assert ("ordini_vendor_riepilogo", {"stato_ordine": "completato"}) in updates
+
+
+def test_dashboard_parziali_colli_da_aggregato(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    riepi = [{"id": 1, "fulfillment_center": "FCX", "start_delivery": "2025-01-10",
+              "stato_ordine": "parziale", "po_list": ["POZ"]}]
+    calls = []
+
+    class Riep:
+        def select(self, *a, **k): return self
+        def in_(self, *a, **k): return self
+        def order(self, *a, **k): return self
+        def range(self, *a, **k): return self
+        def execute(self): return SimpleNamespace(data=riepi)
+
+    def _table(name):
+        if name == "ordini_vendor_riepilogo": return Riep()
+        raise AssertionError(f"nessuna lettura dei blob dati attesa ({name})")
+
+    def _rpc(name, args):
+        calls.append((name, args))
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=[
+            {"riepilogo_id": 1, "numero_parziale": 2, "confermato": True,
+             "conferma_collo": {"1": True, "2": True}, "colli_totali": 3}]))
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=_table, rpc=_rpc))
+
+    js = client.get("/api/amazon/vendor/orders/riepilogo/dashboard").get_json()
+    assert calls == [("parziali_dashboard_colli", {"p_riepilogo_ids": [1]})]
+    assert js[0]["colli_totali"] == 3 and js[0]["colli_confermati"] == 2
+    assert js[0]["parziale_chiuso"] is True
+
+
+def test_parziali_wip_delta(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    calls = []
+
+    def _rpc(name, args):
+        calls.append((name, args))
+        def _exec():
+            if args["p_version"] == 1:
+                raise APIError({"code": "P0001", "message": "Conflitto: dati aggiornati da altro client (versione 4)."})
+            return SimpleNamespace(data={"numero_parziale": 2, "version": 5, "righe": 7})
+        return SimpleNamespace(execute=_exec)
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(rpc=_rpc))
+    url = "/api/amazon/vendor/parziali-wip/delta?center=FC1&data=2025-01-10"
+    op = {"op": "add", "line": {"po_number": "PO1", "model_number": "M1", "collo": 3, "quantita": 1}}
+
+    res = client.post(url, json={"version": 4, "ops": [op], "confermaCollo": {"3": True}})
+    assert res.status_code == 200
+    assert res.get_json() == {"ok": True, "numero_parziale": 2, "version": 5, "righe": 7}
+    assert calls[0] == ("parziali_wip_apply_delta", {
+        "p_center": "FC1", "p_start_delivery": "2025-01-10", "p_ops": [op],
+        "p_conferma_collo": {"3": True}, "p_version": 4})
+
+    assert client.post(url, json={"version": 1, "ops": [op]}).status_code == 409
+    assert client.post(url, json={"ops": [{"op": "drop", "line": {}}]}).status_code == 400
+    assert client.post(url, json={"version": "abc", "ops": [op]}).status_code == 400
+    assert len(calls) == 2
+    # anche il salvataggio completo valida version (niente 500)
+    res = client.post("/api/amazon/vendor/parziali-wip?center=FC1&data=2025-01-10",
+                      json={"version": "abc", "parziali": []})
+    assert res.status_code == 400 and len(calls) == 2
+
+
+def test_get_parziali_wip_ricostruisce_dati_stale(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    order = []
+    wip = {"dati": [], "dati_stale": True, "numero_parziale": 2, "version": 3, "conferma_collo": {}}
+
+    def _rpc(name, args):
+        order.append(name)
+        if name == "parziali_wip_materializza":
+            assert args == {"p_riepilogo_ids": [7]}
+            wip.update(dati=[{"model_number": "M1", "quantita": 2}], dati_stale=False)
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=1))
+
+    class T:
+        def __init__(self, name): self.name = name
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def order(self, *a, **k): return self
+        def limit(self, *a): return self
+        def execute(self):
+            order.append(self.name)
+            return SimpleNamespace(data=[{"id": 7}] if self.name == "ordini_vendor_riepilogo" else [dict(wip)])
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(rpc=_rpc, table=T))
+    js = client.get("/api/amazon/vendor/parziali-wip?center=FC1&data=2025-01-10").get_json()
+    assert js["parziali"] == [{"model_number": "M1", "quantita": 2}] and js["version"] == 3
+    assert order == ["ordini_vendor_riepilogo", "parziali_wip_materializza", "ordini_vendor_parziali"]
+
+
+def test_stream_parziali_riceve_salvataggio_delta(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(rpc=lambda name, args: SimpleNamespace(
+        execute=lambda: SimpleNamespace(data={"numero_parziale": 1, "version": 2}))))
+
+    stream = client.get("/api/amazon/vendor/stream/parziali?center=FC1&data=2025-01-10", buffered=False)
+    assert stream.mimetype == "text/event-stream"
+    chunks = (c.decode() if isinstance(c, bytes) else c for c in stream.response)
+    assert next(chunks).startswith("retry:")
+
+    op = {"op": "add", "line": {"po_number": "PO1", "model_number": "M1", "collo": 1, "quantita": 1}}
+    client.post("/api/amazon/vendor/parziali-wip/delta?center=FC1&data=2025-01-10", json={"ops": [op]})
+
+    msg = next(chunks)
+    assert msg.startswith("event: wip_delta\n")
+    body = json.loads(msg.split("data: ", 1)[1])
+    assert body["topic"] == "parziali:FC1|2025-01-10"
+    assert body["data"]["version"] == 2 and body["data"]["ops"] == [op]
+    stream.close()
+
+
+def test_conferma_parziali_bulk_query_batch_e_ondate(client, monkeypatch):
+    import app.routes.amazon_vendor as mod
+    riepiloghi = [
+        {"id": 1, "fulfillment_center": "FC1", "start_delivery": "2025-01-10", "stato_ordine": "nuovo"},
+        {"id": 2, "fulfillment_center": "FC2", "start_delivery": "2025-01-10", "stato_ordine": "nuovo"},
+        {"id": 3, "fulfillment_center": "FC3", "start_delivery": "2025-01-10", "stato_ordine": "nuovo"},
+    ]
+    parziali = [
+        {"riepilogo_id": 1, "numero_parziale": 1, "dati": [{"model_number": "A", "quantita": 1}]},
+        {"riepilogo_id": 1, "numero_parziale": 2, "dati": [{"model_number": "A", "quantita": 2}]},
+        {"riepilogo_id": 2, "numero_parziale": 1, "dati": json.dumps([{"model_number": "A", "quantita": 1}])},
+        {"riepilogo_id": 3, "numero_parziale": 1, "dati": [{"model_number": "B", "quantita": 1}]},
+    ]
+    queries = []
+
+    class Tbl:
+        def __init__(self, name):
+            self.name, self.op = name, "select"
+            queries.append(self)
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def in_(self, col, vals): self.in_vals = vals; return self
+        def or_(self, cond): self.cond = cond; return self
+        def update(self, d): self.op, self.upd = "update", d; return self
+        def execute(self):
+            if self.name == "ordini_vendor_riepilogo":
+                if self.op == "update":
+                    for r in riepiloghi:
+                        if r["id"] in self.in_vals:
+                            r.update(self.upd)
+                return SimpleNamespace(data=riepiloghi)
+            return SimpleNamespace(data=parziali if self.op == "select" else [])
+
+    moved = []
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=Tbl))
+
+    def _move(c, d, n):
+        moved.append((c, n))
+        if moved.count(("FC3", 1)) == 1 and c == "FC3":
+            raise APIError({"code": "40P01", "message": "deadlock detected"})
+        return {"moved": 1, "failures": []}
+
+    monkeypatch.setattr(mod, "_move_parziale_to_trasferito", _move)
+
+    res = client.post("/api/amazon/vendor/parziali-wip/conferma-parziali-bulk", json={"items": [
+        {"center": "FC1", "data": "2025-01-10"}, {"center": "FC2", "data": "2025-01-10"},
+        {"center": "FC3", "data": "2025-01-10"}, {"center": "FC9", "data": "2025-01-10"}]})
+    assert res.status_code == 200
+    out = {r["center"]: r for r in res.get_json()["results"]}
+    assert out["FC1"]["ok"] and out["FC1"]["numero_parziale"] == 2
+    assert out["FC2"]["ok"] and out["FC3"]["ok"]
+    assert out["FC9"]["ok"] is False and "non trovato" in out["FC9"]["error"]
+    # riepiloghi, WIP, conferma, stato, verifica: una query ciascuno
+    assert len(queries) == 5
+    assert "and(riepilogo_id.eq.1,numero_parziale.eq.2)" in queries[2].cond
+    # FC3 va in deadlock nell'ondata parallela: rieseguito in sequenza alla fine, senza warning
+    assert sorted(moved) == [("FC1", 2), ("FC2", 1), ("FC3", 1), ("FC3", 1)]
+    assert moved[-1] == ("FC3", 1) and "warning" not in out["FC3"]
+    # FC1 e FC2 condividono lo SKU A -> ondate diverse; FC3 va in parallelo con FC1
+    waves = mod._ondate_sku_disgiunti([
+        {"key": "FC1", "skus": {"A"}}, {"key": "FC2", "skus": {"A"}}, {"key": "FC3", "skus": {"B"}}])
+    assert [[j["key"] for j in w] for w in waves] == [["FC1", "FC3"], ["FC2"]]
+
+
+def test_conferma_parziali_bulk_thread_che_finiscono_in_ordine_diverso(client, monkeypatch):
+    import time
+    import app.routes.amazon_vendor as mod
+    centri = ["FC1", "FC2", "FC3"]
+    riepiloghi = [{"id": i, "fulfillment_center": c, "start_delivery": "2025-01-10", "stato_ordine": "nuovo"}
+                  for i, c in enumerate(centri, 1)]
+    parziali = [{"riepilogo_id": i, "numero_parziale": 1, "dati": [{"model_number": f"S{i}", "quantita": 1}]}
+                for i in range(1, 4)]
+
+    class Tbl:
+        def __init__(self, name): self.name, self.op = name, "select"
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def in_(self, *a): return self
+        def or_(self, *a): return self
+        def update(self, d): self.op, self.upd = "update", d; return self
+        def execute(self):
+            if self.name == "ordini_vendor_riepilogo":
+                if self.op == "update":
+                    for r in riepiloghi:
+                        r.update(self.upd)
+                return SimpleNamespace(data=riepiloghi)
+            return SimpleNamespace(data=parziali if self.op == "select" else [])
+
+    finiti = []
+
+    def _move(c, d, n):
+        # finiscono nell'ordine di avvio, con gli altri thread ancora attivi
+        time.sleep({"FC1": 0.05, "FC2": 0.1, "FC3": 0.15}[c])
+        finiti.append(c)
+        return {"moved": 1, "failures": []}
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=Tbl))
+    monkeypatch.setattr(mod, "_move_parziale_to_trasferito", _move)
+
+    res = client.post("/api/amazon/vendor/parziali-wip/conferma-parziali-bulk",
+                      json={"items": [{"center": c, "data": "2025-01-10"} for c in centri]})
+    assert res.status_code == 200
+    assert finiti == ["FC1", "FC2", "FC3"]
+    assert all(r["ok"] and r["transfer_report"]["moved"] == 1 for r in res.get_json()["results"])
+
+
+def test_lista_produzione_keyset_proiezione_etag(monkeypatch):
+    mod = importlib.import_module("app.routes.produzione")
+    rows = [{"id": i, "sku": f"S{i}", "start_delivery": "2025-01-10"} for i in range(1, 4)]
+    seen = []
+
+    class T:
+        def __init__(self, name): self.name, self.ors, self.eqs, self.lim, self.count = name, [], [], None, None
+        def select(self, cols, count=None, head=False): self.cols, self.count = cols, count; return self
+        def eq(self, *a, **k): self.eqs.append(a); return self
+        def or_(self, f): self.ors.append(f); return self
+        def order(self, *a, **k): return self
+        def limit(self, n): self.lim = n; return self
+        def execute(self):
+            seen.append(self)
+            if self.count:
+                return SimpleNamespace(data=[], count=1)
+            return SimpleNamespace(data=rows[: self.lim])
+
+    counters = {"produzione": {"stato_produzione": {"Da Stampare": 3}, "radice": {"R": 3}, "canale": {}}}
+    version = {"n": 7}
+    rpcs = []
+
+    def rpc(name, args):
+        rpcs.append(name)
+        data = version["n"] if name == "produzione_vendor_version_get" else counters
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=data))
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=T, rpc=rpc))
+    monkeypatch.setattr(mod, "_badge_cache", {"at": 0.0, "version": None, "data": None})
+    app = Flask(__name__)
+    app.register_blueprint(mod.bp)
+    client = app.test_client()
+
+    r1 = client.get("/api/produzione?limit=2&fields=sku,radice")
+    js = r1.get_json()
+    assert [r["id"] for r in js["data"]] == [1, 2] and js["total"] == 3
+    assert seen[-1].cols == "id,start_delivery,sku,radice" and seen[-1].lim == 3
+    assert mod._decode_cursor(js["next_cursor"]) == ("2025-01-10", "S2", 2)
+
+    client.get(f"/api/produzione?limit=2&cursor={js['next_cursor']}")
+    assert seen[-1].ors == ['start_delivery.gt.2025-01-10,and(start_delivery.eq.2025-01-10,sku.gt."S2"),'
+                           'and(start_delivery.eq.2025-01-10,sku.eq."S2",id.gt.2)']
+
+    # totale calcolato con gli stessi filtri della pagina
+    n = len(seen)
+    js = client.get("/api/produzione?limit=2&radice=R&search=S1").get_json()
+    assert js["total"] == 1
+    cnt, page = seen[n:]
+    assert cnt.count == "exact" and cnt.eqs == page.eqs == [("radice", "R")]
+    assert cnt.ors == page.ors == ["sku.ilike.%S1%,ean.ilike.%S1%"]
+
+    n, r = len(seen), len(rpcs)
+    r3 = client.get("/api/produzione?limit=2&fields=sku,radice", headers={"If-None-Match": r1.headers["ETag"]})
+    assert r3.status_code == 304
+    assert seen[n:] == [] and rpcs[r:] == ["produzione_vendor_version_get"]   # righe non rilette
+
+    # un commit su produzione_vendor cambia la versione -> niente 304, badge riletti
+    assert rpcs.count("badge_counters_get") == 1
+    version["n"] = 8
+    counters["produzione"]["stato_produzione"] = {"Da Stampare": 2, "Cucito": 1}
+    r4 = client.get("/api/produzione?limit=2&fields=sku,radice", headers={"If-None-Match": r1.headers["ETag"]})
+    assert r4.status_code == 200 and r4.headers["ETag"] != r1.headers["ETag"]
+    assert r4.get_json()["badge_stati"] == {"Da Stampare": 2, "Cucito": 1}
+
+    assert client.get("/api/produzione?fields=id;drop").status_code == 400
+    assert client.get("/api/produzione?cursor=xyz").status_code == 400
+
+
+def test_log_movimenti_canale_in_una_query(monkeypatch):
+    mod = importlib.import_module("app.routes.produzione")
+    logs = [
+        {"id": i, "sku": "S1", "ean": "E1", "motivo": "Cambio stato", "utente": "mario",
+         "created_at": f"2025-01-10T10:0{i}:00Z", "canale": None, "dettaglio": {}}
+        for i in range(1, 4)
+    ] + [{"id": 9, "sku": "S2", "ean": None, "motivo": "Cambio stato", "utente": "mario",
+          "created_at": "2025-01-10T11:00:00Z", "dettaglio": '{"canale": "Sito"}'}]
+    queries = []
+
+    class T:
+        def __init__(self, name): self.name = name; queries.append(name)
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def in_(self, *a, **k): return self
+        def order(self, *a, **k): return self
+        def execute(self):
+            if self.name == "movimenti_produzione_vendor":
+                return SimpleNamespace(data=[dict(l) for l in logs])
+            return SimpleNamespace(data=[
+                {"id": 1, "sku": "S1", "ean": "E1", "start_delivery": None, "canale": "Amazon Vendor"},
+                {"id": 2, "sku": "S1", "ean": "E1", "start_delivery": None, "canale": "Seller"}])
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=T))
+    app = Flask(__name__)
+    app.register_blueprint(mod.bp)
+
+    out = app.test_client().get("/api/produzione/7/log").get_json()
+    assert queries == ["movimenti_produzione_vendor", "produzione_vendor"]
+    labels = {l["id"]: l["canale_label"] for l in out}
+    assert labels == {1: "Amazon Vendor", 2: "Amazon Vendor", 3: "Amazon Vendor", 9: "Sito"}
+
+
+def test_coalesce_logs_finestra_con_bisect():
+    mod = importlib.import_module("app.routes.produzione")
+    base = {"sku": "S1", "ean": "E1", "stato_nuovo": "Stampato", "qty_nuova": 4}
+    logs = [
+        dict(base, id=1, utente="mario", motivo="Cambio stato", created_at="2025-01-10T10:00:00Z"),
+        dict(base, id=2, utente="postgres", motivo="Trigger UPDATE", created_at="2025-01-10T10:00:02Z"),
+        dict(base, id=3, utente="postgres", motivo="Trigger UPDATE", created_at="2025-01-10T10:00:09Z"),
+        dict(base, id=4, utente="postgres", motivo="Trigger UPDATE", created_at="2025-01-10T10:00:01Z",
+             qty_nuova=5),
+    ]
+    assert [l["id"] for l in mod._coalesce_logs(logs, window_seconds=3)] == [1, 3, 4]
+
+
+def test_log_movimenti_paginati_con_before(monkeypatch):
+    mod = importlib.import_module("app.routes.produzione")
+    logs = [{"id": i, "sku": "S1", "ean": "E1", "canale": "Sito", "stato_nuovo": "Stampato", "qty_nuova": 1,
+             "utente": "mario" if i == 3 else "postgres", "motivo": "Cambio stato" if i == 3 else "Trigger UPDATE",
+             "created_at": f"2025-01-10T10:00:0{sec}+00:00"}
+            for i, sec in zip(range(1, 6), (0, 1, 3, 5, 9))]
+    seen = []
+
+    class T:
+        def __init__(self, name): self.f, self.lim, self.ors = [], None, []
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def or_(self, f): self.ors.append(f); return self
+        def gte(self, c, v): self.f.append(lambda r: r[c] >= v); return self
+        def lte(self, c, v): self.f.append(lambda r: r[c] <= v); return self
+        def order(self, *a, **k): return self
+        def limit(self, n): self.lim = n; return self
+        def execute(self):
+            seen.append(self)
+            rows = sorted(logs, key=lambda r: r["created_at"], reverse=True)
+            if self.ors:
+                rows = [r for r in rows if r["id"] < 4]
+            rows = [dict(r) for r in rows if all(fn(r) for fn in self.f)]
+            return SimpleNamespace(data=rows[: self.lim] if self.lim else rows)
+
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=T))
+    app = Flask(__name__)
+    app.register_blueprint(mod.bp)
+    client = app.test_client()
+
+    p1 = client.get("/api/produzione/7/log?limit=2").get_json()
+    # il trigger id 4 è coperto dall'azione umana id 3 (contesto, pagina successiva)
+    assert [l["id"] for l in p1["data"]] == [5]
+    assert mod._unpack_cursor(p1["next_before"]) == ["2025-01-10T10:00:05+00:00", 4]
+
+    p2 = client.get(f"/api/produzione/7/log?limit=2&before={p1['next_before']}").get_json()
+    assert [l["id"] for l in p2["data"]] == [3] and p2["next_before"]
+    assert "id.lt.4" in seen[-2].ors[0]
+    assert client.get("/api/produzione/7/log?before=zzz").status_code == 400
+
+
+# -------------------------------------------------------------
+# Fake condiviso per i test delle RPC: risposte per nome funzione, RPC non
+# deployate (PGRST202 -> percorso legacy) e tabelle in memoria per il legacy.
+# -------------------------------------------------------------
+class _FakeDB:
+    def __init__(self, rpc=None, tables=None):
+        self.rpc_data = dict(rpc or {})
+        self.tables = None if tables is None else {k: [dict(r) for r in v] for k, v in tables.items()}
+        self.calls, self.logs = [], []
+        self._next_id = 1000
+
+    def rpc(self, name, args):
+        self.calls.append((name, args))
+
+        def _execute():
+            if name not in self.rpc_data:
+                raise APIError({"code": "PGRST202", "message": f"Could not find the function public.{name}"})
+            data = self.rpc_data[name]
+            return SimpleNamespace(data=data(args) if callable(data) else data)
+        return SimpleNamespace(execute=_execute)
+
+    def table(self, name):
+        if self.tables is None:
+            raise AssertionError(f"nessuna query diretta attesa su {name}")
+        return _FakeDBQuery(self, name)
+
+    def row(self, table, id_):
+        return next((r for r in self.tables.get(table, []) if r.get("id") == id_), None)
+
+
+class _FakeDBQuery:
+    def __init__(self, db, name):
+        self.db, self.name, self.op, self.payload, self.filters = db, name, "select", None, []
+        self._single = False
+
+    def select(self, *a, **k):
+        return self
+
+    def order(self, *a, **k):
+        return self
+
+    def limit(self, *a):
+        return self
+
+    def single(self):
+        self._single = True
+        return self
+
+    def eq(self, col, val):
+        self.filters.append(lambda r: r.get(col) == val)
+        return self
+
+    def in_(self, col, vals):
+        vals = set(vals)
+        self.filters.append(lambda r: r.get(col) in vals)
+        return self
+
+    def is_(self, col, val):
+        self.filters.append(lambda r: r.get(col) is None)
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def upsert(self, payload, on_conflict=None):
+        self.op, self.payload, self.conflict = "upsert", payload, on_conflict
+        return self
+
+    def delete(self):
+        self.op = "delete"
+        return self
+
+    def execute(self):
+        rows = self.db.tables.setdefault(self.name, [])
+        match = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "select":
+            out = [dict(r) for r in match]
+            return SimpleNamespace(data=(out[0] if out else None) if self._single else out)
+        if self.op == "update":
+            for r in match:
+                r.update(self.payload)
+            return SimpleNamespace(data=[dict(r) for r in match])
+        if self.op == "delete":
+            rows[:] = [r for r in rows if r not in match]
+            return SimpleNamespace(data=match)
+        out = []
+        for p in (self.payload if isinstance(self.payload, list) else [self.payload]):
+            same = [r for r in rows if self.op == "upsert" and r.get(self.conflict) == p.get(self.conflict)]
+            if same:
+                same[0].update(p)
+                out.append(dict(same[0]))
+                continue
+            self.db._next_id += 1
+            rows.append({"id": self.db._next_id, **p})
+            out.append(dict(rows[-1]))
+        return SimpleNamespace(data=out)
+
+
+@pytest.fixture()
+def fake_db(monkeypatch):
+    """fake_db(mod, rpc={nome: data|callable}, tables={...}) installa _FakeDB sul modulo."""
+    def _install(mod, rpc=None, tables=None):
+        db = _FakeDB(rpc, tables)
+        monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+        monkeypatch.setattr(mod, "supabase", db)
+        monkeypatch.setattr(mod, "sb_table", db.table)
+        monkeypatch.setattr(mod, "log_movimento_produzione",
+                            lambda row, utente, motivo, **kw: db.logs.append((row.get("id"), motivo)))
+        return db
+    return _install
+
+
+def _produzione_client(mod):
+    app = Flask(__name__)
+    app.register_blueprint(mod.bp)
+    return app.test_client()
+
+
+def _pv(id_, sku, stato, da_produrre, **extra):
+    return {"id": id_, "sku": sku, "ean": extra.pop("ean", None), "start_delivery": "2025-02-01",
+            "canale": "Amazon Vendor", "stato_produzione": stato, "da_produrre": da_produrre, "plus": 0, **extra}
+
+
+def test_patch_produzione_bulk_cambio_stato_una_rpc(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, rpc={"produzione_move_bulk": {"moved_qty": 12, "moved": []}})
+
+    res = _produzione_client(mod).patch("/api/produzione/bulk", json={
+        "ids": [3, 1], "fields": {"stato_produzione": "Calandrato", "plus": 2}})
+    assert res.get_json() == {"ok": True, "moved_qty": 12}
+    assert db.calls == [("produzione_move_bulk", {
+        "p_moves": [{"from_id": 3, "to_state": "Calandrato"}, {"from_id": 1, "to_state": "Calandrato"}],
+        "p_fields": {"plus": 2}, "p_user_label": "Sistema"})]
+
+
+def test_patch_produzione_bulk_fallback_legacy(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, tables={"produzione_vendor": [
+        _pv(1, "A", "Stampato", 3, ean="E1"),
+        _pv(2, "A", "Calandrato", 5, ean="E1"),      # target esistente: merge
+        _pv(3, "B", "Stampato", 2),                  # target da creare
+        _pv(4, "C", "Stampato", 0),                  # senza quantità: solo i campi
+        _pv(5, "D", "Calandrato", 4),                # già nello stato: solo i campi
+    ]})
+
+    res = _produzione_client(mod).patch("/api/produzione/bulk", json={
+        "ids": [1, 3, 4, 5], "fields": {"stato_produzione": "Calandrato", "plus": 1}})
+    assert res.get_json() == {"ok": True, "moved_qty": 5}
+    assert db.calls[0][0] == "produzione_move_bulk"
+
+    assert db.row("produzione_vendor", 1) is None and db.row("produzione_vendor", 3) is None
+    assert db.row("produzione_vendor", 2)["da_produrre"] == 8 and db.row("produzione_vendor", 2)["plus"] == 1
+    nuova = [r for r in db.tables["produzione_vendor"] if r["sku"] == "B"]
+    assert [(r["stato_produzione"], r["da_produrre"], r["plus"]) for r in nuova] == [("Calandrato", 2, 1)]
+    assert {k: db.row("produzione_vendor", 4)[k] for k in ("stato_produzione", "da_produrre", "plus")} == {
+        "stato_produzione": "Stampato", "da_produrre": 0, "plus": 1}
+    assert {k: db.row("produzione_vendor", 5)[k] for k in ("stato_produzione", "da_produrre", "plus")} == {
+        "stato_produzione": "Calandrato", "da_produrre": 4, "plus": 1}
+    assert [m for m in db.logs if m[1] == "Spostamento a Calandrato"] == [
+        (2, "Spostamento a Calandrato"), (nuova[0]["id"], "Spostamento a Calandrato")]
+
+
+def test_log_sink_blocchi_e_spool(tmp_path):
+    from app.common.log_sink import BufferedLogSink
+    inserted, down = [], {"on": False}
+
+    def _many(rows):
+        if down["on"]:
+            raise RuntimeError("db giù")
+        inserted.append(list(rows))
+
+    sink = BufferedLogSink("test", _many, mode="request", batch_size=2,
+                           spool_path=str(tmp_path / "spool.jsonl"))
+    for i in range(3):
+        sink.write({"i": i})
+    assert inserted == [] and sink.pending() == 3
+    assert sink.flush() == 3
+    assert inserted == [[{"i": 0}, {"i": 1}], [{"i": 2}]]
+
+    down["on"] = True
+    sink.write({"i": 3})
+    sink.flush()
+    assert (tmp_path / "spool.jsonl").exists() and len(inserted) == 2
+
+    down["on"] = False
+    sink.write({"i": 4})
+    sink.flush()
+    assert inserted[2:] == [[{"i": 4}], [{"i": 3}]]
+    assert not (tmp_path / "spool.jsonl").exists()
+
+
+def test_log_sink_errore_di_rete_e_coda_limitata(tmp_path):
+    import httpx
+    from app.common.log_sink import BufferedLogSink
+    inserted, singole = [], []
+
+    def _many(rows):
+        raise httpx.ConnectError("connessione rifiutata")
+
+    spool = tmp_path / "spool.jsonl"
+    sink = BufferedLogSink("test", _many, insert_one=singole.append, mode="request",
+                           batch_size=2, spool_path=str(spool), max_pending=4)
+    for i in range(5):
+        sink.write({"i": i})
+    # oltre max_pending i record più vecchi passano nello spool
+    assert sink.pending() == 3
+    assert [json.loads(l)["i"] for l in spool.read_text().splitlines()] == [0, 1]
+
+    sink.flush()
+    # errore di rete: nessun retry riga per riga, il blocco va nello spool
+    assert singole == [] and sink.pending() == 0
+    assert sorted(json.loads(l)["i"] for l in spool.read_text().splitlines()) == [0, 1, 2, 3, 4]
+
+    sink._insert_many = inserted.append
+    sink.write({"i": 5})
+    sink.flush()
+    assert [r["i"] for b in inserted for r in b] == [5, 0, 1, 2, 3, 4]
+    assert not spool.exists()
+
+
+def test_delete_produzione_bulk_una_rpc(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, rpc={"produzione_delete_bulk": {"deleted": 3, "log_deleted": 8}})
+
+    res = _produzione_client(mod).delete("/api/produzione/bulk", json={"ids": [4, 5, 6]})
+    assert res.get_json() == {"ok": True, "deleted_count": 3}
+    assert db.calls == [("produzione_delete_bulk", {"p_ids": [4, 5, 6]})]
+
+
+def test_delete_produzione_bulk_fallback_legacy(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, tables={
+        "produzione_vendor": [_pv(4, "A", "Stampato", 1), _pv(5, "B", "Stampato", 2), _pv(7, "C", "Cucito", 3)],
+        "movimenti_produzione_vendor": [{"id": 1, "produzione_id": 4}, {"id": 2, "produzione_id": 4},
+                                        {"id": 3, "produzione_id": 7}],
+    })
+
+    res = _produzione_client(mod).delete("/api/produzione/bulk", json={"ids": [4, 5, 6]})
+    assert res.get_json() == {"ok": True, "deleted_count": 2}     # la 6 non esiste
+    assert [r["id"] for r in db.tables["produzione_vendor"]] == [7]
+    assert db.tables["movimenti_produzione_vendor"] == [{"id": 3, "produzione_id": 7}]
+
+
+def test_retarget_qty_rpc_e_bulk(client, fake_db):
+    import app.routes.amazon_vendor as mod
+    db = fake_db(mod, rpc={
+        "retarget_qty_rpc": 77,
+        "retarget_qty_bulk": {"moved_qty": 5, "moved": [{"src_id": 1, "target_id": 9, "qty": 5}], "skipped": [2]},
+    })
+
+    assert mod._retarget_qty_to_date(3, "2025-02-01", 4, "Sistema") == 77
+    assert db.calls[-1] == ("retarget_qty_rpc", {
+        "p_src_id": 3, "p_new_date": "2025-02-01", "p_qty": 4, "p_user_label": "Sistema"})
+
+    res = client.post("/api/amazon/vendor/produzione/retarget", json={
+        "start_delivery": "2025-02-01", "items": [{"id": 1, "qty": 5}, {"id": 2}]})
+    assert res.get_json()["moved_qty"] == 5 and res.get_json()["skipped"] == [2]
+    assert db.calls[-1][0] == "retarget_qty_bulk"
+    assert db.calls[-1][1]["p_items"] == [{"src_id": 1, "qty": 5}, {"src_id": 2, "qty": None}]
+    assert client.post("/api/amazon/vendor/produzione/retarget",
+                       json={"start_delivery": "x", "items": [{"id": 1}]}).status_code == 400
+
+
+def test_retarget_qty_fallback_legacy(client, fake_db):
+    import app.routes.amazon_vendor as mod
+    db = fake_db(mod, tables={"produzione_vendor": [
+        _pv(1, "A", "Cucito", 5),                                  # qty parziale -> nuova riga
+        _pv(2, "B", "Cucito", 3),                                  # tutta -> merge sulla target
+        _pv(3, "B", "Cucito", 4, start_delivery="2025-03-01"),     # già sulla data: saltata
+    ]})
+
+    res = client.post("/api/amazon/vendor/produzione/retarget", json={
+        "start_delivery": "2025-03-01", "items": [{"id": 2}, {"id": 1, "qty": 2}, {"id": 3}, {"id": 99}]})
+    nuova = [r for r in db.tables["produzione_vendor"] if r["sku"] == "A" and r["start_delivery"] == "2025-03-01"]
+    assert res.get_json() == {"ok": True, "moved_qty": 5, "skipped": [3, 99], "moved": [
+        {"src_id": 1, "target_id": nuova[0]["id"], "qty": 2}, {"src_id": 2, "target_id": 3, "qty": 3}]}
+    assert db.row("produzione_vendor", 1)["da_produrre"] == 3 and nuova[0]["da_produrre"] == 2
+    assert db.row("produzione_vendor", 2) is None and db.row("produzione_vendor", 3)["da_produrre"] == 7
+
+    # singola: la qty richiesta oltre la disponibilità viene limitata, sorgente svuotata e cancellata
+    assert mod._retarget_qty_to_date(1, "2025-03-01", 10, "Sistema") == nuova[0]["id"]
+    assert db.row("produzione_vendor", 1) is None and db.row("produzione_vendor", nuova[0]["id"])["da_produrre"] == 5
+    assert [c[0] for c in db.calls] == ["retarget_qty_bulk", "retarget_qty_rpc"]
+
+
+def test_produzione_manuale_batch_upsert(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, rpc={"produzione_manuale_upsert": lambda args: [
+        {"id": 10 + i, "sku": it["sku"], "aggregated": i == 0} for i, it in enumerate(args["p_items"])]})
+    client = _produzione_client(mod)
+
+    res = client.post("/api/produzione/manuale/batch", json={"items": [
+        {"canale": "Sito", "sku": "A1", "qty": 2},
+        {"canale": "Amazon Seller", "sku": "B2", "ean": "123", "qty": "3", "plus": 1,
+         "start_delivery": "2025-02-01", "note": "x"}]})
+    assert [r["id"] for r in res.get_json()["righe"]] == [10, 11]
+    assert len(db.calls) == 1 and db.calls[0][0] == "produzione_manuale_upsert"
+    assert db.calls[0][1]["p_items"][1] == {
+        "sku": "B2", "ean": "123", "canale": "Amazon Seller", "qty": 3, "plus": 1,
+        "start_delivery": "2025-02-01", "note": "x", "cavallotti": False}
+
+    bad = client.post("/api/produzione/manuale/batch", json={"items": [
+        {"canale": "Sito", "sku": "A1", "qty": 2}, {"canale": "Sito", "sku": "A2", "qty": 0}]})
+    assert bad.status_code == 400 and "Voce 2" in bad.get_json()["error"]
+    assert len(db.calls) == 1
+
+    one = client.post("/api/produzione/manuale", json={"canale": "Sito", "sku": "C3", "qty": 1})
+    assert one.get_json() == {"ok": True, "id": 10, "aggregated": True}
+
+
+def test_produzione_manuale_batch_fallback_legacy(fake_db):
+    mod = importlib.import_module("app.routes.produzione")
+    db = fake_db(mod, tables={"produzione_vendor": [
+        _pv(1, "A1", "Da Stampare", 3, canale="Sito", start_delivery=None, qty=3)]})
+
+    res = _produzione_client(mod).post("/api/produzione/manuale/batch", json={"items": [
+        {"canale": "Sito", "sku": "A1", "qty": 2, "plus": 1},           # merge sulla riga esistente
+        {"canale": "Sito", "sku": "B2", "qty": 1, "note": "x"},
+        {"canale": "Sito", "sku": "B2", "qty": 2, "note": "y"},         # stessa chiave: sommata
+        {"canale": "Amazon Seller", "sku": "A1", "qty": 1}]})           # altro canale: nuova riga
+    righe = res.get_json()["righe"]
+    assert [(r["sku"], r["canale"], r["da_produrre"], r["aggregated"]) for r in righe] == [
+        ("A1", "Sito", 6, True), ("B2", "Sito", 3, False), ("A1", "Amazon Seller", 1, False)]
+    assert righe[0]["id"] == 1 and set(righe[0]) == {
+        "id", "sku", "ean", "canale", "start_delivery", "da_produrre", "aggregated"}
+    assert {k: db.row("produzione_vendor", 1)[k] for k in ("da_produrre", "qty", "plus")} == {
+        "da_produrre": 6, "qty": 6, "plus": 0}
+    b2 = db.row("produzione_vendor", righe[1]["id"])
+    assert (b2["da_produrre"], b2["note"], b2["stato_produzione"]) == (3, "y", "Da Stampare")
+    assert db.logs == [(righe[1]["id"], "Inserimento manuale"), (righe[2]["id"], "Inserimento manuale")]
+
+
+def test_catalog_index_ricerca_e_aggiornamenti(client, monkeypatch):
+    from app.services.catalog_index import CatalogIndex
+    import app.routes.amazon_vendor as mod
+    prodotti = [
+        {"id": 1, "shopify_variant_id": "v1", "shopify_product_id": "p1", "sku": "TAPP-ROSSO-120",
+         "ean": "800111", "variant_title": "120x60", "product_title": "Tappeto cucina", "updated_at": "2025-01-01"},
+        {"id": 2, "shopify_variant_id": "v2", "shopify_product_id": "p1", "sku": "TAPP-BLU-120",
+         "ean": "800222", "variant_title": "120x60", "product_title": "Tappeto cucina", "updated_at": "2025-01-03"},
+        {"id": 3, "shopify_variant_id": "v3", "shopify_product_id": "p2", "sku": "COPRI-BLU",
+         "ean": "800333", "variant_title": "", "product_title": "Copridivano", "updated_at": "2025-01-02"},
+    ]
+    idx = CatalogIndex(loader=lambda: [dict(p) for p in prodotti], ttl=3600)
+    assert not idx.ready                          # non ancora caricato: search() -> None, la route usa il DB
+    idx.refresh()
+
+    assert [r["id"] for r in idx.search("blu", 10)] == [3, 2]
+    assert [r["id"] for r in idx.search("cucina blu", 10)] == [2]
+    assert [r["id"] for r in idx.search("800111", 10)] == [1]
+    assert [r["id"] for r in idx.search("120 ROSSO;", 10)] == [1, 2]
+    assert idx.search("cucinablu", 10) == []      # niente match a cavallo tra campi
+    assert [r["id"] for r in idx.search("cuc", 10)] == [2, 1]
+    assert idx.search("ucina", 10) == []          # titoli: solo a inizio parola
+    assert [r["id"] for r in idx.search("co", 10)] == [3]   # token corto: scansione
+    assert not any(len(g) == 2 for g in idx._grams)          # niente postings da 2 caratteri
+    assert [r["id"] for r in idx.search("", 2)] == [2, 3]
+    assert set(idx.search("", 1)[0]) == {"id", "sku", "ean", "variant_title", "product_title", "image_url", "price"}
+
+    idx.upsert({"id": 2, "shopify_variant_id": "v2", "shopify_product_id": "p1", "sku": "TAPP-VERDE-120"})
+    assert [r["id"] for r in idx.search("blu", 10)] == [3]
+    assert [r["id"] for r in idx.search("verde cucina", 10)] == [2]
+    idx.remove_product("p1")
+    assert idx.search("tapp", 10) == [] and len(idx) == 1
+
+    # la route risponde dall'indice senza query
+    monkeypatch.setattr(mod, "catalogo", idx)
+    monkeypatch.setattr(mod, "sb_table", lambda name: (_ for _ in ()).throw(AssertionError(name)))
+    assert [r["id"] for r in client.get("/api/products/search?q=copri").get_json()] == [3]
+
+
+def test_site_orders_sku_summary_rpc_e_batch(client, fake_db):
+    import app.routes.amazon_vendor as mod
+    db = fake_db(mod, rpc={"site_orders_sku_summary": [{"sku": "A1", "orders_count": 2, "total_qty": 5}]})
+
+    res = client.get("/api/orders/site/sku-summary?sku=A1")
+    assert res.get_json() == {"orders_count": 2, "total_qty": 5}
+    assert db.calls[-1] == ("site_orders_sku_summary", {"p_skus": ["A1"]})
+
+    res = client.post("/api/orders/site/sku-summary/batch", json={"skus": ["A1", "B2", "A1"]})
+    assert res.get_json() == {"A1": {"orders_count": 2, "total_qty": 5},
+                              "B2": {"orders_count": 0, "total_qty": 0}}
+    assert db.calls[-1][1] == {"p_skus": ["A1", "B2"]}
+    assert client.get("/api/orders/site/sku-summary/batch?skus=B2").get_json() == {
+        "B2": {"orders_count": 0, "total_qty": 0}}
+
+
+def test_site_orders_sku_summary_fallback_legacy(client, fake_db):
+    import app.routes.amazon_vendor as mod
+    db = fake_db(mod, tables={
+        "order_items": [{"order_id": 1, "sku": "A1", "quantity": 2},
+                        {"order_id": 3, "sku": "A1", "quantity": 4},
+                        {"order_id": 2, "sku": "A1", "quantity": 3},
+                        {"order_id": 2, "sku": "B2", "quantity": 1},
+                        {"order_id": 1, "sku": "Z9", "quantity": 7}],
+        "orders": [{"id": 1, "fulfillment_status": "inevaso"},
+                   {"id": 2, "fulfillment_status": "evaso"},
+                   {"id": 3, "fulfillment_status": "inevaso"}],
+    })
+
+    assert mod._site_orders_summary(["A1", "B2"]) == {
+        "A1": {"orders_count": 2, "total_qty": 6},
+        "B2": {"orders_count": 0, "total_qty": 0}}
+    assert client.get("/api/orders/site/sku-summary?sku=B2").get_json() == {"orders_count": 0, "total_qty": 0}
+    assert [c[0] for c in db.calls] == ["site_orders_sku_summary"] * 2
+
+
+def test_spapi_token_cache_refresh_ahead():
+    from app.common.spapi import SpapiTokenCache
+    now = [0.0]
+    fetched = []
+
+    def _fetch():
+        fetched.append(now[0])
+        return f"tok{len(fetched)}", 3600
+
+    cache = SpapiTokenCache(fetch=_fetch, refresh_ahead=300, clock=lambda: now[0])
+    assert cache.get() == "tok1"
+    now[0] = 1000
+    assert cache.get() == "tok1" and len(fetched) == 1      # in cache, nessuno scambio LWA
+
+    now[0] = 3400                                           # dentro la finestra di anticipo
+    assert cache.get() == "tok1"                            # intanto il token ancora valido
+    cache._bg.join(2)
+    assert cache.get() == "tok2" and fetched == [0.0, 3400]
+
+    cache.invalidate()
+    assert cache.get() == "tok3"
+
+
+def test_vendor_po_sync_pagina_e_watermark():
+    import threading
+    import requests as _requests
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+    from datetime import timezone
+    from app.jobs import vendor_po_sync as sync
+
+    def _po(num, fc, window, items):
+        return {"purchaseOrderNumber": num, "purchaseOrderState": "New", "orderDetails": {
+            "purchaseOrderDate": "2025-08-01T10:00:00Z", "deliveryWindow": window,
+            "shipToParty": {"partyId": fc}, "sellingParty": {"partyId": "VND"},
+            "items": items}}
+
+    pagine = {
+        None: {"orders": [_po("PO1", "MXP5", "2025-08-11T00:00:00Z--2025-08-15T00:00:00Z", [
+            {"itemSequenceNumber": "1", "vendorProductIdentifier": "SKU-A", "amazonProductIdentifier": "B01",
+             "orderedQuantity": {"amount": 2, "unitOfMeasure": "Cases", "unitSize": 6},
+             "netCost": {"amount": "3.50"}}])],
+               "pagination": {"nextToken": "p2"}},
+        "p2": {"orders": [_po("PO2", "MXP5", "2025-08-11T00:00:00Z--2025-08-15T00:00:00Z", [
+            {"itemSequenceNumber": "1", "vendorProductIdentifier": "SKU-B",
+             "orderedQuantity": {"amount": 4, "unitOfMeasure": "Eaches"}}])]},
+    }
+    richieste = []
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            u = urlparse(self.path)
+            q = {k: v[0] for k, v in parse_qs(u.query).items()}
+            richieste.append((u.path, q, self.headers.get("x-amz-access-token")))
+            body = json.dumps({"payload": pagine[q.get("nextToken")]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+
+    db = _FakeDB(tables={"spapi_sync_state": [{"name": "vendor_purchase_orders",
+                                               "watermark": "2025-08-05T12:00:00+00:00"}],
+                         "products": [{"sku": "SKU-A", "ean": "8001"}]})
+    sb = db
+    adesso = datetime(2025, 8, 6, 9, 0, tzinfo=timezone.utc)
+    try:
+        res = sync.sync_vendor_purchase_orders(
+            sb, lambda: "tok", _requests.Session(),
+            endpoint=f"http://127.0.0.1:{srv.server_port}", now=adesso)
+    finally:
+        srv.shutdown()
+
+    assert [q.get("nextToken") for _, q, _ in richieste] == [None, "p2"]
+    assert richieste[0][0] == sync.PO_PATH and richieste[0][2] == "tok"
+    assert richieste[0][1]["changedAfter"] == "2025-08-05T11:55:00Z"   # watermark - overlap
+    assert richieste[0][1]["changedBefore"] == "2025-08-06T09:00:00Z"
+    assert res["po"] == 2 and res["righe"] == 2 and res["riepiloghi"] == 1
+
+    righe = db.tables["ordini_vendor_items"]
+    assert righe[0]["po_item_key"] == "PO1#1" and righe[0]["qty_ordered"] == 12
+    assert righe[0]["vendor_product_id"] == "8001"            # EAN dal catalogo, non lo SKU
+    assert righe[1]["vendor_product_id"] is None and "status" not in righe[0]
+    assert righe[0]["start_delivery"] == "2025-08-11" and righe[0]["fulfillment_center"] == "MXP5"
+    riep = db.tables["ordini_vendor_riepilogo"][0]
+    assert riep["po_list"] == ["PO1", "PO2"] and riep["totale_articoli"] == 16
+    assert db.tables["spapi_sync_state"][0]["watermark"] == adesso.isoformat()
+
+
+def test_import_vendor_orders_stream_xlsx_a_blocchi(monkeypatch):
+    from openpyxl import Workbook
+    mod = importlib.import_module("app.jobs.process_jobs")
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Articoli"
+    ws.append(["Report"])
+    ws.append([])
+    ws.append(list(mod.VENDOR_ORDERS_REQUIRED_COLUMNS))
+    for po, model, qty in [("PO1", "SKU-A", 3), ("PO1", "SKU-B", 2), ("PO2", "SKU-A", 5), ("PO2", "SKU-C", 1)]:
+        ws.append([po, "123", model, "B01", "T", 1.5, qty, 0,
+                   datetime(2025, 8, 11), datetime(2025, 8, 15), None, "OK", "VND", "MXP5"])
+    ws.append([None] * 14)
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+
+    inserti, lookups = [], []
+
+    class _Q:
+        def __init__(self, name):
+            self.name = name
+
+        def select(self, *a, **k):
+            return self
+
+        def in_(self, col, vals):
+            lookups.append(list(vals))
+            return self
+
+        def insert(self, payload):
+            inserti.append(payload)
+            return self
+
+        def execute(self):
+            # SKU-C del PO2 è già in tabella
+            found = [{"po_number": "PO2", "model_number": "SKU-C", "qty_ordered": 1,
+                      "start_delivery": "2025-08-11", "fulfillment_center": "MXP5"}]
+            return SimpleNamespace(data=found if lookups and "PO2" in lookups[-1] else [])
+
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=_Q))
+    esito = mod.import_vendor_orders_stream(mod.iter_vendor_order_rows(buf), chunk_size=2)
+
+    assert lookups == [["PO1"], ["PO2"]]                  # dedup per blocco, non sull'intera tabella
+    assert [len(b) for b in inserti] == [2, 1]            # un insert per blocco
+    assert inserti[0][0]["start_delivery"] == "2025-08-11" and inserti[0][0]["qty_ordered"] == 3
+    assert esito["importati"] == 3 and len(esito["doppioni"]) == 1
+    assert esito["gruppi"] == {("MXP5", "2025-08-11")}
+
+    vuoto = Workbook()
+    vuoto.active.title = "Articoli"
+    for riga in (["x"], [], ["ASIN"]):
+        vuoto.active.append(riga)
+    buf2 = io.BytesIO()
+    vuoto.save(buf2)
+    buf2.seek(0)
+    with pytest.raises(Exception, match="Colonna mancante"):
+        list(mod.iter_vendor_order_rows(buf2))
+
+
+def test_vendor_po_sync_adotta_righe_excel_senza_toccare_ean():
+    from app.jobs import vendor_po_sync as sync
+    db = _FakeDB(tables={"ordini_vendor_items": [{
+        "id": 7, "po_item_key": None, "po_number": "PO1", "model_number": "SKU-A",
+        "fulfillment_center": "MXP5", "vendor_product_id": "8001234567890", "title": "Plaid",
+        "status": "Accettato: in stock", "availability": "Accettato: in stock",
+        "qty_ordered": 10, "start_delivery": "2025-08-11", "created_at": "2025-08-01T08:00:00+00:00"}],
+        "ordini_vendor_riepilogo": [{"id": 1, "fulfillment_center": "MXP5", "start_delivery": "2025-08-11",
+                                     "po_list": ["PO1"], "totale_articoli": 10, "stato_ordine": "nuovo"}]})
+    po = {"purchaseOrderNumber": "PO1", "purchaseOrderState": "Acknowledged", "orderDetails": {
+        "purchaseOrderDate": "2025-08-01T10:00:00Z", "purchaseOrderChangedDate": "2025-08-03T10:00:00Z",
+        "deliveryWindow": "2025-08-12T00:00:00Z--2025-08-16T00:00:00Z",
+        "shipToParty": {"partyId": "MXP5"},
+        "items": [{"itemSequenceNumber": "1", "vendorProductIdentifier": "SKU-A",
+                   "orderedQuantity": {"amount": 8}}]}}
+
+    stats = sync.upsert_items(db, sync.po_to_rows(po))
+    assert stats == {"inserted": 0, "updated": 1, "adopted": 1,
+                     "gruppi_precedenti": {("MXP5", "2025-08-11")}}
+    # la data è cambiata: si ricalcolano sia il gruppo nuovo sia quello di prima
+    sync.aggiorna_riepiloghi(db, {("MXP5", "2025-08-12")} | stats["gruppi_precedenti"])
+    riep = {r["start_delivery"]: r for r in db.tables["ordini_vendor_riepilogo"]}
+    assert riep["2025-08-11"]["po_list"] == [] and riep["2025-08-11"]["totale_articoli"] == 0
+    assert riep["2025-08-12"]["po_list"] == ["PO1"] and riep["2025-08-12"]["totale_articoli"] == 8
+
+    stats = sync.upsert_items(db, sync.po_to_rows(po))       # secondo giro: trovata per po_item_key
+    assert stats == {"inserted": 0, "updated": 1, "adopted": 0,
+                     "gruppi_precedenti": {("MXP5", "2025-08-12")}}
+
+    (row,) = db.tables["ordini_vendor_items"]
+    assert row["po_item_key"] == "PO1#1" and row["qty_ordered"] == 8
+    assert row["start_delivery"] == "2025-08-12" and row["end_delivery"] == "2025-08-16"
+    assert row["vendor_product_id"] == "8001234567890" and row["title"] == "Plaid"
+    assert row["status"] == "Accettato: in stock" and row["created_at"] == "2025-08-01T08:00:00+00:00"
+
+
+def test_supa_with_retry_rpc_assente_senza_retry(monkeypatch):
+    from app.common import supa_retry
+    sleeps, calls = [], []
+    monkeypatch.setattr(supa_retry.time, "sleep", sleeps.append)
+
+    def _builder():
+        calls.append(1)
+        raise APIError({"code": "PGRST202", "message": "Could not find the function public.x"})
+
+    with pytest.raises(APIError) as ei:
+        supa_retry.supa_with_retry(_builder)
+    assert supa_retry.is_missing_rpc(ei.value)
+    assert calls == [1] and sleeps == []
+
+
+def test_log_sink_fk_violation_senza_retry(monkeypatch):
+    mod = importlib.import_module("app.routes.produzione")
+    from app.common import supa_retry
+    sleeps, inserted = [], []
+    monkeypatch.setattr(supa_retry.time, "sleep", sleeps.append)
+    monkeypatch.setattr(mod, "supa_with_retry", supa_retry.supa_with_retry)
+
+    class T:
+        def __init__(self, name): pass
+        def insert(self, rows): self.rows = rows; return self
+        def execute(self):
+            if any(r.get("produzione_id") == 99 for r in self.rows):
+                raise APIError({"code": "23503", "message": "violates foreign key constraint"})
+            inserted.extend(self.rows)
+            return SimpleNamespace(data=self.rows)
+
+    monkeypatch.setattr(mod, "supabase", SimpleNamespace(table=T))
+    sink = mod.BufferedLogSink("test", mod._insert_movimenti, mod._insert_movimento, mode="request")
+    sink.write({"produzione_id": 1, "motivo": "a"})
+    sink.write({"produzione_id": 99, "motivo": "b"})   # riga cancellata prima del flush
+    sink.flush()
+    assert sleeps == []
+    assert [(r["produzione_id"], r["motivo"]) for r in inserted] == [(1, "a"), (None, "b")]
+    assert inserted[1]["dettaglio"]["_missing_produzione_id"] == 99
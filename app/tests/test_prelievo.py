@@ -0,0 +1,127 @@
+# tests/test_prelievo.py
+# -------------------------------------------------------------
+# Pytest suite per repository/service dei prelievi.
+# Stesso approccio di test_amazon_vendor.py: finti builder Supabase
+# in memoria, monkeypatch sui moduli importati.
+# -------------------------------------------------------------
+
+import importlib
+import pytest
+from postgrest.exceptions import APIError
+
+
+class _R:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Rpc:
+    def __init__(self, fn):
+        self._fn = fn
+    def execute(self):
+        return _R(self._fn())
+
+
+@pytest.fixture()
+def repo(monkeypatch):
+    mod = importlib.import_module("app.repositories.prelievo_repo")
+    monkeypatch.setattr(mod, "supa_with_retry", lambda fn: fn())
+    return mod
+
+
+def test_import_da_ordini_usa_rpc(repo, monkeypatch):
+    calls = []
+
+    def _rpc(name, args):
+        calls.append((name, args))
+        return _Rpc(lambda: {"ok": True, "importati": 3, "totali": 3, "errors": []})
+
+    def _no_table(name):
+        raise AssertionError(f"nessuna query diretta attesa su {name}")
+
+    monkeypatch.setattr(repo, "supabase", type("S", (), {"rpc": staticmethod(_rpc)})())
+    monkeypatch.setattr(repo, "sb_table", _no_table)
+
+    out = repo.import_da_ordini("2025-01-10")
+    assert out == {"ok": True, "importati": 3, "totali": 3, "errors": []}
+    assert calls == [("prelievi_import_da_ordini", {"p_data": "2025-01-10"})]
+
+
+def test_import_da_ordini_fallback_se_rpc_assente(repo, monkeypatch):
+    items = [
+        {"model_number": "SKU-1", "vendor_product_id": "EAN1", "start_delivery": "2025-01-10",
+         "qty_ordered": 3, "fulfillment_center": "FC1"},
+        {"model_number": "SKU-1", "vendor_product_id": "EAN1", "start_delivery": "2025-01-10",
+         "qty_ordered": 2, "fulfillment_center": "FC2"},
+    ]
+    riepi = [{"fulfillment_center": "FC1", "start_delivery": "2025-01-10", "stato_ordine": "nuovo"}]
+    inserted, deletes = [], []
+
+    class T:
+        def __init__(self, name): self.name = name
+        def select(self, *a, **k): return self
+        def eq(self, *a, **k): return self
+        def neq(self, *a, **k): return self
+        def delete(self): deletes.append(self.name); return self
+        def insert(self, batch): inserted.extend(batch); return self
+        def execute(self):
+            if self.name == "ordini_vendor_items": return _R(items)
+            if self.name == "ordini_vendor_riepilogo": return _R(riepi)
+            return _R([])
+
+    def _rpc(name, args):
+        def _boom():
+            raise APIError({"code": "PGRST202", "message": "Could not find the function"})
+        return _Rpc(_boom)
+
+    monkeypatch.setattr(repo, "supabase", type("S", (), {"rpc": staticmethod(_rpc)})())
+    monkeypatch.setattr(repo, "sb_table", lambda name: T(name))
+
+    out = repo.import_da_ordini("2025-01-10")
+    assert out["ok"] is True and out["importati"] == 1
+    # un solo delete (niente doppio del_prelievi)
+    assert deletes == ["prelievi_ordini_amazon"]
+    assert inserted[0]["qty"] == 3 and inserted[0]["centri"] == {"FC1": 3}
+
+
+def test_prelievi_page_keyset_e_etag(repo, monkeypatch):
+    from flask import Flask
+    routes = importlib.import_module("app.routes.prelievo")
+
+    rows = [{"id": i, "sku": f"SKU-{i}", "start_delivery": "2025-01-10", "stato": "manca"} for i in range(1, 6)]
+    seen_select = []
+
+    class T:
+        def __init__(self): self._f = []; self._lim = None
+        def select(self, cols): seen_select.append(cols); return self
+        def eq(self, f, v): self._f.append(lambda r: str(r.get(f)) == str(v)); return self
+        def in_(self, f, vals): self._f.append(lambda r: r.get(f) in vals); return self
+        def gt(self, f, v): self._f.append(lambda r: r[f] > v); return self
+        def order(self, *a, **k): return self
+        def limit(self, n): self._lim = n; return self
+        def execute(self):
+            out = [r for r in rows if all(fn(r) for fn in self._f)]
+            return _R(out[: self._lim] if self._lim else out)
+
+    monkeypatch.setattr(repo, "sb_table", lambda name: T())
+    app = Flask(__name__)
+    app.register_blueprint(routes.bp)
+    client = app.test_client()
+
+    r1 = client.get("/api/prelievi/page?data=2025-01-10&limit=2&fields=sku")
+    js = r1.get_json()
+    assert [r["id"] for r in js["data"]] == [1, 2] and js["next_cursor"] == 2
+    assert seen_select[-1] == "id,sku"
+
+    r2 = client.get(f"/api/prelievi/page?data=2025-01-10&limit=2&cursor={js['next_cursor']}")
+    assert [r["id"] for r in r2.get_json()["data"]] == [3, 4]
+
+    etag = r1.headers["ETag"]
+    r3 = client.get("/api/prelievi/page?data=2025-01-10&limit=2&fields=sku",
+                    headers={"If-None-Match": etag})
+    assert r3.status_code == 304
+
+    assert client.get("/api/prelievi/page?fields=password").status_code == 400
+    for bad in ("abc", "%20", "-1", "2.5"):
+        r = client.get(f"/api/prelievi/page?data=2025-01-10&cursor={bad}")
+        assert r.status_code == 400 and r.get_json()["error"] == "cursor non valido"
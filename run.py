@@ -26,6 +26,7 @@ from app.routes.notecredito_amazon_reso import bp as notecredito_amazon_reso_bp
 from app.routes.notecredito import bp as notecredito_tools_bp
 from app.routes.produzione import bp as produzione_bp  # NEW
 from app.routes.prelievo import bp as prelievo_bp  # NEW
+from app.services.catalog_index import catalogo
 
 
 
@@ -65,6 +66,9 @@ def create_app():
     app.register_blueprint(cavallotti.bp)
     app.register_blueprint(jobs_bp)
     app.register_blueprint(prelievo_bp)  # NEW
+    # indice autocomplete prodotti: caricamento in background, non blocca l'avvio
+    catalogo.refresh_async()
+
     names = ", ".join(sorted(app.blueprints.keys()))
     logging.info(f"App Flask avviata. Blueprint registrati: {names}")
     return app
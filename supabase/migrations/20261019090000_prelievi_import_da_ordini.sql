@@ -0,0 +1,73 @@
+-- Import prelievi lato server: aggregazione per (sku, ean, data) + replace atomico.
+-- Sostituisce il giro Python (select * items -> filtro riepiloghi -> insert a batch).
+
+-- Righe aggregate pronte per prelievi_ordini_amazon (solo centri con riepilogo "nuovo").
+-- Prima si somma per centro, poi jsonb_object_agg costruisce "centri": {FC: qty}.
+-- start_delivery degli items è già testo 'YYYY-MM-DD': esposto senza espressioni,
+-- così il filtro per data della RPC usa ordini_vendor_items_start_delivery_idx.
+create or replace view public.v_prelievi_import_aggregati as
+with per_centro as (
+  select
+    it.model_number                       as sku,
+    it.vendor_product_id                  as ean,
+    it.start_delivery                     as start_delivery,
+    coalesce(it.fulfillment_center, '')   as fc,
+    sum(coalesce(it.qty_ordered, 0))::int as qty
+  from public.ordini_vendor_items it
+  join public.ordini_vendor_riepilogo r
+    on r.fulfillment_center = it.fulfillment_center
+   and r.start_delivery::text = it.start_delivery
+   and r.stato_ordine = 'nuovo'
+  where it.model_number is not null
+    and it.start_delivery <> ''
+  group by 1, 2, 3, 4
+)
+select
+  sku,
+  ean,
+  upper(trim(split_part(sku, '-', 1))) as radice,
+  start_delivery,
+  sum(qty)::int                        as qty,
+  jsonb_object_agg(fc, qty)            as centri
+from per_centro
+group by sku, ean, start_delivery;
+
+create index if not exists ordini_vendor_items_start_delivery_idx
+  on public.ordini_vendor_items (start_delivery);
+
+-- Delete + insert nella stessa transazione: nessuna finestra con prelievi vuoti.
+create or replace function public.prelievi_import_da_ordini(p_data date)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_deleted  int := 0;
+  v_inserted int := 0;
+begin
+  if p_data is null then
+    raise exception 'Data richiesta' using errcode = 'P0001';
+  end if;
+
+  -- due import concorrenti della stessa data si serializzano
+  perform pg_advisory_xact_lock(hashtext('prelievi_import'), hashtext(p_data::text));
+
+  delete from public.prelievi_ordini_amazon
+   where start_delivery = p_data;
+  get diagnostics v_deleted = row_count;
+
+  insert into public.prelievi_ordini_amazon
+    (sku, ean, qty, radice, start_delivery, centri, stato, riscontro, plus, note)
+  select sku, ean, qty, radice, p_data, centri, 'in verifica', 0, 0, ''
+    from public.v_prelievi_import_aggregati
+   where start_delivery = p_data::text;
+  get diagnostics v_inserted = row_count;
+
+  return jsonb_build_object(
+    'ok', true,
+    'importati', v_inserted,
+    'totali', v_inserted,
+    'eliminati', v_deleted,
+    'errors', '[]'::jsonb
+  );
+end;
+$$;
@@ -0,0 +1,13 @@
+-- Indici per la lista prelievi paginata (keyset su id) e i filtri server-side.
+
+create index if not exists prelievi_ordini_amazon_data_id_idx
+  on public.prelievi_ordini_amazon (start_delivery, id);
+
+create index if not exists prelievi_ordini_amazon_data_radice_id_idx
+  on public.prelievi_ordini_amazon (start_delivery, radice, id);
+
+create index if not exists prelievi_ordini_amazon_data_stato_id_idx
+  on public.prelievi_ordini_amazon (start_delivery, stato, id);
+
+create index if not exists prelievi_ordini_amazon_canale_data_id_idx
+  on public.prelievi_ordini_amazon (canale, start_delivery, id);
@@ -0,0 +1,208 @@
+-- Proiezione disponibilità magazzino per (sku, ean):
+-- giacenza per canale + prenotati per canale (da prelievi attivi, mag_usato_by_canale).
+-- Mantenuta da trigger su magazzino_giacenze e prelievi_ordini_amazon, quindi
+-- aggiornata da qualsiasi scrittura (RPC magazzino_carica/scarica, trasferimenti, prelievi).
+-- Letta dalla griglia /api/magazzino/giacenze con una sola query paginata.
+
+create table if not exists public.magazzino_disponibilita (
+  sku               text        not null,
+  ean               text        not null default '',   -- '' = EAN assente (chiave non nullable)
+  vendor_qty        int         not null default 0,
+  sito_qty          int         not null default 0,
+  seller_qty        int         not null default 0,
+  vendor_prenotati  int         not null default 0,
+  sito_prenotati    int         not null default 0,
+  seller_prenotati  int         not null default 0,
+  updated_at        timestamptz not null default now(),
+  primary key (sku, ean)
+);
+
+-- stessa normalizzazione di _norm_canale() in amazon_vendor.py
+create or replace function public.magazzino_norm_canale(c text)
+returns text
+language sql
+immutable
+as $$
+  select case
+    when lower(trim(coalesce(c, ''))) like 'amazon vendor%'
+      or lower(trim(coalesce(c, ''))) = 'vendor'             then 'Amazon Vendor'
+    when lower(trim(coalesce(c, ''))) like '%seller%'        then 'Amazon Seller'
+    when lower(trim(coalesce(c, ''))) in ('sito', 'shopify', 'web') then 'Sito'
+    when trim(coalesce(c, '')) = ''                          then 'Amazon Vendor'
+    else trim(c)
+  end
+$$;
+
+-- mag_usato_by_canale come oggetto jsonb, come lo legge il lato Python: accetta anche
+-- l'oggetto salvato come stringa JSON; stringhe non valide, array e scalari -> {}
+-- (una riga sporca non deve far fallire il trigger e con lui ogni scrittura sui prelievi)
+create or replace function public.magazzino_usato_obj(p_raw text)
+returns jsonb
+language plpgsql
+immutable
+as $$
+declare
+  v jsonb;
+begin
+  if p_raw is null or btrim(p_raw) = '' then
+    return '{}'::jsonb;
+  end if;
+  v := p_raw::jsonb;
+  if jsonb_typeof(v) = 'string' then
+    v := (v #>> '{}')::jsonb;
+  end if;
+  return case when jsonb_typeof(v) = 'object' then v else '{}'::jsonb end;
+exception when others then
+  return '{}'::jsonb;
+end;
+$$;
+
+-- Ricalcola la riga di proiezione per una coppia (sku, ean)
+create or replace function public.magazzino_disponibilita_refresh(p_sku text, p_ean text)
+returns void
+language plpgsql
+as $$
+declare
+  v_ean text := coalesce(nullif(trim(p_ean), ''), '');
+  s_vendor int; s_sito int; s_seller int;
+  p_vendor int; p_sito int; p_seller int;
+begin
+  if p_sku is null then
+    return;
+  end if;
+
+  select
+    coalesce(sum(qty) filter (where public.magazzino_norm_canale(canale) = 'Amazon Vendor'), 0),
+    coalesce(sum(qty) filter (where public.magazzino_norm_canale(canale) = 'Sito'), 0),
+    coalesce(sum(qty) filter (where public.magazzino_norm_canale(canale) = 'Amazon Seller'), 0)
+  into s_vendor, s_sito, s_seller
+  from public.magazzino_giacenze
+  where sku = p_sku
+    and coalesce(nullif(trim(ean), ''), '') = v_ean;
+
+  -- prenotati: stessi stati di ACTIVE_PRELIEVO_STATES lato Python
+  select
+    coalesce(sum(q) filter (where c = 'Amazon Vendor'), 0),
+    coalesce(sum(q) filter (where c = 'Sito'), 0),
+    coalesce(sum(q) filter (where c = 'Amazon Seller'), 0)
+  into p_vendor, p_sito, p_seller
+  from (
+    select
+      public.magazzino_norm_canale(kv.key) as c,
+      case when kv.value ~ '^\s*\d+(\.\d+)?\s*$' then kv.value::numeric::int else 0 end as q
+    from public.prelievi_ordini_amazon p
+    cross join lateral jsonb_each_text(public.magazzino_usato_obj(p.mag_usato_by_canale::text)) kv
+    where p.sku = p_sku
+      and coalesce(nullif(trim(p.ean), ''), '') = v_ean
+      and lower(trim(coalesce(p.stato, ''))) in ('in_verifica', 'parziale', 'completo', 'completato', 'completi')
+  ) pr
+  where pr.q > 0;
+
+  if s_vendor = 0 and s_sito = 0 and s_seller = 0
+     and p_vendor = 0 and p_sito = 0 and p_seller = 0 then
+    delete from public.magazzino_disponibilita where sku = p_sku and ean = v_ean;
+    return;
+  end if;
+
+  insert into public.magazzino_disponibilita as d
+    (sku, ean, vendor_qty, sito_qty, seller_qty,
+     vendor_prenotati, sito_prenotati, seller_prenotati, updated_at)
+  values
+    (p_sku, v_ean, s_vendor, s_sito, s_seller, p_vendor, p_sito, p_seller, now())
+  on conflict (sku, ean) do update set
+    vendor_qty       = excluded.vendor_qty,
+    sito_qty         = excluded.sito_qty,
+    seller_qty       = excluded.seller_qty,
+    vendor_prenotati = excluded.vendor_prenotati,
+    sito_prenotati   = excluded.sito_prenotati,
+    seller_prenotati = excluded.seller_prenotati,
+    updated_at       = now();
+end;
+$$;
+
+-- Trigger statement-level con transition table: un refresh per chiave distinta
+-- anche quando l'import prelievi tocca centinaia di righe in un colpo.
+create or replace function public.trg_magazzino_disponibilita_new()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform public.magazzino_disponibilita_refresh(k.sku, k.ean)
+     from (select distinct sku, coalesce(nullif(trim(ean), ''), '') as ean from new_rows) k;
+  return null;
+end;
+$$;
+
+create or replace function public.trg_magazzino_disponibilita_old()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform public.magazzino_disponibilita_refresh(k.sku, k.ean)
+     from (select distinct sku, coalesce(nullif(trim(ean), ''), '') as ean from old_rows) k;
+  return null;
+end;
+$$;
+
+create or replace function public.trg_magazzino_disponibilita_upd()
+returns trigger
+language plpgsql
+as $$
+begin
+  perform public.magazzino_disponibilita_refresh(k.sku, k.ean)
+     from (
+       select sku, coalesce(nullif(trim(ean), ''), '') as ean from new_rows
+       union
+       select sku, coalesce(nullif(trim(ean), ''), '') as ean from old_rows
+     ) k;
+  return null;
+end;
+$$;
+
+drop trigger if exists magazzino_giacenze_disp_ins on public.magazzino_giacenze;
+drop trigger if exists magazzino_giacenze_disp_upd on public.magazzino_giacenze;
+drop trigger if exists magazzino_giacenze_disp_del on public.magazzino_giacenze;
+create trigger magazzino_giacenze_disp_ins after insert on public.magazzino_giacenze
+  referencing new table as new_rows
+  for each statement execute function public.trg_magazzino_disponibilita_new();
+create trigger magazzino_giacenze_disp_upd after update on public.magazzino_giacenze
+  referencing new table as new_rows old table as old_rows
+  for each statement execute function public.trg_magazzino_disponibilita_upd();
+create trigger magazzino_giacenze_disp_del after delete on public.magazzino_giacenze
+  referencing old table as old_rows
+  for each statement execute function public.trg_magazzino_disponibilita_old();
+
+drop trigger if exists prelievi_disp_ins on public.prelievi_ordini_amazon;
+drop trigger if exists prelievi_disp_upd on public.prelievi_ordini_amazon;
+drop trigger if exists prelievi_disp_del on public.prelievi_ordini_amazon;
+create trigger prelievi_disp_ins after insert on public.prelievi_ordini_amazon
+  referencing new table as new_rows
+  for each statement execute function public.trg_magazzino_disponibilita_new();
+create trigger prelievi_disp_upd after update on public.prelievi_ordini_amazon
+  referencing new table as new_rows old table as old_rows
+  for each statement execute function public.trg_magazzino_disponibilita_upd();
+create trigger prelievi_disp_del after delete on public.prelievi_ordini_amazon
+  referencing old table as old_rows
+  for each statement execute function public.trg_magazzino_disponibilita_old();
+
+-- Ricostruzione completa (manutenzione / riallineamento)
+create or replace function public.magazzino_disponibilita_rebuild()
+returns int
+language plpgsql
+as $$
+declare
+  v_n int := 0;
+begin
+  truncate public.magazzino_disponibilita;
+  perform public.magazzino_disponibilita_refresh(k.sku, k.ean)
+     from (
+       select sku, coalesce(nullif(trim(ean), ''), '') as ean from public.magazzino_giacenze
+       union
+       select sku, coalesce(nullif(trim(ean), ''), '') as ean from public.prelievi_ordini_amazon
+     ) k;
+  select count(*) into v_n from public.magazzino_disponibilita;
+  return v_n;
+end;
+$$;
+
+select public.magazzino_disponibilita_rebuild();
@@ -0,0 +1,104 @@
+-- Trasferimento giacenza tra canali (Amazon Vendor / Sito / Amazon Seller) in UNA transazione:
+-- lock righe, verifica disponibilità, scarico origine, carico destinazione, log movimento.
+-- Accetta un array di trasferimenti: o passano tutti o nessuno.
+--
+-- p_items: [{ "sku": "...", "ean": "...", "from": "Sito", "to": "Amazon Vendor", "qty": 3 }, ...]
+-- ritorna: [{ "sku", "ean", "from", "to", "qty", "from_qty", "to_qty" }, ...] nell'ordine di p_items
+-- disponibilità insufficiente: P0001 con detail JSON { "sku", "ean", "from", "disponibile" }
+
+create unique index if not exists magazzino_giacenze_sku_ean_canale_uidx
+  on public.magazzino_giacenze (sku, ean, canale);
+
+create or replace function public.magazzino_trasferisci(
+  p_items  jsonb,
+  p_motivo text default 'trasferimento_manual'
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  it         jsonb;
+  v_pos      bigint;
+  v_sku      text;
+  v_ean      text;
+  v_from     text;
+  v_to       text;
+  v_qty      int;
+  v_from_qty int;
+  v_to_qty   int;
+  v_out      jsonb := '[]'::jsonb;
+begin
+  if p_items is null or jsonb_typeof(p_items) <> 'array' then
+    raise exception 'p_items deve essere un array' using errcode = 'P0001';
+  end if;
+
+  -- ordine deterministico (sku, ean): chiamate concorrenti prendono i lock nello stesso ordine
+  for it, v_pos in
+    select e, n from jsonb_array_elements(p_items) with ordinality t(e, n)
+    order by e->>'sku', e->>'ean', n
+  loop
+    v_sku  := nullif(trim(it->>'sku'), '');
+    v_ean  := nullif(trim(it->>'ean'), '');
+    v_from := it->>'from';
+    v_to   := it->>'to';
+    v_qty  := coalesce((it->>'qty')::int, 0);
+
+    if v_sku is null or v_ean is null then
+      raise exception 'sku e ean sono obbligatori' using errcode = 'P0001';
+    end if;
+    if v_qty <= 0 then
+      raise exception 'quantita deve essere > 0 (sku %)', v_sku using errcode = 'P0001';
+    end if;
+    if v_from not in ('Amazon Vendor', 'Sito', 'Amazon Seller')
+       or v_to not in ('Amazon Vendor', 'Sito', 'Amazon Seller') then
+      raise exception 'canale non valido (usa: Amazon Vendor | Sito | Amazon Seller)' using errcode = 'P0001';
+    end if;
+    if v_from = v_to then
+      raise exception 'from e to devono essere diversi' using errcode = 'P0001';
+    end if;
+
+    -- lock di entrambe le righe (ordine per canale) prima di leggere
+    perform 1
+       from public.magazzino_giacenze
+      where sku = v_sku and ean = v_ean and canale in (v_from, v_to)
+      order by canale
+      for update;
+
+    select qty into v_from_qty
+      from public.magazzino_giacenze
+     where sku = v_sku and ean = v_ean and canale = v_from;
+
+    if coalesce(v_from_qty, 0) < v_qty then
+      raise exception 'Quantità oltre il disponibile nel pool ''%'' (sku %, disponibile %)',
+        v_from, v_sku, coalesce(v_from_qty, 0)
+        using errcode = 'P0001',
+              detail  = jsonb_build_object('sku', v_sku, 'ean', v_ean, 'from', v_from,
+                                           'disponibile', coalesce(v_from_qty, 0))::text;
+    end if;
+
+    update public.magazzino_giacenze
+       set qty = qty - v_qty
+     where sku = v_sku and ean = v_ean and canale = v_from
+    returning qty into v_from_qty;
+
+    insert into public.magazzino_giacenze as g (sku, ean, canale, qty)
+    values (v_sku, v_ean, v_to, v_qty)
+    on conflict (sku, ean, canale) do update set qty = g.qty + excluded.qty
+    returning qty into v_to_qty;
+
+    insert into public.magazzino_movimenti (sku, ean, canale, qty, motivo)
+    values (v_sku, v_ean, v_from || '->' || v_to, v_qty, coalesce(p_motivo, 'trasferimento_manual'));
+
+    v_out := v_out || jsonb_build_object(
+      'sku', v_sku, 'ean', v_ean, 'from', v_from, 'to', v_to, 'qty', v_qty,
+      'from_qty', v_from_qty, 'to_qty', v_to_qty, 'pos', v_pos
+    );
+  end loop;
+
+  -- risultati nell'ordine della richiesta (i lock sono presi in ordine sku/ean)
+  return coalesce((
+    select jsonb_agg(r - 'pos' order by (r->>'pos')::bigint)
+      from jsonb_array_elements(v_out) r
+  ), '[]'::jsonb);
+end;
+$$;
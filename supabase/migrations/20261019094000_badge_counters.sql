@@ -0,0 +1,51 @@
+-- Badge (ordini vendor + produzione) con una sola chiamata aggregata lato DB.
+-- Sostituiscono le count(exact) su ordini_vendor_riepilogo ad ogni polling della UI
+-- e la rilettura completa di produzione_vendor in GET /api/produzione.
+--
+-- Niente contatori mantenuti da trigger: ogni spostamento di produzione avrebbe
+-- aggiornato le stesse poche righe contatore nella propria transazione, serializzando
+-- (e mandando in deadlock) i trasferimenti paralleli. Il conteggio è un group by
+-- al momento della lettura; lato app i badge sono in cache per pochi secondi.
+--
+-- scope 'vendor'     -> dim 'stato_ordine'
+-- scope 'produzione' -> dim 'stato_produzione' | 'radice' | 'canale'
+
+create index if not exists ordini_vendor_riepilogo_stato_ordine_idx
+  on public.ordini_vendor_riepilogo (stato_ordine);
+
+-- Lettura in una chiamata: { scope: { dim: { key: n } } } (solo n > 0)
+-- (stesse chiavi di fallback della vecchia aggregazione Python)
+create or replace function public.badge_counters_get(p_scope text default null)
+returns jsonb
+language sql
+stable
+as $$
+  with counts as (
+    select 'vendor'::text as scope, 'stato_ordine'::text as dim,
+           coalesce(stato_ordine, '') as key, count(*)::int as n
+      from public.ordini_vendor_riepilogo
+     where p_scope is null or p_scope = 'vendor'
+     group by 3
+    union all
+    select 'produzione', v.dim, v.k, count(*)::int
+      from public.produzione_vendor r
+     cross join lateral (values
+       ('stato_produzione', coalesce(r.stato_produzione, 'Da Stampare')),
+       ('radice',           coalesce(nullif(r.radice, ''), '?')),
+       ('canale',           coalesce(nullif(r.canale, ''), '?'))
+     ) v(dim, k)
+     where p_scope is null or p_scope = 'produzione'
+     group by v.dim, v.k
+  )
+  select coalesce(jsonb_object_agg(scope, dims), '{}'::jsonb)
+    from (
+      select scope, jsonb_object_agg(dim, keys) as dims
+        from (
+          select scope, dim, jsonb_object_agg(key, n) as keys
+            from counts
+           where n > 0
+           group by scope, dim
+        ) d
+       group by scope
+    ) s
+$$;
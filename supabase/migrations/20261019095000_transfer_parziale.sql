@@ -0,0 +1,327 @@
+-- Conferma parziale -> spostamento produzione in 'Trasferito' (e cleanup in 'Deposito')
+-- in UNA chiamata/transazione. Stessa logica di _move_parziale_to_trasferito:
+--   need(sku) = q_parziale_corrente - max(0, riscontro_giorno - parziali_confermati_precedenti)
+--   passata 1: righe attive stessa data (prima EAN del parziale, poi le altre; per stato/data)
+--   passata 2: righe attive di altre date -> retarget sulla data -> Trasferito
+--   post-step: se (Trasferito + riscontro) >= ordinato o parziali cumulativi >= ordinato
+--              -> residui attivi in 'Deposito'
+-- Ogni spostamento passa da move_qty_rpc (stessi log/merge); un errore sul singolo
+-- spostamento finisce in "failures" senza annullare gli altri (come prima).
+--
+-- ritorna: { "moved": int, "deposited": int, "failures": [...] }
+
+-- Chiamata a move_qty_rpc con literal non tipizzati: la risoluzione dei tipi
+-- dei parametri resta quella della RPC esistente (come da PostgREST).
+create or replace function public.transfer_parziale_move(
+  p_from_id         bigint,
+  p_to_state        text,
+  p_qty             int,
+  p_user_label      text,
+  p_numero_parziale int,
+  p_riepilogo_id    bigint
+)
+returns void
+language plpgsql
+as $$
+begin
+  execute format(
+    'select public.move_qty_rpc(p_from_id => %s, p_to_state => %L, p_qty => %s, p_user_label => %L, '
+    'p_correlation_id => %L, p_numero_parziale => %s, p_riepilogo_id => %s)',
+    p_from_id, p_to_state, p_qty, p_user_label, gen_random_uuid()::text, p_numero_parziale, p_riepilogo_id
+  );
+end;
+$$;
+
+-- Sposta p_qty da una riga produzione ad una riga (stessa chiave) con data p_new_date.
+-- Equivalente SQL di _retarget_qty_to_date; ritorna l'id della riga target.
+create or replace function public.produzione_retarget_qty(
+  p_src_id     bigint,
+  p_new_date   date,
+  p_qty        int,
+  p_user_label text
+)
+returns bigint
+language plpgsql
+as $$
+declare
+  src        public.produzione_vendor%rowtype;
+  v_take     int;
+  v_tgt_id   bigint;
+  v_after    int;
+begin
+  if coalesce(p_qty, 0) <= 0 then
+    return null;
+  end if;
+
+  select * into src from public.produzione_vendor where id = p_src_id for update;
+  if not found then
+    return null;
+  end if;
+
+  v_take := least(coalesce(src.da_produrre, 0), p_qty);
+  if v_take <= 0 then
+    return null;
+  end if;
+
+  select id into v_tgt_id
+    from public.produzione_vendor
+   where sku = src.sku
+     and ean is not distinct from src.ean
+     and stato_produzione = src.stato_produzione
+     and canale is not distinct from src.canale
+     and start_delivery = p_new_date
+   order by id
+   limit 1
+   for update;
+
+  if v_tgt_id is not null then
+    update public.produzione_vendor
+       set da_produrre = coalesce(da_produrre, 0) + v_take
+     where id = v_tgt_id;
+  else
+    insert into public.produzione_vendor
+      (prelievo_id, sku, ean, qty, riscontro, plus, start_delivery, stato,
+       stato_produzione, da_produrre, cavallotti, note, canale)
+    values
+      (src.prelievo_id, src.sku, src.ean, src.qty, src.riscontro, 0, p_new_date, src.stato,
+       src.stato_produzione, v_take, src.cavallotti, src.note, src.canale)
+    returning id into v_tgt_id;
+
+    insert into public.movimenti_produzione_vendor
+      (produzione_id, sku, ean, canale, stato_vecchio, stato_nuovo, qty_vecchia, qty_nuova,
+       motivo, utente, dettaglio)
+    values
+      (v_tgt_id, src.sku, src.ean, src.canale, null, src.stato_produzione, null, v_take,
+       'Creazione ' || src.stato_produzione || ' (retarget)', p_user_label, '{}'::jsonb);
+  end if;
+
+  v_after := coalesce(src.da_produrre, 0) - v_take;
+  update public.produzione_vendor set da_produrre = v_after where id = p_src_id;
+
+  insert into public.movimenti_produzione_vendor
+    (produzione_id, sku, ean, canale, stato_vecchio, stato_nuovo, qty_vecchia, qty_nuova,
+     motivo, utente, dettaglio)
+  values
+    (p_src_id, src.sku, src.ean, src.canale, src.stato_produzione, src.stato_produzione,
+     src.da_produrre, v_after, 'Retarget data (auto)', p_user_label,
+     jsonb_build_object('retarget', true, 'from_date', src.start_delivery, 'to_date', p_new_date));
+
+  if v_after <= 0 then
+    delete from public.produzione_vendor where id = p_src_id;
+  end if;
+
+  return v_tgt_id;
+end;
+$$;
+
+create or replace function public.transfer_parziale(
+  p_center          text,
+  p_start_delivery  date,
+  p_numero_parziale int
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  c_attivi     constant text[] := array['Stampato', 'Calandrato', 'Cucito', 'Confezionato'];
+  c_esclusi    constant text[] := array['Da Stampare', 'Trasferito', 'Rimossi', 'Deposito'];
+  v_riep_id    bigint;
+  v_curr       record;
+  v_sku        record;
+  v_row        record;
+  v_need       int;
+  v_take       int;
+  v_avail      int;
+  v_tgt_id     bigint;
+  v_moved      int := 0;
+  v_deposited  int := 0;
+  v_failures   jsonb := '[]'::jsonb;
+  v_label      text := format('Sistema (conferma parziale #%s)', p_numero_parziale);
+begin
+  select id into v_riep_id
+    from public.ordini_vendor_riepilogo
+   where fulfillment_center = p_center
+     and start_delivery::text = p_start_delivery::text
+   limit 1;
+  if v_riep_id is null then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  select dati, created_at, confermato into v_curr
+    from public.ordini_vendor_parziali
+   where riepilogo_id = v_riep_id
+     and numero_parziale = p_numero_parziale
+   limit 1;
+  if not found then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  -- failsafe: non muovere se non è confermato
+  if not coalesce(v_curr.confermato, false) then
+    return jsonb_build_object('moved', 0, 'deposited', 0,
+                              'failures', jsonb_build_array(jsonb_build_object('note', 'parziale non confermato')));
+  end if;
+
+  -- conferme concorrenti della stessa data si serializzano
+  perform pg_advisory_xact_lock(hashtext('transfer_parziale'), hashtext(p_start_delivery::text));
+
+  drop table if exists _tp_curr, _tp_prec, _tp_need;
+
+  -- righe del parziale corrente (dati può essere salvato come stringa JSON)
+  create temp table _tp_curr on commit drop as
+  select coalesce(e->>'model_number', e->>'sku')                        as sku,
+         coalesce(e->>'vendor_product_id', e->>'ean', '')                as ean,
+         coalesce(nullif(e->>'quantita', '')::numeric,
+                  nullif(e->>'qty', '')::numeric, 0)::int               as q
+    from jsonb_array_elements(
+           case when jsonb_typeof(v_curr.dati::jsonb) = 'string'
+                then (v_curr.dati::jsonb #>> '{}')::jsonb
+                else coalesce(v_curr.dati::jsonb, '[]'::jsonb) end
+         ) e;
+  delete from _tp_curr where sku is null or q <= 0;
+
+  -- parziali confermati precedenti (tutti i centri della data, created_at < corrente)
+  create temp table _tp_prec on commit drop as
+  select coalesce(e->>'model_number', e->>'sku') as sku,
+         sum(coalesce(nullif(e->>'quantita', '')::numeric,
+                      nullif(e->>'qty', '')::numeric, 0))::int as q
+    from public.ordini_vendor_parziali p
+    join public.ordini_vendor_riepilogo r on r.id = p.riepilogo_id
+   cross join lateral jsonb_array_elements(
+           case when jsonb_typeof(p.dati::jsonb) = 'string'
+                then (p.dati::jsonb #>> '{}')::jsonb
+                else coalesce(p.dati::jsonb, '[]'::jsonb) end
+         ) e
+   where r.start_delivery::text = p_start_delivery::text
+     and coalesce(p.confermato, false)
+     and (p.created_at is null or p.created_at < v_curr.created_at)
+   group by 1;
+
+  -- need per SKU (regola "riscontro-first") + ordinato/riscontro del giorno (solo Vendor)
+  create temp table _tp_need on commit drop as
+  with cur as (
+    select sku, sum(q)::int as q from _tp_curr group by sku
+  ),
+  pre as (
+    select sku, sum(coalesce(riscontro, 0))::int as risc, sum(coalesce(qty, 0))::int as ordinato
+      from public.prelievi_ordini_amazon
+     where start_delivery = p_start_delivery
+       and canale = 'Amazon Vendor'
+       and sku in (select sku from cur)
+     group by sku
+  )
+  select cur.sku,
+         cur.q                                   as q_curr,
+         coalesce(pre.risc, 0)                   as risc,
+         coalesce(pre.ordinato, 0)               as ordinato,
+         coalesce(prec.q, 0)                     as q_prec,
+         greatest(0, cur.q - greatest(0, coalesce(pre.risc, 0) - coalesce(prec.q, 0))) as need
+    from cur
+    left join pre  on pre.sku = cur.sku
+    left join _tp_prec prec on prec.sku = cur.sku;
+
+  for v_sku in select * from _tp_need where need > 0 order by sku loop
+    v_need := v_sku.need;
+
+    -- PASSATA 1: stessa data; prima le EAN del parziale (per qty desc), poi le altre
+    for v_row in
+      select pv.id
+        from public.produzione_vendor pv
+        left join (select ean, sum(q) as q from _tp_curr where sku = v_sku.sku group by ean) ce
+          on ce.ean = coalesce(pv.ean, '')
+       where pv.sku = v_sku.sku
+         and pv.start_delivery = p_start_delivery
+         and pv.canale = 'Amazon Vendor'
+         and pv.stato_produzione <> all (c_esclusi)
+       order by (ce.ean is null), ce.q desc nulls last, coalesce(pv.ean, ''),
+                coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.id
+    loop
+      exit when v_need <= 0;
+      select coalesce(da_produrre, 0) into v_avail
+        from public.produzione_vendor where id = v_row.id for update;
+      v_take := least(coalesce(v_avail, 0), v_need);
+      continue when v_take <= 0;
+      begin
+        perform public.transfer_parziale_move(v_row.id, 'Trasferito', v_take, v_label,
+                                              p_numero_parziale, v_riep_id);
+        v_moved := v_moved + v_take;
+        v_need  := v_need - v_take;
+      exception when others then
+        v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take, 'error', sqlerrm);
+      end;
+    end loop;
+
+    -- PASSATA 2 (fallback): altre date -> retarget sulla data -> Trasferito
+    if v_need > 0 then
+      for v_row in
+        select pv.id
+          from public.produzione_vendor pv
+         where pv.sku = v_sku.sku
+           and pv.canale = 'Amazon Vendor'
+           and pv.stato_produzione <> all (c_esclusi)
+           and pv.start_delivery is distinct from p_start_delivery
+         order by coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.start_delivery, pv.id
+      loop
+        exit when v_need <= 0;
+        select coalesce(da_produrre, 0) into v_avail
+          from public.produzione_vendor where id = v_row.id for update;
+        v_take := least(coalesce(v_avail, 0), v_need);
+        continue when v_take <= 0;
+        begin
+          v_tgt_id := public.produzione_retarget_qty(v_row.id, p_start_delivery, v_take,
+                                                     'Sistema (retarget auto)');
+          if v_tgt_id is not null then
+            perform public.transfer_parziale_move(v_tgt_id, 'Trasferito', v_take, v_label,
+                                                  p_numero_parziale, v_riep_id);
+            v_moved := v_moved + v_take;
+            v_need  := v_need - v_take;
+          end if;
+        exception when others then
+          v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take,
+                                                         'error', 'retarget+move: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+
+    if v_need > 0 then
+      v_failures := v_failures || jsonb_build_object(
+        'sku', v_sku.sku, 'missing', v_need,
+        'note', 'residuo non spostabile (nessun attivo disponibile)');
+    end if;
+  end loop;
+
+  -- POST-STEP: residui attivi in 'Deposito' se l'ordinato è coperto
+  for v_sku in select * from _tp_need order by sku loop
+    if (coalesce((select sum(coalesce(da_produrre, 0))
+                    from public.produzione_vendor
+                   where sku = v_sku.sku and canale = 'Amazon Vendor'
+                     and stato_produzione = 'Trasferito'
+                     and start_delivery = p_start_delivery), 0) + v_sku.risc) >= v_sku.ordinato
+       or (v_sku.q_prec + v_sku.q_curr) >= v_sku.ordinato
+    then
+      for v_row in
+        select id, coalesce(da_produrre, 0) as qty
+          from public.produzione_vendor
+         where sku = v_sku.sku and canale = 'Amazon Vendor'
+           and start_delivery = p_start_delivery
+           and stato_produzione = any (c_attivi)
+           and coalesce(da_produrre, 0) > 0
+         order by array_position(c_attivi, stato_produzione) desc, id
+         for update
+      loop
+        begin
+          perform public.transfer_parziale_move(v_row.id, 'Deposito', v_row.qty,
+                                                'Sistema (cleanup post-conferma)',
+                                                p_numero_parziale, v_riep_id);
+          v_deposited := v_deposited + v_row.qty;
+        exception when others then
+          v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_row.qty,
+                                                         'error', 'deposito: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+  end loop;
+
+  return jsonb_build_object('moved', v_moved, 'failures', v_failures, 'deposited', v_deposited);
+end;
+$$;
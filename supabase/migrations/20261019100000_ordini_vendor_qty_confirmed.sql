@@ -0,0 +1,84 @@
+-- Chiusura ordine vendor: qty_confirmed calcolate UNA volta dai parziali e scritte
+-- sugli items del riepilogo con un solo UPDATE (prima: un update per modello / per item).
+
+-- Righe di un parziale (dati può essere salvato come stringa JSON;
+-- accetta sia model_number/quantita che sku/qty, come il codice Python).
+create or replace function public.parziale_dati_righe(p_dati jsonb)
+returns table (model_number text, ean text, quantita int)
+language sql
+immutable
+as $$
+  select coalesce(e->>'model_number', e->>'sku'),
+         coalesce(e->>'vendor_product_id', e->>'ean', ''),
+         coalesce(nullif(e->>'quantita', '')::numeric, nullif(e->>'qty', '')::numeric, 0)::int
+    from jsonb_array_elements(
+           case when jsonb_typeof(p_dati) = 'string' then (p_dati #>> '{}')::jsonb
+                when jsonb_typeof(p_dati) = 'array'  then p_dati
+                else '[]'::jsonb end
+         ) e
+$$;
+
+-- p_include_wip:   somma anche l'ultimo parziale non confermato (chiudi ordine)
+-- p_reset_missing: modelli senza parziali -> qty_confirmed = 0 (chiudi ordine);
+--                  altrimenti si aggiornano solo i modelli presenti nei parziali
+-- ritorna: { model_number: qty_confirmed }
+create or replace function public.ordini_vendor_sync_qty_confirmed(
+  p_riepilogo_id  bigint,
+  p_include_wip   boolean default false,
+  p_reset_missing boolean default false
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_po_list text[];
+  v_out     jsonb;
+begin
+  select array(select jsonb_array_elements_text(coalesce(to_jsonb(r.po_list), '[]'::jsonb)))
+    into v_po_list
+    from public.ordini_vendor_riepilogo r
+   where r.id = p_riepilogo_id;
+  if not found then
+    raise exception 'riepilogo % non trovato', p_riepilogo_id using errcode = 'P0001';
+  end if;
+
+  with parz as (
+    select dati
+      from public.ordini_vendor_parziali
+     where riepilogo_id = p_riepilogo_id
+       and confermato
+    union all
+    (select dati
+       from public.ordini_vendor_parziali
+      where riepilogo_id = p_riepilogo_id
+        and not coalesce(confermato, false)
+        and p_include_wip
+      order by numero_parziale desc
+      limit 1)
+  ),
+  agg as (
+    select d.model_number, sum(d.quantita)::int as q
+      from parz
+     cross join lateral public.parziale_dati_righe(parz.dati::jsonb) d
+     where d.model_number is not null
+     group by d.model_number
+  ),
+  upd as (
+    update public.ordini_vendor_items it
+       set qty_confirmed = coalesce(agg.q, 0)
+      from (select distinct i.id, i.model_number
+              from public.ordini_vendor_items i
+             where i.po_number = any (v_po_list)) t
+      left join agg on agg.model_number = t.model_number
+     where it.id = t.id
+       and (p_reset_missing or agg.model_number is not null)
+       and it.qty_confirmed is distinct from coalesce(agg.q, 0)
+    returning 1
+  )
+  select coalesce(jsonb_object_agg(model_number, q), '{}'::jsonb)
+    into v_out
+    from agg;
+
+  return v_out;
+end;
+$$;
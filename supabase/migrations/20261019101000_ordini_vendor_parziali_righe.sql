@@ -0,0 +1,180 @@
+-- Proiezione riga-per-riga dei parziali (ordini_vendor_parziali.dati -> una riga per articolo/collo),
+-- mantenuta da trigger ad ogni salvataggio WIP / conferma. Le aggregazioni (colli dashboard,
+-- qty inserite per barcode, qty_confirmed in chiusura) diventano GROUP BY lato SQL.
+
+create table if not exists public.ordini_vendor_parziali_righe (
+  riepilogo_id    bigint  not null,
+  numero_parziale int     not null,
+  riga            int     not null,            -- posizione nell'array dati (1..n)
+  confermato      boolean not null default false,
+  po_number       text,
+  model_number    text,
+  ean             text    not null default '',
+  collo           text,
+  quantita        int     not null default 0,
+  primary key (riepilogo_id, numero_parziale, riga)
+);
+
+create index if not exists ordini_vendor_parziali_righe_po_model_idx
+  on public.ordini_vendor_parziali_righe (po_number, model_number);
+create index if not exists ordini_vendor_parziali_righe_conf_idx
+  on public.ordini_vendor_parziali_righe (riepilogo_id, confermato, model_number);
+
+-- Esplode dati (array o stringa JSON) nelle righe della proiezione
+create or replace function public.ordini_vendor_parziali_righe_sync(
+  p_riepilogo_id    bigint,
+  p_numero_parziale int,
+  p_confermato      boolean,
+  p_dati            jsonb
+)
+returns void
+language plpgsql
+as $$
+begin
+  delete from public.ordini_vendor_parziali_righe
+   where riepilogo_id = p_riepilogo_id
+     and numero_parziale = p_numero_parziale;
+
+  insert into public.ordini_vendor_parziali_righe
+    (riepilogo_id, numero_parziale, riga, confermato, po_number, model_number, ean, collo, quantita)
+  select p_riepilogo_id, p_numero_parziale, e.ord::int, coalesce(p_confermato, false),
+         e.val->>'po_number',
+         coalesce(e.val->>'model_number', e.val->>'sku'),
+         coalesce(e.val->>'vendor_product_id', e.val->>'ean', ''),
+         nullif(e.val->>'collo', ''),
+         coalesce(nullif(e.val->>'quantita', '')::numeric, nullif(e.val->>'qty', '')::numeric, 0)::int
+    from jsonb_array_elements(
+           case when jsonb_typeof(p_dati) = 'string' then (p_dati #>> '{}')::jsonb
+                when jsonb_typeof(p_dati) = 'array'  then p_dati
+                else '[]'::jsonb end
+         ) with ordinality as e(val, ord);
+end;
+$$;
+
+create or replace function public.trg_ordini_vendor_parziali_righe()
+returns trigger
+language plpgsql
+as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    delete from public.ordini_vendor_parziali_righe
+     where riepilogo_id = old.riepilogo_id
+       and numero_parziale = old.numero_parziale;
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform public.ordini_vendor_parziali_righe_sync(
+      new.riepilogo_id, new.numero_parziale, new.confermato, new.dati::jsonb);
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists ordini_vendor_parziali_righe_trg on public.ordini_vendor_parziali;
+create trigger ordini_vendor_parziali_righe_trg
+  after insert or delete or update of riepilogo_id, numero_parziale, dati, confermato
+  on public.ordini_vendor_parziali
+  for each row execute function public.trg_ordini_vendor_parziali_righe();
+
+-- backfill
+truncate public.ordini_vendor_parziali_righe;
+select public.ordini_vendor_parziali_righe_sync(riepilogo_id, numero_parziale, confermato, dati::jsonb)
+  from public.ordini_vendor_parziali;
+
+-- ---------------------------------------------------------------------------
+-- Aggregazioni
+-- ---------------------------------------------------------------------------
+
+-- Dashboard: per parziale colli distinti + stato, senza scaricare dati
+create or replace function public.parziali_dashboard_colli(p_riepilogo_ids bigint[])
+returns table (
+  riepilogo_id    bigint,
+  numero_parziale int,
+  confermato      boolean,
+  conferma_collo  jsonb,
+  colli_totali    int
+)
+language sql
+stable
+as $$
+  select p.riepilogo_id, p.numero_parziale, p.confermato, p.conferma_collo::jsonb,
+         coalesce((select count(distinct r.collo)::int
+                     from public.ordini_vendor_parziali_righe r
+                    where r.riepilogo_id = p.riepilogo_id
+                      and r.numero_parziale = p.numero_parziale
+                      and r.collo is not null), 0)
+    from public.ordini_vendor_parziali p
+   where p.riepilogo_id = any (p_riepilogo_ids)
+$$;
+
+-- Barcode: quantità già inserite nei parziali per (po_number, model_number)
+create or replace function public.parziali_qty_inserted(
+  p_riepilogo_ids bigint[],
+  p_model_numbers text[] default null
+)
+returns table (po_number text, model_number text, quantita int)
+language sql
+stable
+as $$
+  select r.po_number, r.model_number, sum(r.quantita)::int
+    from public.ordini_vendor_parziali_righe r
+   where r.riepilogo_id = any (p_riepilogo_ids)
+     and (p_model_numbers is null or r.model_number = any (p_model_numbers))
+   group by r.po_number, r.model_number
+$$;
+
+-- Chiusura ordine: stessa firma/semantica, aggregazione sulle righe
+create or replace function public.ordini_vendor_sync_qty_confirmed(
+  p_riepilogo_id  bigint,
+  p_include_wip   boolean default false,
+  p_reset_missing boolean default false
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_po_list text[];
+  v_wip     int;
+  v_out     jsonb;
+begin
+  select array(select jsonb_array_elements_text(coalesce(to_jsonb(r.po_list), '[]'::jsonb)))
+    into v_po_list
+    from public.ordini_vendor_riepilogo r
+   where r.id = p_riepilogo_id;
+  if not found then
+    raise exception 'riepilogo % non trovato', p_riepilogo_id using errcode = 'P0001';
+  end if;
+
+  if p_include_wip then
+    select max(numero_parziale) into v_wip
+      from public.ordini_vendor_parziali
+     where riepilogo_id = p_riepilogo_id
+       and not coalesce(confermato, false);
+  end if;
+
+  with agg as (
+    select model_number, sum(quantita)::int as q
+      from public.ordini_vendor_parziali_righe
+     where riepilogo_id = p_riepilogo_id
+       and (confermato or numero_parziale = v_wip)
+       and model_number is not null
+     group by model_number
+  ),
+  upd as (
+    update public.ordini_vendor_items it
+       set qty_confirmed = coalesce(agg.q, 0)
+      from (select distinct i.id, i.model_number
+              from public.ordini_vendor_items i
+             where i.po_number = any (v_po_list)) t
+      left join agg on agg.model_number = t.model_number
+     where it.id = t.id
+       and (p_reset_missing or agg.model_number is not null)
+       and it.qty_confirmed is distinct from coalesce(agg.q, 0)
+    returning 1
+  )
+  select coalesce(jsonb_object_agg(model_number, q), '{}'::jsonb)
+    into v_out
+    from agg;
+
+  return v_out;
+end;
+$$;
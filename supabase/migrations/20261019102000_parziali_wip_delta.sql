@@ -0,0 +1,377 @@
+-- Salvataggio WIP parziali a delta: il client invia solo le operazioni sulle righe
+-- (add/update/remove) + le chiavi di conferma_collo cambiate, con la versione letta.
+-- La versione è un intero monotono (sostituisce il confronto stringa su last_modified_at).
+--
+-- Con il salvataggio a delta la fonte delle righe del WIP è la proiezione
+-- ordini_vendor_parziali_righe (colonna line = riga completa): ogni operazione scrive
+-- una sola riga e il blob dati NON viene riscritto, viene solo marcato dati_stale.
+-- dati è ricostruito dalle righe (ordini_vendor_parziali_dati) alla prima scrittura
+-- non a delta sul parziale (conferma, gestito, salvataggio completo) o su richiesta
+-- di chi lo legge (parziali_wip_materializza).
+
+alter table public.ordini_vendor_parziali
+  add column if not exists version int not null default 0;
+alter table public.ordini_vendor_parziali
+  add column if not exists dati_stale boolean not null default false;
+
+create index if not exists ordini_vendor_parziali_dati_stale_idx
+  on public.ordini_vendor_parziali (riepilogo_id) where dati_stale;
+
+-- riga completa (tutti i campi inviati dal client) per ricostruire dati
+alter table public.ordini_vendor_parziali_righe
+  add column if not exists line jsonb;
+
+create index if not exists ordini_vendor_parziali_righe_linea_idx
+  on public.ordini_vendor_parziali_righe (riepilogo_id, numero_parziale, model_number, po_number);
+
+-- Esplode dati nelle righe della proiezione (come in 20261019101000, più line)
+create or replace function public.ordini_vendor_parziali_righe_sync(
+  p_riepilogo_id    bigint,
+  p_numero_parziale int,
+  p_confermato      boolean,
+  p_dati            jsonb
+)
+returns void
+language plpgsql
+as $$
+begin
+  delete from public.ordini_vendor_parziali_righe
+   where riepilogo_id = p_riepilogo_id
+     and numero_parziale = p_numero_parziale;
+
+  insert into public.ordini_vendor_parziali_righe
+    (riepilogo_id, numero_parziale, riga, confermato, po_number, model_number, ean, collo, quantita, line)
+  select p_riepilogo_id, p_numero_parziale, e.ord::int, coalesce(p_confermato, false),
+         e.val->>'po_number',
+         coalesce(e.val->>'model_number', e.val->>'sku'),
+         coalesce(e.val->>'vendor_product_id', e.val->>'ean', ''),
+         nullif(e.val->>'collo', ''),
+         coalesce(nullif(e.val->>'quantita', '')::numeric, nullif(e.val->>'qty', '')::numeric, 0)::int,
+         e.val
+    from jsonb_array_elements(
+           case when jsonb_typeof(p_dati) = 'string' then (p_dati #>> '{}')::jsonb
+                when jsonb_typeof(p_dati) = 'array'  then p_dati
+                else '[]'::jsonb end
+         ) with ordinality as e(val, ord);
+end;
+$$;
+
+-- backfill di line
+update public.ordini_vendor_parziali_righe r
+   set line = e.val
+  from public.ordini_vendor_parziali p
+ cross join lateral jsonb_array_elements(
+         case when jsonb_typeof(p.dati::jsonb) = 'string' then (p.dati::jsonb #>> '{}')::jsonb
+              when jsonb_typeof(p.dati::jsonb) = 'array'  then p.dati::jsonb
+              else '[]'::jsonb end
+       ) with ordinality as e(val, ord)
+ where r.riepilogo_id = p.riepilogo_id
+   and r.numero_parziale = p.numero_parziale
+   and r.riga = e.ord
+   and r.line is null;
+
+-- dati ricostruito dalle righe (ordine = riga)
+create or replace function public.ordini_vendor_parziali_dati(
+  p_riepilogo_id    bigint,
+  p_numero_parziale int
+)
+returns jsonb
+language sql
+stable
+as $$
+  select coalesce(jsonb_agg(r.line order by r.riga), '[]'::jsonb)
+    from public.ordini_vendor_parziali_righe r
+   where r.riepilogo_id = p_riepilogo_id
+     and r.numero_parziale = p_numero_parziale
+$$;
+
+-- Versione + compattazione di dati.
+-- Ogni scrittura che cambia contenuto/stato incrementa la versione (vale anche per il
+-- salvataggio completo via upsert). Se dati è stale e la scrittura non è a delta:
+-- chi scrive un nuovo dati lo sostituisce, altrimenti dati viene ricostruito dalle righe
+-- (la ricostruzione non è una modifica: non cambia la versione).
+create or replace function public.trg_ordini_vendor_parziali_version()
+returns trigger
+language plpgsql
+as $$
+declare
+  v_new_dati boolean;
+begin
+  if tg_op = 'INSERT' then
+    new.version := greatest(coalesce(new.version, 0), 1);
+    return new;
+  end if;
+
+  v_new_dati := new.dati::jsonb is distinct from old.dati::jsonb;
+  if old.dati_stale and coalesce(current_setting('app.parziali_righe_delta', true), '') <> 'on' then
+    if not v_new_dati then
+      new.dati := public.ordini_vendor_parziali_dati(old.riepilogo_id, old.numero_parziale);
+    end if;
+    new.dati_stale := false;
+  end if;
+
+  if v_new_dati
+     or new.conferma_collo::jsonb is distinct from old.conferma_collo::jsonb
+     or new.confermato is distinct from old.confermato then
+    new.version := coalesce(old.version, 0) + 1;
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists ordini_vendor_parziali_version_trg on public.ordini_vendor_parziali;
+create trigger ordini_vendor_parziali_version_trg
+  before insert or update on public.ordini_vendor_parziali
+  for each row execute function public.trg_ordini_vendor_parziali_version();
+
+-- Ricostruisce dati dei WIP stale dei riepiloghi indicati (per chi legge il blob).
+-- La colonna aggiornata è solo dati_stale: il trigger sopra riscrive dati, quello
+-- della proiezione (update of dati, ...) non scatta.
+create or replace function public.parziali_wip_materializza(p_riepilogo_ids bigint[])
+returns int
+language plpgsql
+as $$
+declare
+  v_n int;
+begin
+  update public.ordini_vendor_parziali
+     set dati_stale = false
+   where riepilogo_id = any (p_riepilogo_ids)
+     and dati_stale;
+  get diagnostics v_n = row_count;
+  return v_n;
+end;
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Proiezione righe: il trigger di 20261019101000 ricostruiva tutte le righe del
+-- parziale ad ogni update. Ora:
+--   - salvataggio a delta (flag di transazione app.parziali_righe_delta = 'on'):
+--     le righe sono scritte una per una dalla RPC -> niente ricostruzione
+--   - cambia solo confermato: update della sola colonna confermato
+--   - altrimenti (salvataggio completo, insert/delete): ricostruzione come prima
+-- ---------------------------------------------------------------------------
+create or replace function public.trg_ordini_vendor_parziali_righe()
+returns trigger
+language plpgsql
+as $$
+begin
+  if current_setting('app.parziali_righe_delta', true) = 'on' then
+    return null;
+  end if;
+
+  if tg_op = 'UPDATE'
+     and new.riepilogo_id = old.riepilogo_id
+     and new.numero_parziale = old.numero_parziale
+     and new.dati::jsonb is not distinct from old.dati::jsonb then
+    if new.confermato is distinct from old.confermato then
+      update public.ordini_vendor_parziali_righe
+         set confermato = coalesce(new.confermato, false)
+       where riepilogo_id = new.riepilogo_id
+         and numero_parziale = new.numero_parziale;
+    end if;
+    return null;
+  end if;
+
+  if tg_op in ('UPDATE', 'DELETE') then
+    delete from public.ordini_vendor_parziali_righe
+     where riepilogo_id = old.riepilogo_id
+       and numero_parziale = old.numero_parziale;
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform public.ordini_vendor_parziali_righe_sync(
+      new.riepilogo_id, new.numero_parziale, new.confermato, new.dati::jsonb);
+  end if;
+  return null;
+end;
+$$;
+
+-- Scrive UNA riga della proiezione (stesse regole di ordini_vendor_parziali_righe_sync).
+-- riga = posizione ordinale: l'ordine per riga è l'ordine di dati ricostruito,
+-- i buchi lasciati dalle rimozioni sono ammessi (il salvataggio completo rinumera).
+create or replace function public.ordini_vendor_parziali_righe_put(
+  p_riepilogo_id    bigint,
+  p_numero_parziale int,
+  p_riga            int,
+  p_line            jsonb
+)
+returns void
+language sql
+as $$
+  insert into public.ordini_vendor_parziali_righe
+    (riepilogo_id, numero_parziale, riga, confermato, po_number, model_number, ean, collo, quantita, line)
+  values
+    (p_riepilogo_id, p_numero_parziale, p_riga, false,
+     p_line->>'po_number',
+     coalesce(p_line->>'model_number', p_line->>'sku'),
+     coalesce(p_line->>'vendor_product_id', p_line->>'ean', ''),
+     nullif(p_line->>'collo', ''),
+     coalesce(nullif(p_line->>'quantita', '')::numeric, nullif(p_line->>'qty', '')::numeric, 0)::int,
+     p_line)
+  on conflict (riepilogo_id, numero_parziale, riga) do update
+    set po_number    = excluded.po_number,
+        model_number = excluded.model_number,
+        ean          = excluded.ean,
+        collo        = excluded.collo,
+        quantita     = excluded.quantita,
+        line         = excluded.line;
+$$;
+
+-- p_ops: [{ "op": "add"|"update"|"remove", "line": { po_number, model_number, collo, quantita, ... } }]
+--   chiave riga = (po_number, model_number, collo)
+--   add    -> somma quantita alla riga esistente o la accoda
+--   update -> fonde i campi nella riga esistente (o la accoda)
+--   remove -> elimina la riga
+--   righe con quantita <= 0 dopo add/update vengono rimosse
+-- p_conferma_collo: { "<collo>": true|false|null } fuso nella mappa (null = rimuovi chiave)
+-- p_version: versione letta dal client (null = nessun controllo)
+-- ritorna: { numero_parziale, version, righe, last_modified_at }
+-- Ogni operazione legge e scrive una sola riga della proiezione; il parziale riceve
+-- solo conferma_collo/version/last_modified_at e dati_stale (dati non viene riscritto).
+create or replace function public.parziali_wip_apply_delta(
+  p_center         text,
+  p_start_delivery date,
+  p_ops            jsonb,
+  p_conferma_collo jsonb default null,
+  p_version        int   default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_riep    bigint;
+  v_row     record;
+  v_num     int;
+  v_conf    jsonb;
+  v_op      jsonb;
+  v_line    jsonb;
+  v_cur     jsonb;
+  v_riga    int;
+  v_max     int;
+  v_righe   int;
+  v_version int;
+  v_now     timestamptz := now();
+begin
+  select id into v_riep
+    from public.ordini_vendor_riepilogo
+   where fulfillment_center = p_center
+     and start_delivery::text = p_start_delivery::text
+   limit 1;
+  if v_riep is null then
+    raise exception 'riepilogo non trovato' using errcode = 'P0001';
+  end if;
+
+  -- serializza i salvataggi sullo stesso riepilogo (anche la creazione del WIP)
+  perform pg_advisory_xact_lock(hashtext('parziali_wip'), hashtext(v_riep::text));
+
+  select numero_parziale, conferma_collo, version into v_row
+    from public.ordini_vendor_parziali
+   where riepilogo_id = v_riep
+     and not coalesce(confermato, false)
+   order by numero_parziale desc
+   limit 1
+   for update;
+
+  -- le scritture di questa transazione sono a delta: niente ricostruzioni da trigger
+  perform set_config('app.parziali_righe_delta', 'on', true);
+
+  if found then
+    if p_version is not null and p_version <> coalesce(v_row.version, 0) then
+      raise exception 'Conflitto: dati aggiornati da altro client (versione %).', coalesce(v_row.version, 0)
+        using errcode = 'P0001';
+    end if;
+    v_num  := v_row.numero_parziale;
+    v_conf := coalesce(v_row.conferma_collo::jsonb, '{}'::jsonb);
+  else
+    -- il WIP letto dal client è stato confermato nel frattempo
+    if coalesce(p_version, 0) > 0 then
+      raise exception 'Conflitto: parziale già confermato da altro client.' using errcode = 'P0001';
+    end if;
+    select coalesce(max(numero_parziale), 0) + 1 into v_num
+      from public.ordini_vendor_parziali
+     where riepilogo_id = v_riep;
+    v_conf := '{}'::jsonb;
+    delete from public.ordini_vendor_parziali_righe
+     where riepilogo_id = v_riep and numero_parziale = v_num;
+    insert into public.ordini_vendor_parziali
+      (riepilogo_id, numero_parziale, dati, conferma_collo, confermato, created_at, last_modified_at)
+    values
+      (v_riep, v_num, '[]'::jsonb, v_conf, false, v_now, v_now);
+  end if;
+
+  select coalesce(max(riga), 0) into v_max
+    from public.ordini_vendor_parziali_righe
+   where riepilogo_id = v_riep and numero_parziale = v_num;
+
+  for v_op in select * from jsonb_array_elements(coalesce(p_ops, '[]'::jsonb)) loop
+    v_line := coalesce(v_op->'line', '{}'::jsonb);
+
+    -- riga con la stessa chiave (indice su riepilogo/parziale/modello/po)
+    v_riga := null;
+    v_cur  := null;
+    select r.riga, r.line into v_riga, v_cur
+      from public.ordini_vendor_parziali_righe r
+     where r.riepilogo_id = v_riep
+       and r.numero_parziale = v_num
+       and r.model_number is not distinct from coalesce(v_line->>'model_number', v_line->>'sku')
+       and r.po_number is not distinct from (v_line->>'po_number')
+       and r.collo is not distinct from nullif(v_line->>'collo', '')
+     order by r.riga
+     limit 1;
+
+    case v_op->>'op'
+      when 'add' then
+        if v_riga is null then
+          v_cur := v_line;
+        else
+          v_cur := jsonb_set(v_cur, '{quantita}',
+                             to_jsonb(coalesce(nullif(v_cur->>'quantita', '')::numeric, 0)
+                                      + coalesce(nullif(v_line->>'quantita', '')::numeric, 0)));
+        end if;
+      when 'update' then
+        v_cur := case when v_riga is null then v_line else v_cur || v_line end;
+      when 'remove' then
+        v_cur := null;
+      else
+        raise exception 'operazione non valida: %', coalesce(v_op->>'op', 'null') using errcode = 'P0001';
+    end case;
+
+    if v_cur is null or coalesce(nullif(v_cur->>'quantita', '')::numeric, 0) <= 0 then
+      if v_riga is not null then
+        delete from public.ordini_vendor_parziali_righe
+         where riepilogo_id = v_riep and numero_parziale = v_num and riga = v_riga;
+      end if;
+    else
+      if v_riga is null then
+        v_max  := v_max + 1;
+        v_riga := v_max;
+      end if;
+      perform public.ordini_vendor_parziali_righe_put(v_riep, v_num, v_riga, v_cur);
+    end if;
+  end loop;
+
+  if p_conferma_collo is not null then
+    v_conf := jsonb_strip_nulls(v_conf || p_conferma_collo);
+  end if;
+
+  update public.ordini_vendor_parziali p
+     set conferma_collo   = v_conf,
+         dati_stale       = true,
+         last_modified_at = v_now,
+         version          = coalesce(p.version, 0) + 1
+   where riepilogo_id = v_riep and numero_parziale = v_num
+  returning p.version into v_version;
+  perform set_config('app.parziali_righe_delta', 'off', true);
+
+  select count(*)::int into v_righe
+    from public.ordini_vendor_parziali_righe
+   where riepilogo_id = v_riep and numero_parziale = v_num;
+
+  return jsonb_build_object(
+    'numero_parziale', v_num,
+    'version', v_version,
+    'righe', v_righe,
+    'last_modified_at', v_now
+  );
+end;
+$$;
@@ -0,0 +1,365 @@
+-- Registro per (start_delivery, sku, ean) dei totali usati dal trasferimento parziali:
+--   qty_confermata  = somma righe dei parziali confermati (tutti i centri della data)
+--   riscontro/ordinato = somma prelievi Amazon Vendor della data
+-- Aggiornato a delta da trigger statement-level (righe parziali, prelievi), così
+-- transfer_parziale legge una riga per SKU invece di riaggregare tutta la giornata.
+
+create table if not exists public.ordini_vendor_totali_giorno (
+  start_delivery  date    not null,
+  sku             text    not null,
+  ean             text    not null default '',
+  qty_confermata  int     not null default 0,
+  riscontro       int     not null default 0,
+  ordinato        int     not null default 0,
+  updated_at      timestamptz not null default now(),
+  primary key (start_delivery, sku, ean)
+);
+
+-- Applica delta aggregati al registro
+create or replace function public.ordini_vendor_totali_giorno_apply(p_deltas jsonb)
+returns void
+language sql
+as $$
+  insert into public.ordini_vendor_totali_giorno as t
+    (start_delivery, sku, ean, qty_confermata, riscontro, ordinato)
+  select (d->>'start_delivery')::date, d->>'sku', coalesce(d->>'ean', ''),
+         coalesce((d->>'qty_confermata')::int, 0),
+         coalesce((d->>'riscontro')::int, 0),
+         coalesce((d->>'ordinato')::int, 0)
+    from jsonb_array_elements(coalesce(p_deltas, '[]'::jsonb)) d
+   where d->>'sku' is not null and d->>'start_delivery' is not null
+  on conflict (start_delivery, sku, ean) do update
+    set qty_confermata = t.qty_confermata + excluded.qty_confermata,
+        riscontro      = t.riscontro + excluded.riscontro,
+        ordinato       = t.ordinato + excluded.ordinato,
+        updated_at     = now();
+$$;
+
+-- ---------------------------------------------------------------------------
+-- Righe parziali confermate -> qty_confermata
+-- ---------------------------------------------------------------------------
+create or replace function public.trg_totali_giorno_parziali()
+returns trigger
+language plpgsql
+as $$
+declare
+  v_deltas jsonb := '[]'::jsonb;
+begin
+  if tg_op in ('INSERT', 'UPDATE') then
+    select v_deltas || coalesce(jsonb_agg(jsonb_build_object(
+             'start_delivery', g.d, 'sku', g.sku, 'ean', g.ean, 'qty_confermata', g.q)), '[]'::jsonb)
+      into v_deltas
+      from (select left(r.start_delivery::text, 10) as d, x.model_number as sku, x.ean, sum(x.quantita)::int as q
+              from new_rows x
+              join public.ordini_vendor_riepilogo r on r.id = x.riepilogo_id
+             where x.confermato and x.model_number is not null
+             group by 1, 2, 3) g;
+  end if;
+  if tg_op in ('DELETE', 'UPDATE') then
+    select v_deltas || coalesce(jsonb_agg(jsonb_build_object(
+             'start_delivery', g.d, 'sku', g.sku, 'ean', g.ean, 'qty_confermata', -g.q)), '[]'::jsonb)
+      into v_deltas
+      from (select left(r.start_delivery::text, 10) as d, x.model_number as sku, x.ean, sum(x.quantita)::int as q
+              from old_rows x
+              join public.ordini_vendor_riepilogo r on r.id = x.riepilogo_id
+             where x.confermato and x.model_number is not null
+             group by 1, 2, 3) g;
+  end if;
+  perform public.ordini_vendor_totali_giorno_apply(v_deltas);
+  return null;
+end;
+$$;
+
+drop trigger if exists totali_giorno_parziali_ins on public.ordini_vendor_parziali_righe;
+drop trigger if exists totali_giorno_parziali_upd on public.ordini_vendor_parziali_righe;
+drop trigger if exists totali_giorno_parziali_del on public.ordini_vendor_parziali_righe;
+create trigger totali_giorno_parziali_ins after insert on public.ordini_vendor_parziali_righe
+  referencing new table as new_rows
+  for each statement execute function public.trg_totali_giorno_parziali();
+create trigger totali_giorno_parziali_upd after update on public.ordini_vendor_parziali_righe
+  referencing new table as new_rows old table as old_rows
+  for each statement execute function public.trg_totali_giorno_parziali();
+create trigger totali_giorno_parziali_del after delete on public.ordini_vendor_parziali_righe
+  referencing old table as old_rows
+  for each statement execute function public.trg_totali_giorno_parziali();
+
+-- ---------------------------------------------------------------------------
+-- Prelievi Amazon Vendor -> riscontro / ordinato
+-- ---------------------------------------------------------------------------
+create or replace function public.trg_totali_giorno_prelievi()
+returns trigger
+language plpgsql
+as $$
+declare
+  v_deltas jsonb := '[]'::jsonb;
+begin
+  if tg_op in ('INSERT', 'UPDATE') then
+    select v_deltas || coalesce(jsonb_agg(jsonb_build_object(
+             'start_delivery', g.d, 'sku', g.sku, 'ean', g.ean, 'riscontro', g.risc, 'ordinato', g.ord)), '[]'::jsonb)
+      into v_deltas
+      from (select left(start_delivery::text, 10) as d, sku, coalesce(ean, '') as ean,
+                   sum(coalesce(riscontro, 0))::int as risc, sum(coalesce(qty, 0))::int as ord
+              from new_rows
+             where canale = 'Amazon Vendor' and sku is not null and start_delivery is not null
+             group by 1, 2, 3) g;
+  end if;
+  if tg_op in ('DELETE', 'UPDATE') then
+    select v_deltas || coalesce(jsonb_agg(jsonb_build_object(
+             'start_delivery', g.d, 'sku', g.sku, 'ean', g.ean, 'riscontro', -g.risc, 'ordinato', -g.ord)), '[]'::jsonb)
+      into v_deltas
+      from (select left(start_delivery::text, 10) as d, sku, coalesce(ean, '') as ean,
+                   sum(coalesce(riscontro, 0))::int as risc, sum(coalesce(qty, 0))::int as ord
+              from old_rows
+             where canale = 'Amazon Vendor' and sku is not null and start_delivery is not null
+             group by 1, 2, 3) g;
+  end if;
+  perform public.ordini_vendor_totali_giorno_apply(v_deltas);
+  return null;
+end;
+$$;
+
+drop trigger if exists totali_giorno_prelievi_ins on public.prelievi_ordini_amazon;
+drop trigger if exists totali_giorno_prelievi_upd on public.prelievi_ordini_amazon;
+drop trigger if exists totali_giorno_prelievi_del on public.prelievi_ordini_amazon;
+create trigger totali_giorno_prelievi_ins after insert on public.prelievi_ordini_amazon
+  referencing new table as new_rows
+  for each statement execute function public.trg_totali_giorno_prelievi();
+create trigger totali_giorno_prelievi_upd after update on public.prelievi_ordini_amazon
+  referencing new table as new_rows old table as old_rows
+  for each statement execute function public.trg_totali_giorno_prelievi();
+create trigger totali_giorno_prelievi_del after delete on public.prelievi_ordini_amazon
+  referencing old table as old_rows
+  for each statement execute function public.trg_totali_giorno_prelievi();
+
+-- Ricostruzione completa (manutenzione / riallineamento)
+create or replace function public.ordini_vendor_totali_giorno_rebuild()
+returns void
+language plpgsql
+as $$
+begin
+  lock table public.ordini_vendor_totali_giorno in exclusive mode;
+  delete from public.ordini_vendor_totali_giorno;
+
+  insert into public.ordini_vendor_totali_giorno (start_delivery, sku, ean, qty_confermata, riscontro, ordinato)
+  select d::date, sku, ean, sum(conf)::int, sum(risc)::int, sum(ord)::int
+    from (
+      select left(r.start_delivery::text, 10) as d, x.model_number as sku, x.ean,
+             x.quantita as conf, 0 as risc, 0 as ord
+        from public.ordini_vendor_parziali_righe x
+        join public.ordini_vendor_riepilogo r on r.id = x.riepilogo_id
+       where x.confermato and x.model_number is not null
+      union all
+      select left(start_delivery::text, 10), sku, coalesce(ean, ''),
+             0, coalesce(riscontro, 0), coalesce(qty, 0)
+        from public.prelievi_ordini_amazon
+       where canale = 'Amazon Vendor' and sku is not null and start_delivery is not null
+    ) u
+   group by 1, 2, 3;
+end;
+$$;
+
+select public.ordini_vendor_totali_giorno_rebuild();
+
+-- ---------------------------------------------------------------------------
+-- transfer_parziale: stessa logica, totali del giorno letti dal registro
+--
+-- Cambia la definizione di "parziali precedenti" nel calcolo del riscontro residuo:
+-- prima erano i confermati con created_at < corrente, ora sono TUTTI i confermati
+-- della data meno il corrente (il registro non conosce l'ordine di creazione).
+-- Con la conferma massiva l'ordine di conferma non segue created_at, e un parziale
+-- più recente già confermato ha comunque consumato il riscontro: conta anche lui.
+-- Il fallback Python (_need_riscontro_first) usa la stessa regola.
+-- ---------------------------------------------------------------------------
+create or replace function public.transfer_parziale(
+  p_center          text,
+  p_start_delivery  date,
+  p_numero_parziale int
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  c_attivi     constant text[] := array['Stampato', 'Calandrato', 'Cucito', 'Confezionato'];
+  c_esclusi    constant text[] := array['Da Stampare', 'Trasferito', 'Rimossi', 'Deposito'];
+  v_riep_id    bigint;
+  v_curr       record;
+  v_sku        record;
+  v_row        record;
+  v_need       int;
+  v_take       int;
+  v_avail      int;
+  v_tgt_id     bigint;
+  v_moved      int := 0;
+  v_deposited  int := 0;
+  v_failures   jsonb := '[]'::jsonb;
+  v_label      text := format('Sistema (conferma parziale #%s)', p_numero_parziale);
+begin
+  select id into v_riep_id
+    from public.ordini_vendor_riepilogo
+   where fulfillment_center = p_center
+     and start_delivery::text = p_start_delivery::text
+   limit 1;
+  if v_riep_id is null then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  select confermato into v_curr
+    from public.ordini_vendor_parziali
+   where riepilogo_id = v_riep_id
+     and numero_parziale = p_numero_parziale
+   limit 1;
+  if not found then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  -- failsafe: non muovere se non è confermato
+  if not coalesce(v_curr.confermato, false) then
+    return jsonb_build_object('moved', 0, 'deposited', 0,
+                              'failures', jsonb_build_array(jsonb_build_object('note', 'parziale non confermato')));
+  end if;
+
+  -- conferme concorrenti della stessa data si serializzano
+  perform pg_advisory_xact_lock(hashtext('transfer_parziale'), hashtext(p_start_delivery::text));
+
+  drop table if exists _tp_curr, _tp_need;
+
+  -- righe del parziale corrente (proiezione ordini_vendor_parziali_righe)
+  create temp table _tp_curr on commit drop as
+  select model_number as sku, ean, quantita as q
+    from public.ordini_vendor_parziali_righe
+   where riepilogo_id = v_riep_id
+     and numero_parziale = p_numero_parziale
+     and model_number is not null
+     and quantita > 0;
+
+  -- need per SKU (regola "riscontro-first") dal registro del giorno: una riga per SKU.
+  -- Il parziale corrente è già confermato, quindi "precedenti" = confermato - corrente.
+  create temp table _tp_need on commit drop as
+  with cur as (
+    select sku, sum(q)::int as q from _tp_curr group by sku
+  ),
+  led as (
+    select sku,
+           sum(qty_confermata)::int as conf,
+           sum(riscontro)::int      as risc,
+           sum(ordinato)::int       as ordinato
+      from public.ordini_vendor_totali_giorno
+     where start_delivery = p_start_delivery
+       and sku in (select sku from cur)
+     group by sku
+  )
+  select cur.sku,
+         cur.q                                         as q_curr,
+         coalesce(led.risc, 0)                         as risc,
+         coalesce(led.ordinato, 0)                     as ordinato,
+         greatest(0, coalesce(led.conf, 0) - cur.q)    as q_prec,
+         greatest(0, cur.q - greatest(0, coalesce(led.risc, 0)
+                                         - greatest(0, coalesce(led.conf, 0) - cur.q))) as need
+    from cur
+    left join led on led.sku = cur.sku;
+
+  for v_sku in select * from _tp_need where need > 0 order by sku loop
+    v_need := v_sku.need;
+
+    -- PASSATA 1: stessa data; prima le EAN del parziale (per qty desc), poi le altre
+    for v_row in
+      select pv.id
+        from public.produzione_vendor pv
+        left join (select ean, sum(q) as q from _tp_curr where sku = v_sku.sku group by ean) ce
+          on ce.ean = coalesce(pv.ean, '')
+       where pv.sku = v_sku.sku
+         and pv.start_delivery = p_start_delivery
+         and pv.canale = 'Amazon Vendor'
+         and pv.stato_produzione <> all (c_esclusi)
+       order by (ce.ean is null), ce.q desc nulls last, coalesce(pv.ean, ''),
+                coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.id
+    loop
+      exit when v_need <= 0;
+      select coalesce(da_produrre, 0) into v_avail
+        from public.produzione_vendor where id = v_row.id for update;
+      v_take := least(coalesce(v_avail, 0), v_need);
+      continue when v_take <= 0;
+      begin
+        perform public.transfer_parziale_move(v_row.id, 'Trasferito', v_take, v_label,
+                                              p_numero_parziale, v_riep_id);
+        v_moved := v_moved + v_take;
+        v_need  := v_need - v_take;
+      exception when others then
+        v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take, 'error', sqlerrm);
+      end;
+    end loop;
+
+    -- PASSATA 2 (fallback): altre date -> retarget sulla data -> Trasferito
+    if v_need > 0 then
+      for v_row in
+        select pv.id
+          from public.produzione_vendor pv
+         where pv.sku = v_sku.sku
+           and pv.canale = 'Amazon Vendor'
+           and pv.stato_produzione <> all (c_esclusi)
+           and pv.start_delivery is distinct from p_start_delivery
+         order by coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.start_delivery, pv.id
+      loop
+        exit when v_need <= 0;
+        select coalesce(da_produrre, 0) into v_avail
+          from public.produzione_vendor where id = v_row.id for update;
+        v_take := least(coalesce(v_avail, 0), v_need);
+        continue when v_take <= 0;
+        begin
+          v_tgt_id := public.produzione_retarget_qty(v_row.id, p_start_delivery, v_take,
+                                                     'Sistema (retarget auto)');
+          if v_tgt_id is not null then
+            perform public.transfer_parziale_move(v_tgt_id, 'Trasferito', v_take, v_label,
+                                                  p_numero_parziale, v_riep_id);
+            v_moved := v_moved + v_take;
+            v_need  := v_need - v_take;
+          end if;
+        exception when others then
+          v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take,
+                                                         'error', 'retarget+move: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+
+    if v_need > 0 then
+      v_failures := v_failures || jsonb_build_object(
+        'sku', v_sku.sku, 'missing', v_need,
+        'note', 'residuo non spostabile (nessun attivo disponibile)');
+    end if;
+  end loop;
+
+  -- POST-STEP: residui attivi in 'Deposito' se l'ordinato è coperto
+  for v_sku in select * from _tp_need order by sku loop
+    if (coalesce((select sum(coalesce(da_produrre, 0))
+                    from public.produzione_vendor
+                   where sku = v_sku.sku and canale = 'Amazon Vendor'
+                     and stato_produzione = 'Trasferito'
+                     and start_delivery = p_start_delivery), 0) + v_sku.risc) >= v_sku.ordinato
+       or (v_sku.q_prec + v_sku.q_curr) >= v_sku.ordinato
+    then
+      for v_row in
+        select id, coalesce(da_produrre, 0) as qty
+          from public.produzione_vendor
+         where sku = v_sku.sku and canale = 'Amazon Vendor'
+           and start_delivery = p_start_delivery
+           and stato_produzione = any (c_attivi)
+           and coalesce(da_produrre, 0) > 0
+         order by array_position(c_attivi, stato_produzione) desc, id
+         for update
+      loop
+        begin
+          perform public.transfer_parziale_move(v_row.id, 'Deposito', v_row.qty,
+                                                'Sistema (cleanup post-conferma)',
+                                                p_numero_parziale, v_riep_id);
+          v_deposited := v_deposited + v_row.qty;
+        exception when others then
+          v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_row.qty,
+                                                         'error', 'deposito: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+  end loop;
+
+  return jsonb_build_object('moved', v_moved, 'failures', v_failures, 'deposited', v_deposited);
+end;
+$$;
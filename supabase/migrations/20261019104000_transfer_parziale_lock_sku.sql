@@ -0,0 +1,212 @@
+-- transfer_parziale: lock per SKU invece che per data, così la conferma massiva
+-- può eseguire in parallelo i trasferimenti di centri senza SKU in comune.
+-- Corpo invariato rispetto a 20261019103000 salvo il lock e la gestione errori:
+-- deadlock / lock non ottenibile NON diventano "failure" della singola riga ma
+-- annullano l'intero trasferimento, che il chiamante riesegue (la conferma massiva
+-- lo ripete in sequenza dopo le ondate parallele).
+
+create or replace function public.transfer_parziale(
+  p_center          text,
+  p_start_delivery  date,
+  p_numero_parziale int
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  c_attivi     constant text[] := array['Stampato', 'Calandrato', 'Cucito', 'Confezionato'];
+  c_esclusi    constant text[] := array['Da Stampare', 'Trasferito', 'Rimossi', 'Deposito'];
+  v_riep_id    bigint;
+  v_curr       record;
+  v_sku        record;
+  v_row        record;
+  v_need       int;
+  v_take       int;
+  v_avail      int;
+  v_tgt_id     bigint;
+  v_moved      int := 0;
+  v_deposited  int := 0;
+  v_failures   jsonb := '[]'::jsonb;
+  v_label      text := format('Sistema (conferma parziale #%s)', p_numero_parziale);
+begin
+  select id into v_riep_id
+    from public.ordini_vendor_riepilogo
+   where fulfillment_center = p_center
+     and start_delivery::text = p_start_delivery::text
+   limit 1;
+  if v_riep_id is null then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  select confermato into v_curr
+    from public.ordini_vendor_parziali
+   where riepilogo_id = v_riep_id
+     and numero_parziale = p_numero_parziale
+   limit 1;
+  if not found then
+    return jsonb_build_object('moved', 0, 'failures', '[]'::jsonb, 'deposited', 0);
+  end if;
+
+  -- failsafe: non muovere se non è confermato
+  if not coalesce(v_curr.confermato, false) then
+    return jsonb_build_object('moved', 0, 'deposited', 0,
+                              'failures', jsonb_build_array(jsonb_build_object('note', 'parziale non confermato')));
+  end if;
+
+  drop table if exists _tp_curr, _tp_need;
+
+  -- righe del parziale corrente (proiezione ordini_vendor_parziali_righe)
+  create temp table _tp_curr on commit drop as
+  select model_number as sku, ean, quantita as q
+    from public.ordini_vendor_parziali_righe
+   where riepilogo_id = v_riep_id
+     and numero_parziale = p_numero_parziale
+     and model_number is not null
+     and quantita > 0;
+
+  -- lock per SKU (ordine deterministico): trasferimenti di parziali con SKU disgiunti
+  -- procedono in parallelo, quelli che condividono SKU (anche su date diverse,
+  -- per via del retarget) si serializzano
+  perform pg_advisory_xact_lock(hashtext('transfer_parziale'), hashtext(s.sku))
+     from (select distinct sku from _tp_curr order by sku) s;
+
+  -- need per SKU (regola "riscontro-first") dal registro del giorno: una riga per SKU.
+  -- Il parziale corrente è già confermato, quindi "precedenti" = confermato - corrente.
+  create temp table _tp_need on commit drop as
+  with cur as (
+    select sku, sum(q)::int as q from _tp_curr group by sku
+  ),
+  led as (
+    select sku,
+           sum(qty_confermata)::int as conf,
+           sum(riscontro)::int      as risc,
+           sum(ordinato)::int       as ordinato
+      from public.ordini_vendor_totali_giorno
+     where start_delivery = p_start_delivery
+       and sku in (select sku from cur)
+     group by sku
+  )
+  select cur.sku,
+         cur.q                                         as q_curr,
+         coalesce(led.risc, 0)                         as risc,
+         coalesce(led.ordinato, 0)                     as ordinato,
+         greatest(0, coalesce(led.conf, 0) - cur.q)    as q_prec,
+         greatest(0, cur.q - greatest(0, coalesce(led.risc, 0)
+                                         - greatest(0, coalesce(led.conf, 0) - cur.q))) as need
+    from cur
+    left join led on led.sku = cur.sku;
+
+  for v_sku in select * from _tp_need where need > 0 order by sku loop
+    v_need := v_sku.need;
+
+    -- PASSATA 1: stessa data; prima le EAN del parziale (per qty desc), poi le altre
+    for v_row in
+      select pv.id
+        from public.produzione_vendor pv
+        left join (select ean, sum(q) as q from _tp_curr where sku = v_sku.sku group by ean) ce
+          on ce.ean = coalesce(pv.ean, '')
+       where pv.sku = v_sku.sku
+         and pv.start_delivery = p_start_delivery
+         and pv.canale = 'Amazon Vendor'
+         and pv.stato_produzione <> all (c_esclusi)
+       order by (ce.ean is null), ce.q desc nulls last, coalesce(pv.ean, ''),
+                coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.id
+    loop
+      exit when v_need <= 0;
+      select coalesce(da_produrre, 0) into v_avail
+        from public.produzione_vendor where id = v_row.id for update;
+      v_take := least(coalesce(v_avail, 0), v_need);
+      continue when v_take <= 0;
+      begin
+        perform public.transfer_parziale_move(v_row.id, 'Trasferito', v_take, v_label,
+                                              p_numero_parziale, v_riep_id);
+        v_moved := v_moved + v_take;
+        v_need  := v_need - v_take;
+      exception
+        when deadlock_detected or serialization_failure or lock_not_available then
+          raise;
+        when others then
+          v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take, 'error', sqlerrm);
+      end;
+    end loop;
+
+    -- PASSATA 2 (fallback): altre date -> retarget sulla data -> Trasferito
+    if v_need > 0 then
+      for v_row in
+        select pv.id
+          from public.produzione_vendor pv
+         where pv.sku = v_sku.sku
+           and pv.canale = 'Amazon Vendor'
+           and pv.stato_produzione <> all (c_esclusi)
+           and pv.start_delivery is distinct from p_start_delivery
+         order by coalesce(array_position(c_attivi, pv.stato_produzione), 999), pv.start_delivery, pv.id
+      loop
+        exit when v_need <= 0;
+        select coalesce(da_produrre, 0) into v_avail
+          from public.produzione_vendor where id = v_row.id for update;
+        v_take := least(coalesce(v_avail, 0), v_need);
+        continue when v_take <= 0;
+        begin
+          v_tgt_id := public.produzione_retarget_qty(v_row.id, p_start_delivery, v_take,
+                                                     'Sistema (retarget auto)');
+          if v_tgt_id is not null then
+            perform public.transfer_parziale_move(v_tgt_id, 'Trasferito', v_take, v_label,
+                                                  p_numero_parziale, v_riep_id);
+            v_moved := v_moved + v_take;
+            v_need  := v_need - v_take;
+          end if;
+        exception
+          when deadlock_detected or serialization_failure or lock_not_available then
+            raise;
+          when others then
+            v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_take,
+                                                           'error', 'retarget+move: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+
+    if v_need > 0 then
+      v_failures := v_failures || jsonb_build_object(
+        'sku', v_sku.sku, 'missing', v_need,
+        'note', 'residuo non spostabile (nessun attivo disponibile)');
+    end if;
+  end loop;
+
+  -- POST-STEP: residui attivi in 'Deposito' se l'ordinato è coperto
+  for v_sku in select * from _tp_need order by sku loop
+    if (coalesce((select sum(coalesce(da_produrre, 0))
+                    from public.produzione_vendor
+                   where sku = v_sku.sku and canale = 'Amazon Vendor'
+                     and stato_produzione = 'Trasferito'
+                     and start_delivery = p_start_delivery), 0) + v_sku.risc) >= v_sku.ordinato
+       or (v_sku.q_prec + v_sku.q_curr) >= v_sku.ordinato
+    then
+      for v_row in
+        select id, coalesce(da_produrre, 0) as qty
+          from public.produzione_vendor
+         where sku = v_sku.sku and canale = 'Amazon Vendor'
+           and start_delivery = p_start_delivery
+           and stato_produzione = any (c_attivi)
+           and coalesce(da_produrre, 0) > 0
+         order by array_position(c_attivi, stato_produzione) desc, id
+         for update
+      loop
+        begin
+          perform public.transfer_parziale_move(v_row.id, 'Deposito', v_row.qty,
+                                                'Sistema (cleanup post-conferma)',
+                                                p_numero_parziale, v_riep_id);
+          v_deposited := v_deposited + v_row.qty;
+        exception
+          when deadlock_detected or serialization_failure or lock_not_available then
+            raise;
+          when others then
+            v_failures := v_failures || jsonb_build_object('sku', v_sku.sku, 'take', v_row.qty,
+                                                           'error', 'deposito: ' || sqlerrm);
+        end;
+      end loop;
+    end if;
+  end loop;
+
+  return jsonb_build_object('moved', v_moved, 'failures', v_failures, 'deposited', v_deposited);
+end;
+$$;
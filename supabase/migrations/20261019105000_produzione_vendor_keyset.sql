@@ -0,0 +1,55 @@
+-- Lista produzione paginata (keyset su start_delivery, sku, id) con GET condizionale.
+--
+-- L'ETag si basa su un contatore di versione incrementato una volta per transazione
+-- che modifica produzione_vendor. Non su max(updated_at): now() è l'inizio della
+-- transazione, e una transazione iniziata prima ma committata dopo non sposterebbe
+-- il massimo (304 con righe mancanti). Il contatore è aggiornato da un trigger
+-- deferred, quindi al commit: diventa visibile insieme alle righe e, essendo l'ultimo
+-- lock preso, non crea cicli con i lock di riga dei trasferimenti paralleli.
+-- Le righe contatore sono 16 (shard per txid) per non serializzare i writer su una riga.
+
+create table if not exists public.produzione_vendor_version (
+  shard smallint primary key,
+  n     bigint   not null default 0
+);
+
+insert into public.produzione_vendor_version (shard)
+select g from generate_series(0, 15) g
+on conflict (shard) do nothing;
+
+create or replace function public.trg_produzione_vendor_version()
+returns trigger
+language plpgsql
+as $$
+declare
+  v_tx text := txid_current()::text;
+begin
+  -- una sola volta per transazione (il trigger è per riga)
+  if current_setting('app.produzione_version_tx', true) is distinct from v_tx then
+    perform set_config('app.produzione_version_tx', v_tx, true);
+    update public.produzione_vendor_version
+       set n = n + 1
+     where shard = (txid_current() % 16)::smallint;
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists produzione_vendor_version_trg on public.produzione_vendor;
+create constraint trigger produzione_vendor_version_trg
+  after insert or update or delete on public.produzione_vendor
+  deferrable initially deferred
+  for each row execute function public.trg_produzione_vendor_version();
+
+-- versione corrente della tabella (cambia ad ogni commit che la modifica)
+create or replace function public.produzione_vendor_version_get()
+returns bigint
+language sql
+stable
+as $$
+  select coalesce(sum(n), 0)::bigint from public.produzione_vendor_version
+$$;
+
+-- ordinamento della lista (nulls first come l'ORDER BY lato API)
+create index if not exists produzione_vendor_keyset_idx
+  on public.produzione_vendor (start_delivery nulls first, sku, id);
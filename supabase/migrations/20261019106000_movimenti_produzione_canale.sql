@@ -0,0 +1,31 @@
+-- Log movimenti produzione: canale sempre valorizzato in scrittura (anche per i log
+-- scritti dai trigger), così la lettura non deve più risalire a produzione_vendor.
+
+create or replace function public.trg_movimenti_produzione_canale()
+returns trigger
+language plpgsql
+as $$
+begin
+  if new.canale is null then
+    new.canale := nullif(new.dettaglio::jsonb->>'canale', '');
+  end if;
+  if new.canale is null and new.produzione_id is not null then
+    select pv.canale into new.canale
+      from public.produzione_vendor pv
+     where pv.id = new.produzione_id;
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists movimenti_produzione_canale_trg on public.movimenti_produzione_vendor;
+create trigger movimenti_produzione_canale_trg
+  before insert on public.movimenti_produzione_vendor
+  for each row execute function public.trg_movimenti_produzione_canale();
+
+-- backfill dei log storici senza canale
+update public.movimenti_produzione_vendor m
+   set canale = coalesce(nullif(m.dettaglio::jsonb->>'canale', ''), pv.canale)
+  from public.produzione_vendor pv
+ where m.canale is null
+   and pv.id = m.produzione_id;
@@ -0,0 +1,132 @@
+-- Spostamento di stato in blocco delle righe produzione (PATCH /api/produzione/bulk)
+-- in UNA chiamata/transazione. Per ogni mossa, come _merge_into_target + cancellazione:
+--   - somma la qty sulla riga target (stessa sku/ean/data/canale, stato = to_state)
+--     oppure la crea
+--   - scala la sorgente (cancellata se svuotata)
+--   - log 'Spostamento a <stato>' sulla TARGET (per non rompere l'FK)
+-- Gli altri campi (p_fields: plus/note/...) vanno sulle target; le righe senza
+-- quantità ricevono solo quelli. Un log riepilogativo 'Bulk spostamento a ...' a fine giro.
+--
+-- p_moves: [{ "from_id": 1, "to_state": "Calandrato", "qty": 5 }]  (qty null = tutta)
+-- ritorna: { "moved_qty": int, "moved": [{ from_id, target_id, qty }], "skipped": [from_id...] }
+
+create or replace function public.produzione_move_bulk(
+  p_moves      jsonb,
+  p_fields     jsonb default '{}'::jsonb,
+  p_user_label text  default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_mv        jsonb;
+  v_to_state  text;
+  src         public.produzione_vendor%rowtype;
+  v_q         int;
+  v_tgt_id    bigint;
+  v_tgt_ids   bigint[] := '{}';
+  v_moved     jsonb := '[]'::jsonb;
+  v_skipped   jsonb := '[]'::jsonb;
+  v_total     int := 0;
+  v_states    text[] := '{}';
+  v_fields    jsonb := coalesce(p_fields, '{}'::jsonb) - 'stato_produzione' - 'id';
+  v_set       text;
+begin
+  -- colonne reali di produzione_vendor presenti in p_fields
+  select string_agg(format('%1$I = r.%1$I', c.column_name), ', ')
+    into v_set
+    from information_schema.columns c
+   where c.table_schema = 'public'
+     and c.table_name = 'produzione_vendor'
+     and v_fields ? c.column_name;
+
+  -- ordine per id: lock sempre nello stesso ordine tra chiamate concorrenti
+  for v_mv in
+    select e from jsonb_array_elements(coalesce(p_moves, '[]'::jsonb)) e
+     order by (e->>'from_id')::bigint
+  loop
+    v_to_state := v_mv->>'to_state';
+    select * into src from public.produzione_vendor
+     where id = (v_mv->>'from_id')::bigint
+     for update;
+    if not found or v_to_state is null then
+      v_skipped := v_skipped || to_jsonb((v_mv->>'from_id')::bigint);
+      continue;
+    end if;
+
+    v_q := least(coalesce(src.da_produrre, 0),
+                 coalesce(nullif(v_mv->>'qty', '')::int, coalesce(src.da_produrre, 0)));
+
+    -- niente da spostare (o già nello stato): solo gli altri campi sulla riga stessa
+    if v_q <= 0 or src.stato_produzione = v_to_state then
+      v_tgt_ids := v_tgt_ids || src.id;
+      continue;
+    end if;
+
+    select id into v_tgt_id
+      from public.produzione_vendor
+     where sku = src.sku
+       and ean is not distinct from src.ean
+       and start_delivery is not distinct from src.start_delivery
+       and canale is not distinct from src.canale
+       and stato_produzione = v_to_state
+     order by id
+     limit 1
+     for update;
+
+    if v_tgt_id is not null then
+      update public.produzione_vendor
+         set da_produrre = coalesce(da_produrre, 0) + v_q
+       where id = v_tgt_id;
+    else
+      insert into public.produzione_vendor
+        (prelievo_id, sku, ean, qty, riscontro, plus, start_delivery, stato,
+         stato_produzione, da_produrre, cavallotti, note, canale)
+      values
+        (null, src.sku, src.ean, src.qty, src.riscontro, 0, src.start_delivery, src.stato,
+         v_to_state, v_q, src.cavallotti, src.note, src.canale)
+      returning id into v_tgt_id;
+    end if;
+
+    if v_q >= coalesce(src.da_produrre, 0) then
+      delete from public.produzione_vendor where id = src.id;
+    else
+      update public.produzione_vendor set da_produrre = da_produrre - v_q where id = src.id;
+    end if;
+
+    insert into public.movimenti_produzione_vendor
+      (produzione_id, sku, ean, canale, stato_vecchio, stato_nuovo, qty_vecchia, qty_nuova,
+       plus_vecchio, plus_nuovo, motivo, utente, dettaglio)
+    values
+      (v_tgt_id, src.sku, src.ean, src.canale, src.stato_produzione, v_to_state, v_q, v_q,
+       coalesce(src.plus, 0),
+       coalesce(nullif(v_fields->>'plus', '')::int, coalesce(src.plus, 0)),
+       'Spostamento a ' || v_to_state, p_user_label,
+       jsonb_build_object('source_id', src.id, 'bulk', true));
+
+    v_tgt_ids := v_tgt_ids || v_tgt_id;
+    v_moved   := v_moved || jsonb_build_object('from_id', src.id, 'target_id', v_tgt_id, 'qty', v_q);
+    v_total   := v_total + v_q;
+    if not v_to_state = any (v_states) then
+      v_states := v_states || v_to_state;
+    end if;
+  end loop;
+
+  if v_set is not null and cardinality(v_tgt_ids) > 0 then
+    execute format(
+      'update public.produzione_vendor t set %s
+         from jsonb_populate_record(null::public.produzione_vendor, $1) r
+        where t.id = any ($2)', v_set)
+      using v_fields, v_tgt_ids;
+  end if;
+
+  insert into public.movimenti_produzione_vendor
+    (produzione_id, sku, ean, canale, motivo, utente, dettaglio)
+  select null, '*', null, 'Amazon Vendor', 'Bulk spostamento a ' || s, p_user_label,
+         jsonb_build_object('affected_count', jsonb_array_length(coalesce(p_moves, '[]'::jsonb)),
+                            'moved_qty', v_total)
+    from unnest(v_states) s;
+
+  return jsonb_build_object('moved_qty', v_total, 'moved', v_moved, 'skipped', v_skipped);
+end;
+$$;
@@ -0,0 +1,28 @@
+-- Cancellazione in blocco di righe produzione + log collegati in UNA transazione
+-- (prima: delete a lotti di 100 con pause, prima i log poi le righe, con finestre
+-- in cui i log erano spariti ma le righe no).
+-- ritorna: { "deleted": int, "log_deleted": int }
+
+create or replace function public.produzione_delete_bulk(p_ids bigint[])
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_logs int;
+  v_rows int;
+begin
+  -- lock delle righe nello stesso ordine delle altre operazioni bulk
+  perform 1 from public.produzione_vendor
+   where id = any (p_ids)
+   order by id
+     for update;
+
+  delete from public.movimenti_produzione_vendor where produzione_id = any (p_ids);
+  get diagnostics v_logs = row_count;
+
+  delete from public.produzione_vendor where id = any (p_ids);
+  get diagnostics v_rows = row_count;
+
+  return jsonb_build_object('deleted', v_rows, 'log_deleted', v_logs);
+end;
+$$;
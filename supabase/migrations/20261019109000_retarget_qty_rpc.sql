@@ -0,0 +1,68 @@
+-- Retarget atomico di quantità produzione su una nuova data di consegna.
+-- Stessa logica di _retarget_qty_to_date (merge su target stessa sku/ean/stato/canale
+-- con la nuova data, scalo della sorgente, due log, delete se svuotata) in una
+-- transazione con lock sulla sorgente: niente read-modify-write su da_produrre.
+
+-- Singolo: ritorna l'id della riga target (null se niente da spostare)
+create or replace function public.retarget_qty_rpc(
+  p_src_id     bigint,
+  p_new_date   date,
+  p_qty        int,
+  p_user_label text default null
+)
+returns bigint
+language sql
+as $$
+  select public.produzione_retarget_qty(p_src_id, p_new_date, p_qty, coalesce(p_user_label, 'Sistema'));
+$$;
+
+-- Batch: sposta più righe sulla stessa nuova finestra di consegna.
+-- p_items: [{ "src_id": 1, "qty": 5 }]  (qty null = tutta la riga)
+-- ritorna: { "moved_qty": int, "moved": [{ src_id, target_id, qty }], "skipped": [src_id...] }
+create or replace function public.retarget_qty_bulk(
+  p_items      jsonb,
+  p_new_date   date,
+  p_user_label text default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_it      record;
+  v_avail   int;
+  v_take    int;
+  v_tgt_id  bigint;
+  v_total   int := 0;
+  v_moved   jsonb := '[]'::jsonb;
+  v_skipped jsonb := '[]'::jsonb;
+begin
+  -- ordine per id: lock coerenti tra chiamate concorrenti
+  for v_it in
+    select (e->>'src_id')::bigint as src_id, nullif(e->>'qty', '')::int as qty
+      from jsonb_array_elements(coalesce(p_items, '[]'::jsonb)) e
+     order by 1
+  loop
+    select coalesce(da_produrre, 0) into v_avail
+      from public.produzione_vendor
+     where id = v_it.src_id
+       and start_delivery is distinct from p_new_date
+       for update;
+    v_take := least(coalesce(v_avail, 0), coalesce(v_it.qty, v_avail, 0));
+
+    v_tgt_id := null;
+    if v_take > 0 then
+      v_tgt_id := public.produzione_retarget_qty(v_it.src_id, p_new_date, v_take,
+                                                 coalesce(p_user_label, 'Sistema'));
+    end if;
+
+    if v_tgt_id is null then
+      v_skipped := v_skipped || to_jsonb(v_it.src_id);
+    else
+      v_total := v_total + v_take;
+      v_moved := v_moved || jsonb_build_object('src_id', v_it.src_id, 'target_id', v_tgt_id, 'qty', v_take);
+    end if;
+  end loop;
+
+  return jsonb_build_object('moved_qty', v_total, 'moved', v_moved, 'skipped', v_skipped);
+end;
+$$;
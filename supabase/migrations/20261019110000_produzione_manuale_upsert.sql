@@ -0,0 +1,121 @@
+-- Inserimento manuale in produzione (Sito / Amazon Seller) a blocchi, con
+-- aggrega-o-inserisci via INSERT ... ON CONFLICT sulla chiave logica
+-- (sku, ean, canale, stato_produzione, start_delivery) delle righe 'Da Stampare'.
+-- Niente lookup+update/insert separati: sicuro con inserimenti concorrenti.
+--
+-- Solo canali manuali: le righe Amazon Vendor (sync da prelievo, move/retarget)
+-- restano fuori da merge e indice univoco, lì qty/plus/prelievo_id hanno altro significato
+-- e più righe 'Da Stampare' con la stessa chiave sono legittime.
+
+-- 1) eventuali doppioni 'Da Stampare' manuali (nati da inserimenti concorrenti) confluiscono
+--    nella riga con id minore, i log seguono la riga superstite
+with dup as (
+  select id,
+         min(id) over w as keep_id,
+         sum(coalesce(da_produrre, 0)) over w as tot
+    from public.produzione_vendor
+   where stato_produzione = 'Da Stampare'
+     and canale in ('Sito', 'Amazon Seller')
+  window w as (partition by sku, ean, canale, start_delivery)
+),
+upd as (
+  update public.produzione_vendor p
+     set da_produrre = d.tot, qty = d.tot, plus = 0
+    from dup d
+   where p.id = d.id
+     and d.id = d.keep_id
+     and exists (select 1 from dup x where x.keep_id = d.keep_id and x.id <> x.keep_id)
+  returning p.id
+),
+mv as (
+  update public.movimenti_produzione_vendor m
+     set produzione_id = d.keep_id
+    from dup d
+   where m.produzione_id = d.id
+     and d.id <> d.keep_id
+  returning m.id
+)
+delete from public.produzione_vendor p
+ using dup d
+ where p.id = d.id
+   and d.id <> d.keep_id;
+
+-- 2) chiave logica univoca (NULL su ean/start_delivery contano come uguali, come _eq_or_is_null)
+create unique index if not exists produzione_vendor_manuale_da_stampare_uq
+  on public.produzione_vendor (sku, ean, canale, stato_produzione, start_delivery)
+  nulls not distinct
+  where stato_produzione = 'Da Stampare'
+    and canale in ('Sito', 'Amazon Seller');
+
+-- p_items: [{ sku, ean, canale, qty, plus, start_delivery, note, cavallotti }]
+-- Stessa semantica di crea_produzione_manuale:
+--   nuova riga   -> qty, plus, da_produrre = qty + plus, log 'Inserimento manuale'
+--   riga esistente -> da_produrre = qty = esistente + qty + plus, plus = 0, note/cavallotti sovrascritti
+-- Voci con la stessa chiave nello stesso blocco vengono sommate prima dell'upsert.
+-- ritorna: [{ id, sku, ean, canale, start_delivery, da_produrre, aggregated }]
+create or replace function public.produzione_manuale_upsert(
+  p_items      jsonb,
+  p_user_label text default null
+)
+returns jsonb
+language plpgsql
+as $$
+declare
+  v_out jsonb;
+begin
+  with src as (
+    select x.*, e.ord
+      from jsonb_array_elements(coalesce(p_items, '[]'::jsonb)) with ordinality as e(val, ord)
+     cross join lateral jsonb_to_record(e.val) as x(
+       sku text, ean text, canale text, qty int, plus int,
+       start_delivery date, note text, cavallotti boolean)
+  ),
+  agg as (
+    select sku, nullif(ean, '') as ean, canale, start_delivery,
+           sum(qty)::int as qty,
+           sum(coalesce(plus, 0))::int as plus,
+           (array_agg(nullif(note, '') order by ord desc))[1] as note,
+           (array_agg(coalesce(cavallotti, false) order by ord desc))[1] as cavallotti
+      from src
+     where canale in ('Sito', 'Amazon Seller')
+     group by sku, nullif(ean, ''), canale, start_delivery
+  ),
+  ups as (
+    insert into public.produzione_vendor as t
+      (prelievo_id, sku, ean, qty, riscontro, plus, start_delivery, stato,
+       stato_produzione, da_produrre, cavallotti, note, canale)
+    select null, sku, ean, qty, 0, plus, start_delivery, 'manuale',
+           'Da Stampare', qty + plus, cavallotti, note, canale
+      from agg
+    on conflict (sku, ean, canale, stato_produzione, start_delivery)
+      where stato_produzione = 'Da Stampare'
+        and canale in ('Sito', 'Amazon Seller')
+    do update
+       set da_produrre = coalesce(t.da_produrre, 0) + excluded.da_produrre,
+           qty         = coalesce(t.da_produrre, 0) + excluded.da_produrre,
+           plus        = 0,
+           note        = excluded.note,
+           cavallotti  = excluded.cavallotti
+    returning t.id, t.sku, t.ean, t.canale, t.start_delivery, t.da_produrre, t.plus,
+              (t.xmax::text <> '0') as aggregated
+  ),
+  logs as (
+    insert into public.movimenti_produzione_vendor
+      (produzione_id, sku, ean, canale, stato_vecchio, stato_nuovo, qty_vecchia, qty_nuova,
+       plus_vecchio, plus_nuovo, motivo, utente, dettaglio)
+    select id, sku, ean, canale, null, 'Da Stampare', null, da_produrre,
+           null, coalesce(plus, 0), 'Inserimento manuale', coalesce(p_user_label, 'Sistema'),
+           jsonb_build_object('canale', canale)
+      from ups
+     where not aggregated
+    returning 1
+  )
+  select coalesce(jsonb_agg(jsonb_build_object(
+           'id', id, 'sku', sku, 'ean', ean, 'canale', canale, 'start_delivery', start_delivery,
+           'da_produrre', da_produrre, 'aggregated', aggregated) order by id), '[]'::jsonb)
+    into v_out
+    from ups;
+
+  return v_out;
+end;
+$$;
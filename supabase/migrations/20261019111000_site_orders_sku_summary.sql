@@ -0,0 +1,30 @@
+-- Riepilogo ordini Sito INEVASI per SKU, aggregato lato DB.
+-- Prima: scaricati gli id di tutti gli ordini 'inevaso' e rispediti in un in_(order_id, ...)
+-- (payload che cresce con l'arretrato). Ora una sola chiamata, anche per più SKU.
+--
+-- p_skus: ['SKU1', 'SKU2', ...]
+-- ritorna: una riga per SKU presente negli ordini inevasi (gli SKU assenti non compaiono)
+--   { sku, orders_count (ordini distinti), total_qty }
+
+create index if not exists order_items_sku_order_idx
+  on public.order_items (sku, order_id);
+
+create index if not exists orders_inevaso_idx
+  on public.orders (id)
+  where fulfillment_status = 'inevaso';
+
+create or replace function public.site_orders_sku_summary(p_skus text[])
+returns table (sku text, orders_count int, total_qty int)
+language sql
+stable
+as $$
+  select i.sku,
+         count(distinct i.order_id)::int      as orders_count,
+         coalesce(sum(i.quantity), 0)::int    as total_qty
+    from public.order_items i
+    join public.orders o
+      on o.id = i.order_id
+     and o.fulfillment_status = 'inevaso'
+   where i.sku = any (coalesce(p_skus, '{}'::text[]))
+   group by i.sku;
+$$;
@@ -0,0 +1,21 @@
+-- Ingestione ordini Vendor da SP-API (getPurchaseOrders) al posto dell'upload Excel.
+--
+-- 1) chiave stabile di riga PO: '<purchaseOrderNumber>#<itemSequenceNumber>'.
+--    Le righe importate da Excel restano con po_item_key NULL (NULL distinti: nessun conflitto).
+alter table public.ordini_vendor_items
+  add column if not exists po_item_key text,
+  add column if not exists po_changed_at timestamptz;
+
+create unique index if not exists ordini_vendor_items_po_item_key_uq
+  on public.ordini_vendor_items (po_item_key);
+
+create index if not exists ordini_vendor_items_fc_start_idx
+  on public.ordini_vendor_items (fulfillment_center, start_delivery);
+
+-- 2) watermark dei sync incrementali (uno per sorgente)
+create table if not exists public.spapi_sync_state (
+  name        text primary key,
+  watermark   timestamptz,
+  last_result jsonb,
+  updated_at  timestamptz not null default now()
+);